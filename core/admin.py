@@ -1,5 +1,17 @@
-from django.contrib import admin
-from .models import Profile, Realm
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.auth.models import User
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.http import HttpResponseRedirect
+from django.template.response import TemplateResponse
+from django.urls import path
+
+from . import liveops
+from .consumers import realm_router
+from .maps import MapValidationError, normalize_map
+from .models import MapBlob, Profile, Realm
 
 
 @admin.register(Profile)
@@ -8,9 +20,107 @@ class ProfileAdmin(admin.ModelAdmin):
     search_fields = ('user__username',)
 
 
+class RealmForm(forms.ModelForm):
+    # Stored in a MapBlob, shared with realms that have the same map
+    map_data = forms.JSONField()
+
+    class Meta:
+        model = Realm
+        fields = ('owner', 'name', 'only_owner', 'is_template')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.map_blob_id:
+            self.fields['map_data'].initial = self.instance.map_data
+
+    def clean_map_data(self):
+        try:
+            return normalize_map(self.cleaned_data['map_data'])
+        except MapValidationError as e:
+            raise ValidationError(str(e))
+
+    def save(self, commit=True):
+        self.instance.map_data = self.cleaned_data['map_data']
+        return super().save(commit)
+
+
 @admin.register(Realm)
 class RealmAdmin(admin.ModelAdmin):
-    list_display = ('name', 'owner', 'created_at', 'only_owner')
-    list_filter = ('only_owner', 'created_at')
+    form = RealmForm
+    list_display = ('name', 'owner', 'created_at', 'only_owner', 'is_template')
+    list_filter = ('only_owner', 'is_template', 'created_at')
+    # Name icontains is served by a trigram index on PostgreSQL; see migration 0005
     search_fields = ('name', 'owner__username')
-    readonly_fields = ('share_id', 'created_at')
+    readonly_fields = ('share_id', 'created_at', 'map_blob')
+    list_select_related = ('owner',)
+    # Counting every realm for each changelist page is a full scan
+    show_full_result_count = False
+
+    def get_urls(self):
+        return [
+            path('live/', self.admin_site.admin_view(self.live_sessions_view), name='core_realm_live'),
+        ] + super().get_urls()
+
+    def live_sessions_view(self, request):
+        """Running sessions on every worker, with kick and drain actions"""
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        realm_router.start_once()
+        if request.method == 'POST':
+            self.live_action(request)
+            return HttpResponseRedirect(request.path)
+
+        sessions, silent = async_to_sync(liveops.collect_stats)()
+        names = {
+            str(realm_id): name for realm_id, name in
+            Realm.objects.filter(id__in=[s['realm_id'] for s in sessions if s['realm_id'].isdigit()])
+            .values_list('id', 'name')
+        }
+        for stats in sessions:
+            stats['name'] = names.get(stats['realm_id'], '(deleted)')
+            stats['fan_out'] = stats['sent'] / stats['events'] if stats['events'] else 0
+        return TemplateResponse(request, 'admin/core/realm/live_sessions.html', {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Live sessions',
+            'sessions': sessions,
+            'silent_workers': silent,
+            'rate_seconds': settings.LIVEOPS_RATE_SECONDS,
+        })
+
+    def live_action(self, request):
+        realm_id = request.POST.get('realm_id', '')
+        action = request.POST.get('action')
+        if action == 'drain':
+            closed = async_to_sync(liveops.drain)(realm_id, 'This space was closed by an administrator.')
+            if closed is None:
+                self.message_user(request, f'The worker holding realm {realm_id} did not answer.', messages.ERROR)
+            else:
+                self.message_user(request, f'Drained realm {realm_id}: {closed} connection(s) closed.')
+        elif action == 'kick':
+            username = request.POST.get('username', '').strip()
+            user = User.objects.filter(username=username).only('id').first()
+            kicked = user and async_to_sync(liveops.kick)(
+                realm_id, str(user.id), 'You were removed from this space by an administrator.'
+            )
+            if kicked:
+                self.message_user(request, f'Kicked {username} from realm {realm_id}.')
+            else:
+                self.message_user(request, f'{username or "Nobody"} is not in realm {realm_id}.', messages.WARNING)
+
+
+@admin.register(MapBlob)
+class MapBlobAdmin(admin.ModelAdmin):
+    list_display = ('hash', 'refcount', 'created_at')
+    readonly_fields = ('hash', 'refcount', 'created_at')
+    exclude = ('map_data', 'map_artifacts')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        # Shared by realms; change a realm's map instead
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,142 @@
+import asyncio
+import atexit
+import bisect
+import hashlib
+import logging
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Sorted set of live workers, scored by their last heartbeat
+WORKERS_KEY = 'gather:realm-workers'
+
+
+class HashRing:
+    """Consistent hash ring mapping realm ids onto worker ids"""
+    def __init__(self, workers=(), replicas=64):
+        self.workers = frozenset(workers)
+        self.points = sorted(
+            (self._hash(f"{worker}#{i}"), worker)
+            for worker in self.workers
+            for i in range(replicas)
+        )
+        self.keys = [point for point, _ in self.points]
+
+    def get_worker(self, key):
+        if not self.points:
+            return None
+        index = bisect.bisect(self.keys, self._hash(str(key))) % len(self.points)
+        return self.points[index][1]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class RealmRouter:
+    """Decides which worker process owns each realm.
+
+    Every worker heartbeats into a Redis sorted set and builds the same
+    hash ring from the live members, so they all agree on a realm's owner
+    without talking to each other. Workers receive forwarded game events on
+    their own channel layer channel, which doubles as their id on the ring.
+
+    Without REDIS_URL there is a single process and it owns every realm.
+    """
+    def __init__(self, on_message, on_ring_change, on_start=None):
+        self.on_message = on_message
+        self.on_ring_change = on_ring_change
+        self.on_start = on_start
+        self.enabled = bool(settings.REDIS_URL)
+        self.worker_id = 'local'
+        self.ring = HashRing([self.worker_id])
+        self.started = None
+
+    async def start(self):
+        """Join the ring; called by the first connection a worker accepts"""
+        if not self.enabled:
+            return
+        if self.started is None:
+            self.started = asyncio.ensure_future(self._start())
+        await asyncio.shield(self.started)
+
+    def start_once(self):
+        """start() for sync code such as views; once the worker has joined,
+        this returns without a trip to the event loop"""
+        if self.enabled and not (self.started and self.started.done()):
+            async_to_sync(self.start)()
+
+    async def _start(self):
+        import redis.asyncio as redis
+
+        self.channel_layer = get_channel_layer()
+        # A plain channel rather than new_channel(): channels_redis polls
+        # process-local channels through the consumers' shared receive
+        self.worker_id = f"realm-worker.{uuid.uuid4().hex}"
+        self.redis = redis.from_url(settings.REDIS_URL)
+        atexit.register(self._leave)
+        await self.heartbeat()
+        asyncio.ensure_future(self.heartbeat_loop())
+        asyncio.ensure_future(self.receive_loop())
+        if self.on_start:
+            await self.on_start(self)
+        logger.info('Realm worker %s joined with %d workers live', self.worker_id, len(self.ring.workers))
+
+    def get_owner(self, realm_id):
+        return self.ring.get_worker(realm_id) or self.worker_id
+
+    def is_local(self, realm_id):
+        return self.get_owner(realm_id) == self.worker_id
+
+    def is_live(self, worker_id):
+        return worker_id in self.ring.workers
+
+    async def heartbeat(self):
+        seconds, micros = await self.redis.time()
+        now = seconds + micros / 1e6
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(WORKERS_KEY, {self.worker_id: now})
+            pipe.zremrangebyscore(WORKERS_KEY, '-inf', now - settings.CLUSTER_WORKER_TTL)
+            pipe.zrange(WORKERS_KEY, 0, -1)
+            *_, members = await pipe.execute()
+
+        workers = {member.decode() for member in members}
+        if workers != self.ring.workers:
+            logger.info('Realm workers changed: %d live', len(workers))
+            self.ring = HashRing(workers)
+            await self.on_ring_change()
+
+    async def heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(settings.CLUSTER_HEARTBEAT_SECONDS)
+            try:
+                await self.heartbeat()
+            except Exception:
+                logger.exception('Realm worker heartbeat failed')
+
+    async def receive_loop(self):
+        while True:
+            try:
+                message = await self.channel_layer.receive(self.worker_id)
+            except Exception:
+                logger.exception('Realm worker receive failed')
+                await asyncio.sleep(1)
+                continue
+            asyncio.ensure_future(self.on_message(message))
+
+    async def forward(self, owner, message):
+        await self.channel_layer.send(owner, message)
+
+    def _leave(self):
+        # Hand our realms over right away rather than after CLUSTER_WORKER_TTL
+        import redis
+
+        try:
+            redis.from_url(settings.REDIS_URL).zrem(WORKERS_KEY, self.worker_id)
+        except redis.RedisError:
+            pass
@@ -1,48 +1,126 @@
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
+import asyncio
+import base64
+import copy
+import functools
+import hashlib
+import itertools
 import json
+import secrets
+import threading
+import time
 import uuid
-from asgiref.sync import sync_to_async
+import weakref
+import zlib
+from array import array
+from collections import Counter, deque
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+from channels.exceptions import ChannelFull
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db.models import Subquery
+from .cluster import RealmRouter
+from .heatmaps import HeatmapRecorder, room_heat
+from .map_cache import map_artifact_cache
+from .maps import parse_tile_key
 from .models import Realm, Profile
+from .presence import presence_index, realm_group, visible_realm_ids
+from .recorder import session_recorder
+from .skins import get_catalog
+from .snapshots import SessionSnapshots
 
 
-class SessionManager:
-    """Manages all active game sessions"""
+class SessionShard:
+    """The realm sessions whose ids hash to one shard, behind its own lock"""
     def __init__(self):
+        self.lock = threading.Lock()
         self.sessions = {}
+
+
+class SessionManager:
+    """Manages all active game sessions"""
+    def __init__(self, shard_count=16, presence=None):
+        self.shards = [SessionShard() for _ in range(shard_count)]
+        self.presence = presence
         self.player_id_to_realm_id = {}
         self.channel_name_to_player_id = {}
+        self.resume_tokens = {}
+        self.player_id_to_resume_token = {}
+        self.suspended_players = {}
     
-    def create_session(self, realm_id, map_data):
-        if realm_id not in self.sessions:
-            self.sessions[realm_id] = Session(realm_id, map_data)
+    def get_shard(self, realm_id):
+        return self.shards[zlib.crc32(str(realm_id).encode()) % len(self.shards)]
+    
+    def create_session(self, realm_id, map_artifacts):
+        shard = self.get_shard(realm_id)
+        with shard.lock:
+            if realm_id not in shard.sessions:
+                shard.sessions[realm_id] = Session(realm_id, map_artifacts)
+            return shard.sessions[realm_id]
     
     def get_session(self, realm_id):
-        return self.sessions.get(realm_id)
+        return self.get_shard(realm_id).sessions.get(realm_id)
+    
+    def iter_sessions(self):
+        """All live sessions; safe to call from threads other than the event loop"""
+        for shard in self.shards:
+            with shard.lock:
+                sessions = list(shard.sessions.values())
+            yield from sessions
+    
+    def remove_session(self, realm_id):
+        """Drop a session along with everyone still in it"""
+        session = self.get_session(realm_id)
+        if not session:
+            return
+        for user_id in list(session.players):
+            if self.player_id_to_realm_id.get(user_id) == realm_id:
+                self.logout_player(user_id)
+        shard = self.get_shard(realm_id)
+        with shard.lock:
+            shard.sessions.pop(realm_id, None)
+        # Their clients are told to spectate wherever the realm went
+        session.spectators.clear()
+        self.presence_changed(realm_id, {})
     
     def get_player_session(self, user_id):
         realm_id = self.player_id_to_realm_id.get(user_id)
         if realm_id:
-            return self.sessions.get(realm_id)
+            return self.get_session(realm_id)
         return None
     
     def add_player_to_session(self, channel_name, realm_id, user_id, username, skin):
-        self.sessions[realm_id].add_player(channel_name, user_id, username, skin)
+        """Add a player and return the token that lets them resume after a drop"""
+        session = self.get_session(realm_id)
+        old_player = session.get_player(user_id)
+        if old_player:
+            self.channel_name_to_player_id.pop(old_player['channel_name'], None)
+        self._clear_suspension(user_id)
+        
+        session.add_player(channel_name, user_id, username, skin)
         self.player_id_to_realm_id[user_id] = realm_id
         self.channel_name_to_player_id[channel_name] = user_id
+        self.presence_changed(realm_id, session.players)
+        return self._issue_resume_token(user_id)
     
     def logout_player(self, user_id):
         realm_id = self.player_id_to_realm_id.get(user_id)
         if not realm_id:
             return False
         
-        session = self.sessions.get(realm_id)
+        session = self.get_session(realm_id)
         if session:
             player = session.get_player(user_id)
             if player:
-                del self.channel_name_to_player_id[player['channel_name']]
+                self.channel_name_to_player_id.pop(player['channel_name'], None)
                 session.remove_player(user_id)
+                self.presence_changed(realm_id, session.players)
         
+        self._clear_suspension(user_id)
+        self.resume_tokens.pop(self.player_id_to_resume_token.pop(user_id, None), None)
         del self.player_id_to_realm_id[user_id]
         return True
     
@@ -51,27 +129,232 @@ class SessionManager:
         if user_id:
             return self.logout_player(user_id)
         return False
+    
+    def suspend_player(self, channel_name, grace_seconds, on_expire):
+        """Reserve a disconnected player's state for a grace period.
+        
+        The player stays in the session (keeping their slot, position and
+        proximity group) but receives nothing until they resume. If they
+        have not resumed in time, ``on_expire(user_id, token)`` is awaited.
+        """
+        user_id = self.channel_name_to_player_id.pop(channel_name, None)
+        session = self.get_player_session(user_id)
+        player = session.get_player(user_id) if session else None
+        if not player or player['channel_name'] != channel_name:
+            return False
+        
+        player['channel_name'] = None
+        self._suspend(
+            user_id,
+            self.player_id_to_resume_token[user_id],
+            session.get_room_state(player['room']),
+            grace_seconds,
+            on_expire
+        )
+        return True
+    
+    def resume_player(self, token, user_id, channel_name):
+        """Reattach a suspended player to a new connection.
+        
+        Returns ``(session, player, changed, left, new_token)`` where
+        ``changed``/``left`` describe the player's room since they dropped,
+        or None if the token is unknown, expired or belongs to someone else.
+        """
+        if not token or self.resume_tokens.get(token) != user_id:
+            return None
+        suspension = self.suspended_players.get(user_id)
+        if not suspension or suspension['token'] != token:
+            return None
+        
+        self._clear_suspension(user_id)
+        session = self.get_player_session(user_id)
+        player = session.get_player(user_id)
+        player['channel_name'] = channel_name
+        self.channel_name_to_player_id[channel_name] = user_id
+        
+        changed, left = session.get_room_changes(player['room'], suspension['room_state'], user_id)
+        return session, player, changed, left, self._issue_resume_token(user_id)
+    
+    def expire_player(self, user_id, token):
+        """Log out a suspended player whose grace period ran out"""
+        suspension = self.suspended_players.get(user_id)
+        if not suspension or suspension['token'] != token:
+            return False
+        return self.logout_player(user_id)
+    
+    def snapshot_session(self, session):
+        """Plain-data copy of a session and its players' resume state"""
+        players = []
+        for p in session.players.values():
+            suspension = self.suspended_players.get(p['uid'])
+            room_state = None
+            if suspension:
+                room_state = [[uid, *state] for uid, state in suspension['room_state'].items()]
+            players.append([
+                p['uid'], p['username'], p['x'], p['y'], p['room'], p['skin'],
+                p['proximity_id'], self.player_id_to_resume_token.get(p['uid']), room_state
+            ])
+        return {
+            'realm': session.realm_id,
+            'map_version': session.map_artifacts.get('map_version'),
+            'seq': [session.room_seq[i] for i in range(len(session.room_seq))],
+            'players': players
+        }
+    
+    def restore_session(self, state, map_artifacts, grace_seconds, on_expire):
+        """Rebuild a session from ``snapshot_session`` with every player suspended.
+        
+        Snapshots name their map by version only; ``map_artifacts`` are the
+        ones for that version, read from the database again. Players keep their resume tokens, so their clients can ``resumeRealm``
+        straight into the restored state within the grace period.
+        """
+        realm_id = state['realm']
+        shard = self.get_shard(realm_id)
+        with shard.lock:
+            if realm_id in shard.sessions:
+                return shard.sessions[realm_id]
+            session = shard.sessions[realm_id] = Session(realm_id, map_artifacts)
+        
+        for room_index, seq in enumerate(state['seq']):
+            session.room_seq[room_index] = seq
+        
+        restored = []
+        for uid, username, x, y, room, skin, proximity_id, token, room_state in state['players']:
+            if uid in self.player_id_to_realm_id or not token:
+                # Already playing again elsewhere on this worker
+                continue
+            session.restore_player({
+                'uid': uid,
+                'username': username,
+                'x': x,
+                'y': y,
+                'room': room,
+                'channel_name': None,
+                'skin': skin,
+                'proximity_id': proximity_id
+            })
+            self.player_id_to_realm_id[uid] = realm_id
+            self.resume_tokens[token] = uid
+            self.player_id_to_resume_token[uid] = token
+            restored.append((uid, token, room_state))
+        
+        # Players connected at snapshot time had seen their room as it was then
+        for uid, token, room_state in restored:
+            if room_state is None:
+                room_state = session.get_room_state(session.players[uid]['room'])
+            else:
+                room_state = {row[0]: tuple(row[1:]) for row in room_state}
+            self._suspend(uid, token, room_state, grace_seconds, on_expire)
+        self.presence_changed(realm_id, session.players)
+        return session
+    
+    def presence_changed(self, realm_id, players):
+        if self.presence is not None:
+            self.presence.update(realm_id, list(players.values()))
+    
+    def _suspend(self, user_id, token, room_state, grace_seconds, on_expire):
+        self.suspended_players[user_id] = {
+            'token': token,
+            'room_state': room_state,
+            'expiry': asyncio.get_running_loop().call_later(
+                grace_seconds,
+                lambda: asyncio.ensure_future(on_expire(user_id, token))
+            ),
+        }
+    
+    def _issue_resume_token(self, user_id):
+        self.resume_tokens.pop(self.player_id_to_resume_token.get(user_id), None)
+        token = secrets.token_urlsafe(24)
+        self.resume_tokens[token] = user_id
+        self.player_id_to_resume_token[user_id] = token
+        return token
+    
+    def _clear_suspension(self, user_id):
+        suspension = self.suspended_players.pop(user_id, None)
+        if suspension:
+            suspension['expiry'].cancel()
+
+
+class SessionStats:
+    """Running totals a session keeps for the live-ops admin page.
+    
+    Handlers bump plain integers as they go; rates are only worked out when
+    someone asks, against a sample kept at most LIVEOPS_RATE_SECONDS old.
+    """
+    __slots__ = ('started', 'events', 'sent', 'samples')
+    
+    def __init__(self):
+        self.started = time.monotonic()
+        # Inbound game events, and messages sent for them to players
+        self.events = 0
+        self.sent = 0
+        self.samples = deque([(self.started, 0, 0)], maxlen=2)
+    
+    def rates(self):
+        """``(events, sent)`` per second since the older of the last two samples"""
+        now = time.monotonic()
+        if now - self.samples[-1][0] >= settings.LIVEOPS_RATE_SECONDS:
+            self.samples.append((now, self.events, self.sent))
+        since, events, sent = self.samples[0]
+        elapsed = max(now - since, 1.0)
+        return (self.events - events) / elapsed, (self.sent - sent) / elapsed
 
 
 class Session:
     """Represents a single game realm session"""
-    def __init__(self, realm_id, map_data):
+    def __init__(self, realm_id, map_artifacts):
         self.realm_id = realm_id
-        self.map_data = map_data
+        # Compiled from the map on save (core.maps); sessions never see tilemaps
+        self.map_artifacts = map_artifacts
+        # Held across a mutation and its fan-out so a realm's events are
+        # applied and delivered one at a time, in sequence order
+        self.lock = asyncio.Lock()
         self.players = {}
         self.player_rooms = {}
         self.player_positions = {}
+        self.room_seq = {}
+        self.room_events = {}
         
         # Initialize room tracking
-        for i in range(len(map_data['rooms'])):
+        for i in range(len(map_artifacts['rooms'])):
             self.player_rooms[i] = set()
             self.player_positions[i] = {}
+            self.room_seq[i] = 0
+            self.room_events[i] = deque(maxlen=settings.ROOM_EVENT_LOG_SIZE)
+        # Moves not yet broadcast, per room: {uid: [steps, last input]};
+        # see run_session_ticks
+        self.pending_moves = {}
+        self.tick_task = None
+        # Proximity groups as last sent to each player, and when players'
+        # groups last changed without being sent yet; see settle_proximity
+        self.announced_proximity = {}
+        self.proximity_changes = {}
+        # Members of each announced group, so counting groups is len()
+        self.proximity_members = Counter()
+        # Per room, the private area of every tile in one flat array
+        self.zone_grids = [build_zone_grid(room) for room in map_artifacts['rooms']]
+        # Per room, the walkable-tile bitmap; see is_walkable
+        self.walkable = [build_walkable_grid(room) for room in map_artifacts['rooms']]
+        # Per room, tile counters for the heatmaps; see HeatmapRecorder
+        self.heat = [room_heat(room) for room in map_artifacts['rooms']]
+        # Spectating connections by channel name, with the room they watch,
+        # and each watched room as spectators last saw it; see
+        # run_spectator_updates
+        self.spectators = {}
+        self.spectator_views = {}
+        self.spectator_task = None
+        # Chat groups each connected player's channel was added to, as
+        # {uid: (channel name, groups)}, and how many are in each group;
+        # see sync_chat_groups
+        self.chat_members = {}
+        self.chat_group_sizes = Counter()
+        self.stats = SessionStats()
     
     def add_player(self, channel_name, user_id, username, skin):
         # Remove existing player if reconnecting
         self.remove_player(user_id)
         
-        spawn = self.map_data['spawnpoint']
+        spawn = self.map_artifacts['spawnpoint']
         spawn_room = spawn['roomIndex']
         spawn_x = spawn['x']
         spawn_y = spawn['y']
@@ -95,6 +378,16 @@ class Session:
             self.player_positions[spawn_room][coord_key] = set()
         self.player_positions[spawn_room][coord_key].add(user_id)
     
+    def restore_player(self, player):
+        """Put a player back exactly where a snapshot had them"""
+        self.players[player['uid']] = player
+        self.player_rooms[player['room']].add(player['uid'])
+        
+        coord_key = f"{player['x']}, {player['y']}"
+        if coord_key not in self.player_positions[player['room']]:
+            self.player_positions[player['room']][coord_key] = set()
+        self.player_positions[player['room']][coord_key].add(player['uid'])
+    
     def remove_player(self, user_id):
         if user_id not in self.players:
             return
@@ -107,6 +400,8 @@ class Session:
             self.player_positions[player['room']][coord_key].discard(user_id)
         
         del self.players[user_id]
+        self.announce_proximity(user_id, None)
+        self.proximity_changes.pop(user_id, None)
     
     def get_player(self, user_id):
         return self.players.get(user_id)
@@ -117,6 +412,214 @@ class Session:
     def get_player_count(self):
         return len(self.players)
     
+    def record_event(self, room_index, event):
+        """Stamp a room event with the room's next sequence number and log it"""
+        self.room_seq[room_index] += 1
+        event = dict(event, seq=self.room_seq[room_index])
+        self.room_events[room_index].append(copy.deepcopy(event))
+        return event
+    
+    def get_events_since(self, room_index, seq):
+        """Logged events after ``seq``, or None if the log no longer goes back that far"""
+        events = self.room_events[room_index]
+        if not isinstance(seq, int) or seq < 0 or seq > self.room_seq[room_index]:
+            return None
+        if seq == self.room_seq[room_index]:
+            return []
+        if not events or events[0]['seq'] > seq + 1:
+            return None
+        return list(itertools.islice(events, seq + 1 - events[0]['seq'], None))
+    
+    def queue_move(self, room_index, user_id, x, y, client_input):
+        """Remember a move for the room's next playersMoved batch"""
+        entry = self.pending_moves.setdefault(room_index, {}).setdefault(user_id, [[], None])
+        if entry[0][-1:] != [[x, y]]:
+            entry[0].append([x, y])
+        del entry[0][:-MAX_BATCHED_STEPS]
+        entry[1] = client_input
+    
+    def take_moves(self, room_index):
+        """The room's queued moves as one players_moved event, or None.
+        
+        Each row is ``[uid, steps, input]``: the tiles walked since the last
+        batch (the last one being where the player is now) and the newest
+        client input number the server applied, for the mover's own
+        reconciliation. ``t`` is the server time in milliseconds.
+        """
+        moves = self.pending_moves.pop(room_index, None)
+        rows = [
+            [uid, steps, client_input] for uid, (steps, client_input) in (moves or {}).items()
+            if uid in self.player_rooms[room_index]
+        ]
+        if not rows:
+            return None
+        return {
+            'type': 'players_moved',
+            't': int(time.time() * 1000),
+            'moves': rows
+        }
+    
+    def is_walkable(self, room_index, x, y):
+        """Whether a player may stand on a tile: one that exists and is not
+        impassable. Rooms without any tiles are open everywhere."""
+        walkable = self.walkable[room_index]
+        if walkable is None:
+            return True
+        min_x, min_y, width, height, bitmap = walkable
+        dx, dy = x - min_x, y - min_y
+        if not (0 <= dx < width and 0 <= dy < height):
+            return False
+        bit = dy * width + dx
+        return bool(bitmap[bit >> 3] & (1 << (bit & 7)))
+    
+    def can_teleport(self, player, room_index, x, y):
+        """Whether a player may teleport to a tile: the destination of the
+        teleporter they stand on, or the spawnpoint, and walkable either way"""
+        if type(room_index) is not int or type(x) is not int or type(y) is not int:
+            return False
+        if not 0 <= room_index < len(self.walkable):
+            return False
+        target = [room_index, x, y]
+        spawn = self.map_artifacts['spawnpoint']
+        teleporters = self.map_artifacts['rooms'][player['room']]['teleporters']
+        if (target != teleporters.get(f"{player['x']}, {player['y']}")
+                and target != [spawn['roomIndex'], spawn['x'], spawn['y']]):
+            return False
+        return self.is_walkable(room_index, x, y)
+    
+    def zone_at(self, room_index, x, y):
+        """The private area id at a tile, or None"""
+        zones = self.zone_grids[room_index]
+        if zones is None:
+            return None
+        min_x, min_y, width, height, grid, names = zones
+        dx, dy = x - min_x, y - min_y
+        if 0 <= dx < width and 0 <= dy < height and grid[dy * width + dx]:
+            return names[grid[dy * width + dx] - 1]
+        return None
+    
+    def note_proximity_changes(self, user_ids):
+        """Start (or restart) the dwell time of these players' new groups"""
+        now = asyncio.get_running_loop().time()
+        for uid in user_ids:
+            self.proximity_changes[uid] = now
+    
+    def settle_proximity(self):
+        """Players whose group has held for PROXIMITY_DWELL_SECONDS and differs
+        from what they were last told; they are marked as told.
+        
+        A player stepping back and forth over a group's edge therefore causes
+        no update at all, and each player gets at most one per tick.
+        """
+        now = asyncio.get_running_loop().time()
+        settled = []
+        for uid, since in list(self.proximity_changes.items()):
+            if now - since < settings.PROXIMITY_DWELL_SECONDS:
+                continue
+            del self.proximity_changes[uid]
+            player = self.players.get(uid)
+            if player and player['proximity_id'] != self.announced_proximity.get(uid):
+                self.announce_proximity(uid, player['proximity_id'])
+                settled.append(player)
+        return settled
+    
+    def announce_proximity(self, uid, proximity_id):
+        """Record the group a player has been told they are in"""
+        previous = self.announced_proximity.pop(uid, None)
+        if previous is not None:
+            self.proximity_members[previous] -= 1
+            if not self.proximity_members[previous]:
+                del self.proximity_members[previous]
+        if proximity_id is not None:
+            self.announced_proximity[uid] = proximity_id
+            self.proximity_members[proximity_id] += 1
+    
+    def chat_groups(self, user_id):
+        """The chat groups a player belongs in; none while disconnected"""
+        player = self.players.get(user_id)
+        if not player or not player['channel_name']:
+            return frozenset()
+        groups = {chat_group(self.realm_id, 'realm'), chat_group(self.realm_id, 'room', player['room'])}
+        # The group the client has been told about, so chat and video agree
+        proximity_id = self.announced_proximity.get(user_id)
+        if proximity_id is not None:
+            groups.add(chat_group(self.realm_id, 'proximity', proximity_id))
+        return frozenset(groups)
+    
+    def live_stats(self):
+        """Load figures for the live-ops admin page, from counters only"""
+        events_rate, sent_rate = self.stats.rates()
+        return {
+            'realm_id': self.realm_id,
+            'players': len(self.players),
+            'rooms': [[room, len(uids)] for room, uids in self.player_rooms.items() if uids],
+            'spectators': len(self.spectators),
+            'proximity_groups': len(self.proximity_members),
+            'events': self.stats.events,
+            'sent': self.stats.sent,
+            'events_per_second': events_rate,
+            'sent_per_second': sent_rate,
+            'uptime': time.monotonic() - self.stats.started
+        }
+    
+    def get_room_snapshot(self, room_index):
+        """Compact view of a room: one [uid, username, x, y, skin] row per player"""
+        return {
+            'room': room_index,
+            'seq': self.room_seq[room_index],
+            'players': [
+                [p['uid'], p['username'], p['x'], p['y'], p['skin']]
+                for p in self.get_players_in_room(room_index)
+            ]
+        }
+    
+    def spectator_view(self, room_index):
+        """Snapshot rows of a room as spectators currently see it"""
+        if room_index not in self.spectator_views:
+            self.spectator_views[room_index] = {
+                row[0]: row for row in self.get_room_snapshot(room_index)['players']
+            }
+        return list(self.spectator_views[room_index].values())
+    
+    def spectator_update(self, room_index):
+        """What changed in a room since spectators last saw it, or None.
+        
+        ``moved`` rows are [uid, x, y]; ``updated`` holds full snapshot rows
+        of new players and of players whose name or skin changed; ``left``
+        lists uids. Spectators then see the room as it is now.
+        """
+        view = self.spectator_views.get(room_index, {})
+        current = {row[0]: row for row in self.get_room_snapshot(room_index)['players']}
+        moved, updated = [], []
+        for uid, row in current.items():
+            seen = view.get(uid)
+            if seen is None or seen[1] != row[1] or seen[4] != row[4]:
+                updated.append(row)
+            elif seen[2:4] != row[2:4]:
+                moved.append([uid, row[2], row[3]])
+        left = [uid for uid in view if uid not in current]
+        self.spectator_views[room_index] = current
+        if not (moved or updated or left):
+            return None
+        return {'room': room_index, 'moved': moved, 'updated': updated, 'left': left}
+    
+    def get_room_state(self, room_index):
+        """Snapshot of what a player in the room can see of the others"""
+        return {
+            p['uid']: (p['x'], p['y'], p['skin'])
+            for p in self.get_players_in_room(room_index)
+        }
+    
+    def get_room_changes(self, room_index, since_state, user_id):
+        """Players that appeared or changed, and uids that left, since a snapshot"""
+        current_state = self.get_room_state(room_index)
+        changed = [
+            self.players[uid] for uid, state in current_state.items()
+            if uid != user_id and since_state.get(uid) != state
+        ]
+        left = [uid for uid in since_state if uid not in current_state]
+        return changed, left
+    
     def move_player(self, user_id, x, y):
         if user_id not in self.players:
             return []
@@ -138,6 +641,8 @@ class Session:
         if new_coord not in self.player_positions[room]:
             self.player_positions[room][new_coord] = set()
         self.player_positions[room][new_coord].add(user_id)
+        if self.heat[room]:
+            self.heat[room].visit(x, y)
         
         # Update proximity
         return self.set_proximity_ids_with_player(user_id)
@@ -163,43 +668,71 @@ class Session:
         return self.move_player(user_id, x, y)
     
     def set_proximity_ids_with_player(self, user_id):
-        """Calculate proximity IDs for video chat"""
+        """Calculate proximity IDs for video chat.
+        
+        Everyone inside a private area is one group, however far apart.
+        Elsewhere groups are joined within PROXIMITY_RANGE tiles but only
+        left beyond PROXIMITY_LEAVE_RANGE, so walking along a group's edge
+        does not flip a player in and out of it; players inside private
+        areas do not count there.
+        """
         player = self.players[user_id]
-        proximity_tiles = self._get_proximity_tiles(player['x'], player['y'])
-        changed_players = set()
         original_proximity_id = player['proximity_id']
-        other_players_exist = False
         
-        for tile in proximity_tiles:
-            players_in_tile = self.player_positions[player['room']].get(tile, set())
-            
-            for other_uid in players_in_tile:
-                if other_uid == user_id:
-                    continue
-                
-                other_players_exist = True
-                other_player = self.players[other_uid]
-                
-                if other_player['proximity_id'] is None:
-                    if player['proximity_id'] is None:
-                        player['proximity_id'] = str(uuid.uuid4())
-                        if player['proximity_id'] != original_proximity_id:
-                            changed_players.add(user_id)
-                    
-                    other_player['proximity_id'] = player['proximity_id']
-                    changed_players.add(other_uid)
-                elif player['proximity_id'] != other_player['proximity_id']:
-                    player['proximity_id'] = other_player['proximity_id']
-                    if player['proximity_id'] != original_proximity_id:
-                        changed_players.add(user_id)
-        
-        if not other_players_exist:
+        zone = self.zone_at(player['room'], player['x'], player['y'])
+        if zone is not None:
+            player['proximity_id'] = f"{ZONE_GROUP_PREFIX}{player['room']}-{zone}"
+            return [user_id] if player['proximity_id'] != original_proximity_id else []
+        
+        current = original_proximity_id
+        if current is not None and current.startswith(ZONE_GROUP_PREFIX):
+            # Just walked out of a private area
+            current = None
+        nearby = self._players_near(player, settings.PROXIMITY_RANGE)
+        
+        if not nearby:
+            if current is not None and any(
+                self.players[uid]['proximity_id'] == current
+                for uid in self._players_near(player, settings.PROXIMITY_LEAVE_RANGE)
+            ):
+                return []
             player['proximity_id'] = None
-            if original_proximity_id is not None:
-                changed_players.add(user_id)
+            return [user_id] if original_proximity_id is not None else []
+        
+        # Stay in our group if anyone close is in it, else join theirs
+        groups = {self.players[uid]['proximity_id'] for uid in nearby} - {None}
+        if current in groups:
+            proximity_id = current
+        elif groups:
+            proximity_id = min(groups)
+        else:
+            proximity_id = str(uuid.uuid4())
+        
+        changed_players = set()
+        player['proximity_id'] = proximity_id
+        if proximity_id != original_proximity_id:
+            changed_players.add(user_id)
+        for uid in nearby:
+            other_player = self.players[uid]
+            if other_player['proximity_id'] is None:
+                other_player['proximity_id'] = proximity_id
+                changed_players.add(uid)
         
         return list(changed_players)
     
+    def _players_near(self, player, range_val):
+        """Other players within ``range_val`` tiles (a square) of ``player``,
+        leaving out those in private areas"""
+        room = player['room']
+        positions = self.player_positions[room]
+        return [
+            uid
+            for tile in self._get_proximity_tiles(player['x'], player['y'], range_val)
+            for uid in positions.get(tile, ())
+            if uid != player['uid']
+            and self.zone_at(room, self.players[uid]['x'], self.players[uid]['y']) is None
+        ]
+    
     def _get_proximity_tiles(self, x, y, range_val=3):
         """Get tiles within proximity range"""
         tiles = []
@@ -209,55 +742,310 @@ class Session:
         return tiles
 
 
+# Events that enter a realm, and so pick the worker and realm they go to
+PLAYER_ENTRY_EVENTS = {'joinRealm', 'resumeRealm', 'spectateRealm'}
+
+# Messages that hand the client a complete room state as of their seq
+ROOM_BASE_TYPES = {'joinedRealm', 'resumedRealm', 'roomSnapshot'}
+
+# Position updates where only the newest per player matters to a lagging
+# client. Moves are superseded too, by merging buffered playersMoved batches
+# per player (see GameConsumer.push).
+SUPERSEDABLE_TYPES = {'playerTeleported'}
+
+# Tiles of one player's walk kept per playersMoved batch; earlier ones are
+# dropped and the client's interpolation cuts that corner
+MAX_BATCHED_STEPS = 16
+
+# Close code for clients that cannot keep up; they come back via resumeRealm
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+# Close code for clients removed by an administrator; they do not reconnect
+KICKED_CLOSE_CODE = 4003
+
+# Proximity ids of private area groups start with this; others are UUIDs
+ZONE_GROUP_PREFIX = 'zone-'
+
+
+def build_zone_grid(room):
+    """``(min_x, min_y, width, height, grid, names)`` for a compiled room with
+    private areas, else None. ``grid`` holds 1 + the index into ``names`` of
+    each tile's area, 0 for none.
+    """
+    if not room.get('zones') or not room['bounds']:
+        return None
+    min_x, min_y, width, height = room['bounds']
+    grid = array('H', bytes(2 * width * height))
+    names = list(room['zones'])
+    for index, name in enumerate(names, 1):
+        for key in room['zones'][name]:
+            x, y = parse_tile_key(key)
+            grid[(y - min_y) * width + (x - min_x)] = index
+    return min_x, min_y, width, height, grid, names
+
+
+def build_walkable_grid(room):
+    """``(min_x, min_y, width, height, bitmap)`` for a compiled room with
+    tiles, else None; ``bitmap`` as in core.maps.compile_room"""
+    if not room['bounds']:
+        return None
+    return (*room['bounds'], base64.b64decode(room['walkable']))
+
+
 # Global session manager
-session_manager = SessionManager()
+session_manager = SessionManager(settings.SESSION_SHARDS, presence_index)
 
 
-class GameConsumer(AsyncWebsocketConsumer):
-    """WebSocket consumer for game interactions"""
+# Client-facing names of sequenced room events
+ROOM_EVENT_TYPES = {
+    'player_joined_room': 'playerJoinedRoom',
+    'player_left_room': 'playerLeftRoom',
+    'players_moved': 'playersMoved',
+    'player_teleported': 'playerTeleported',
+    'player_changed_skin': 'playerChangedSkin',
+}
+
+
+def room_event_message(event):
+    """Convert a logged channel layer room event into its client message"""
+    return {**event, 'type': ROOM_EVENT_TYPES[event['type']]}
+
+
+async def send_to_room(channel_layer, session, room_index, event, exclude=None, sequenced=True):
+    """Send a channel layer event to every connected player in a room.
     
-    async def connect(self):
-        self.user = self.scope['user']
-        if not self.user.is_authenticated:
-            await self.close()
+    Sequenced events are numbered and logged per room so a client that
+    missed some can catch up with ``syncRoom``.
+    """
+    if sequenced:
+        if event['type'] != 'players_moved':
+            # Moves made before this event must not reach clients after it
+            await flush_moves(channel_layer, session, room_index)
+        event = session.record_event(room_index, event)
+    for p in session.get_players_in_room(room_index):
+        if p['uid'] != exclude and p['channel_name']:
+            try:
+                await channel_layer.send(p['channel_name'], event)
+            except ChannelFull:
+                # That consumer is hopelessly behind; it recovers via syncRoom
+                continue
+            session.stats.sent += 1
+    return event
+
+
+async def flush_moves(channel_layer, session, room_index):
+    """Send the room's queued moves, if any, as one playersMoved batch"""
+    event = session.take_moves(room_index)
+    if event:
+        await send_to_room(channel_layer, session, room_index, event)
+
+
+async def send_proximity_updates(channel_layer, session, players):
+    for player in players:
+        if player['channel_name']:
+            await channel_layer.send(player['channel_name'], {
+                'type': 'proximity_update',
+                'proximity_id': player['proximity_id']
+            })
+            session.stats.sent += 1
+
+
+async def run_session_ticks(session):
+    """Send each room's queued moves once per MOVE_BROADCAST_INTERVAL, and
+    proximity group changes once they have settled.
+    
+    Runs while players keep moving. Every client in the room, movers
+    included, gets one batch per tick rather than one message per step,
+    and interpolates between batches.
+    """
+    channel_layer = get_channel_layer()
+    interval = settings.MOVE_BROADCAST_INTERVAL if settings.MOVE_BROADCAST_INTERVAL > 0 else 0.1
+    while True:
+        await asyncio.sleep(interval)
+        async with session.lock:
+            if not session.pending_moves and not session.proximity_changes:
+                session.tick_task = None
+                return
+            for room_index in list(session.pending_moves):
+                await flush_moves(channel_layer, session, room_index)
+            settled = session.settle_proximity()
+            await send_proximity_updates(channel_layer, session, settled)
+            await sync_chat_groups(channel_layer, session, [player['uid'] for player in settled])
+
+
+def spectator_group(realm_id, room_index):
+    return f'spectate_{realm_id}_{room_index}'
+
+
+async def run_spectator_updates(session):
+    """Send spectators what changed in the rooms they watch, once per
+    SPECTATOR_UPDATE_SECONDS.
+    
+    Each watched room costs one snapshot diff and one group message per
+    update, however many spectators it has. Runs while anyone spectates.
+    """
+    channel_layer = get_channel_layer()
+    while True:
+        await asyncio.sleep(settings.SPECTATOR_UPDATE_SECONDS)
+        async with session.lock:
+            if not session.spectators:
+                session.spectator_task = None
+                session.spectator_views = {}
+                return
+            for room_index, watching in Counter(session.spectators.values()).items():
+                update = session.spectator_update(room_index)
+                if update:
+                    await channel_layer.group_send(spectator_group(session.realm_id, room_index), {
+                        'type': 'spectator_update',
+                        't': int(time.time() * 1000),
+                        **update
+                    })
+                    session.stats.sent += watching
+
+
+# Who a sendMessage reaches; direct messages go to one player
+CHAT_SCOPES = ('room', 'realm', 'proximity', 'direct')
+
+
+def chat_group(realm_id, scope, key=None):
+    """Channel layer group of a chat scope. Proximity ids can hold private
+    area names from the map, so they are hashed into a valid group name."""
+    if scope == 'realm':
+        return f'chat_{realm_id}'
+    if scope == 'room':
+        return f'chat_{realm_id}_room_{key}'
+    return f'chat_{realm_id}_near_{hashlib.sha1(key.encode()).hexdigest()[:20]}'
+
+
+async def sync_chat_groups(channel_layer, session, user_ids):
+    """Bring these players' chat group memberships in line with where they are.
+    
+    Called as players join, leave, drop, resume, change rooms or settle
+    into a proximity group. Only the groups a player entered or left are
+    touched, so sending to a group never has to look at its members.
+    """
+    for user_id in user_ids:
+        groups = session.chat_groups(user_id)
+        channel_name = session.players[user_id]['channel_name'] if groups else None
+        old_channel, old_groups = session.chat_members.pop(user_id, (None, frozenset()))
+        if groups:
+            session.chat_members[user_id] = (channel_name, groups)
+        if channel_name != old_channel:
+            left, joined = old_groups, groups
+        else:
+            left, joined = old_groups - groups, groups - old_groups
+        for group in left:
+            session.chat_group_sizes[group] -= 1
+            if not session.chat_group_sizes[group]:
+                del session.chat_group_sizes[group]
+            await channel_layer.group_discard(group, old_channel)
+        for group in joined:
+            session.chat_group_sizes[group] += 1
+            await channel_layer.group_add(group, channel_name)
+
+
+def chat_frame(realm_id, message):
+    """A chat_message event carrying the client's receiveMessage already
+    encoded, so fanning it out costs no work per recipient"""
+    return {
+        'type': 'chat_message',
+        'realm': realm_id,
+        'frame': json.dumps({'type': 'receiveMessage', **message})
+    }
+
+
+def realm_serialized(handler):
+    """Run a consumer handler under the lock of the realm the player is in"""
+    @functools.wraps(handler)
+    async def wrapper(self, *args, **kwargs):
+        while True:
+            session = session_manager.get_player_session(self.user_id)
+            if not session:
+                return await handler(self, *args, **kwargs)
+            async with session.lock:
+                # The player may have switched realms while we waited
+                if session_manager.get_player_session(self.user_id) is session:
+                    return await handler(self, *args, **kwargs)
+    return wrapper
+
+
+async def expire_suspended_player(user_id, token):
+    """Tell the room a suspended player is gone once their grace period ends"""
+    session = session_manager.get_player_session(user_id)
+    if not session:
+        return
+    async with session.lock:
+        player = session.get_player(user_id)
+        if not player or not session_manager.expire_player(user_id, token):
             return
-        
-        self.user_id = str(self.user.id)
-        await self.accept()
+        await send_to_room(get_channel_layer(), session, player['room'], {
+            'type': 'player_left_room',
+            'uid': user_id
+        })
+
+
+def collect_snapshots():
+    """Every session this worker holds, None for those nobody is in"""
+    return {
+        session.realm_id: session_manager.snapshot_session(session) if session.players else None
+        for session in session_manager.iter_sessions()
+    }
+
+
+# Sessions saved across restarts and deploys
+session_snapshots = SessionSnapshots(collect_snapshots)
+
+# Where players go, for the owners' heatmaps
+heatmap_recorder = HeatmapRecorder(session_manager.iter_sessions)
+
+
+async def restore_realm(realm_id, map_artifacts=None, accept=None):
+    """Bring back a realm an earlier process saved, if it is not live here.
     
-    async def disconnect(self, close_code):
-        if hasattr(self, 'realm_group_name'):
-            await self.channel_layer.group_discard(
-                self.realm_group_name,
-                self.channel_name
-            )
-        
-        # Logout player
-        session = session_manager.get_player_session(self.user_id)
-        if session:
-            # Notify others in room
-            player = session.get_player(self.user_id)
-            if player:
-                room_players = session.get_players_in_room(player['room'])
-                for p in room_players:
-                    if p['uid'] != self.user_id:
-                        await self.channel_layer.send(
-                            p['channel_name'],
-                            {
-                                'type': 'player_left_room',
-                                'uid': self.user_id
-                            }
-                        )
-        
-        session_manager.logout_by_channel_name(self.channel_name)
+    ``map_artifacts`` are the realm's current ones, read here if not given;
+    a snapshot taken on another version of the map is dropped. ``accept``
+    may turn a snapshot down, which leaves it saved for whoever it is for.
+    """
+    if session_manager.get_session(realm_id):
+        return
+    state = await session_snapshots.load(realm_id, accept)
+    if not state:
+        return
+    if map_artifacts is None:
+        map_blob_id = await Realm.objects.filter(id=realm_id).values_list('map_blob_id', flat=True).afirst()
+        map_artifacts = await map_artifact_cache.get(map_blob_id) if map_blob_id else None
+    if not map_artifacts or map_artifacts.get('map_version') != state['map_version']:
+        # The map was edited, or the realm deleted, since the snapshot
+        return
+    session_manager.restore_session(state, map_artifacts, settings.RESUME_GRACE_SECONDS, expire_suspended_player)
+
+
+class PlayerHandlers:
+    """Game logic for one player, run by the worker that owns their realm.
     
-    async def receive(self, text_data):
+    GameConsumer uses it directly when its realm is owned locally; for
+    connections held by other workers the owner runs it as a RemotePlayer.
+    Everything meant for the client goes through ``push``.
+    """
+    
+    async def handle_event(self, data):
         try:
-            data = json.loads(text_data)
             event_type = data.get('type')
+            if session_recorder.enabled:
+                self.record_event(data)
+            
+            if getattr(self, 'spectating', None) and event_type not in PLAYER_ENTRY_EVENTS:
+                # Spectators only watch
+                return
             
             if event_type == 'joinRealm':
                 await self.join_realm(data)
+            elif event_type == 'spectateRealm':
+                await self.spectate_realm(data)
+            elif event_type == 'resumeRealm':
+                await self.resume_realm(data)
+            elif event_type == 'syncRoom':
+                await self.sync_room(data)
             elif event_type == 'movePlayer':
                 await self.move_player(data)
             elif event_type == 'teleport':
@@ -266,97 +1054,293 @@ class GameConsumer(AsyncWebsocketConsumer):
                 await self.changed_skin(data)
             elif event_type == 'sendMessage':
                 await self.send_message(data)
+            
+            session = session_manager.get_player_session(self.user_id)
+            if session:
+                session.stats.events += 1
         
         except Exception as e:
-            await self.send(text_data=json.dumps({
+            await self.push({
                 'type': 'error',
                 'message': str(e)
-            }))
+            })
+    
+    def record_event(self, data):
+        """Log an inbound event for ``replay_sessions``"""
+        if data.get('type') in PLAYER_ENTRY_EVENTS:
+            realm_id = str(data.get('realmId'))
+            session = session_manager.get_session(realm_id)
+        else:
+            session = session_manager.get_player_session(self.user_id)
+            if not session:
+                return
+            realm_id = session.realm_id
+        session_recorder.record_event(realm_id, session, self, data)
+    
+    async def handle_disconnect(self, close_code):
+        await self.stop_spectating()
+        if session_recorder.enabled:
+            session = session_manager.get_player_session(self.user_id)
+            if session:
+                session_recorder.record_disconnect(session.realm_id, session, self, close_code)
+        
+        if close_code == 1000:
+            # Client left on purpose; no point holding their spot
+            await self.leave_realm()
+            return
+        
+        # Keep the player around so a flaky connection can resume quietly;
+        # the room only hears about it if the grace period runs out
+        session = session_manager.get_player_session(self.user_id)
+        if session_manager.suspend_player(
+            self.channel_name,
+            settings.RESUME_GRACE_SECONDS,
+            expire_suspended_player
+        ):
+            await sync_chat_groups(self.channel_layer, session, [self.user_id])
     
-    @sync_to_async
-    def get_realm_data(self, realm_id):
+    @realm_serialized
+    async def leave_realm(self):
+        session = session_manager.get_player_session(self.user_id)
+        player = session.get_player(self.user_id) if session else None
+        if player and player['channel_name'] == self.channel_name:
+            await send_to_room(self.channel_layer, session, player['room'], {
+                'type': 'player_left_room',
+                'uid': self.user_id
+            }, exclude=self.user_id)
+            session_manager.logout_by_channel_name(self.channel_name)
+            await sync_chat_groups(self.channel_layer, session, [self.user_id])
+    
+    async def get_realm_data(self, realm_id):
+        """Fetch the realm and the joining user's skin in a single query; the
+        map comes from the artifact cache, which holds it after the first join"""
+        skin = Profile.objects.filter(user_id=self.user.id).values('skin')[:1]
         try:
-            realm = Realm.objects.get(id=realm_id)
-            return realm.map_data, realm.owner_id, realm.only_owner
+            realm = await Realm.objects.annotate(
+                skin=Subquery(skin)
+            ).only('map_blob_id', 'owner_id', 'only_owner').aget(id=realm_id)
         except Realm.DoesNotExist:
-            return None, None, None
+            return None, None, None, None
+        map_artifacts = await map_artifact_cache.get(realm.map_blob_id)
+        if map_artifacts is None:
+            # Deleted in between
+            return None, None, None, None
+        # Profiles may hold a skin that has since left the catalog
+        return map_artifacts, realm.owner_id, realm.only_owner, get_catalog().resolve(realm.skin)
     
-    @sync_to_async
-    def get_user_skin(self):
-        try:
-            return self.user.profile.skin
-        except:
-            return '009'
+    async def load_realm(self, realm_id):
+        """Realm data as from get_realm_data, or None once the client has
+        been told why it cannot enter"""
+        realm_data = await self.get_realm_data(realm_id)
+        if realm_data[0] is None:
+            await self.push({
+                'type': 'failedToJoinRoom',
+                'reason': 'Space not found.'
+            })
+            return None
+        if not realm_data[0]:
+            # Stored before maps were validated, and does not pass
+            await self.push({
+                'type': 'failedToJoinRoom',
+                'reason': "This space's map is invalid. The owner needs to fix it in the editor."
+            })
+            return None
+        return realm_data
     
     async def join_realm(self, data):
         realm_id = str(data.get('realmId'))
+        await self.stop_spectating()
         
         # Get realm data
-        map_data, owner_id, only_owner = await self.get_realm_data(realm_id)
-        if not map_data:
-            await self.send(text_data=json.dumps({
-                'type': 'failedToJoinRoom',
-                'reason': 'Space not found.'
-            }))
+        realm_data = await self.load_realm(realm_id)
+        if realm_data is None:
             return
+        map_artifacts, owner_id, only_owner, skin = realm_data
         
-        # Check if full
-        session = session_manager.get_session(realm_id)
-        if session and session.get_player_count() >= 30:
-            await self.send(text_data=json.dumps({
-                'type': 'failedToJoinRoom',
-                'reason': "Space is full. It's 30 players max."
-            }))
+        # Create session if doesn't exist
+        await restore_realm(realm_id, map_artifacts)
+        session = session_manager.create_session(realm_id, map_artifacts)
+        
+        async with session.lock:
+            # Check if full
+            if session.get_player_count() >= 30:
+                await self.push({
+                    'type': 'failedToJoinRoom',
+                    'reason': "Space is full. It's 30 players max."
+                })
+                return
+            
+            # Add player to session
+            resume_token = session_manager.add_player_to_session(
+                self.channel_name,
+                realm_id,
+                self.user_id,
+                self.user.username,
+                skin
+            )
+            
+            player = session.get_player(self.user_id)
+            await sync_chat_groups(self.channel_layer, session, [self.user_id])
+            
+            # Send joined confirmation
+            await self.push({
+                'type': 'joinedRealm',
+                'player': player,
+                'players': session.get_players_in_room(player['room']),
+                'seq': session.room_seq[player['room']],
+                'resumeToken': resume_token,
+                'moveInterval': int(settings.MOVE_BROADCAST_INTERVAL * 1000)
+            })
+            
+            # Notify others in room
+            await self.broadcast_to_room(session, player['room'], {
+                'type': 'player_joined_room',
+                'player': player
+            })
+    
+    async def spectate_realm(self, data):
+        """Watch a realm without joining it.
+        
+        Spectators take no player slot and join no proximity group. They get
+        the room once, then what changed in it every SPECTATOR_UPDATE_SECONDS
+        through a group shared by everyone watching that room.
+        """
+        realm_id = str(data.get('realmId'))
+        realm_data = await self.load_realm(realm_id)
+        if realm_data is None:
             return
+        map_artifacts = realm_data[0]
         
-        # Create session if doesn't exist
-        if not session:
-            session_manager.create_session(realm_id, map_data)
+        # A connection either plays or watches
+        await self.leave_realm()
+        await self.stop_spectating()
         
-        # Get user skin
-        skin = await self.get_user_skin()
+        await restore_realm(realm_id, map_artifacts)
+        session = session_manager.create_session(realm_id, map_artifacts)
+        room_index = data.get('roomIndex')
+        if type(room_index) is not int or room_index not in session.player_rooms:
+            room_index = map_artifacts['spawnpoint']['roomIndex']
         
-        # Add player to session
-        session_manager.add_player_to_session(
-            self.channel_name,
-            realm_id,
+        async with session.lock:
+            session.spectators[self.channel_name] = room_index
+            self.spectating = (session, room_index)
+            await self.channel_layer.group_add(spectator_group(realm_id, room_index), self.channel_name)
+            await self.push({
+                'type': 'spectatingRealm',
+                'room': room_index,
+                'players': session.spectator_view(room_index),
+                'interval': int(settings.SPECTATOR_UPDATE_SECONDS * 1000)
+            })
+            if session.spectator_task is None:
+                session.spectator_task = asyncio.ensure_future(run_spectator_updates(session))
+    
+    async def stop_spectating(self):
+        spectating = getattr(self, 'spectating', None)
+        if not spectating:
+            return
+        session, room_index = spectating
+        self.spectating = None
+        session.spectators.pop(self.channel_name, None)
+        await self.channel_layer.group_discard(
+            spectator_group(session.realm_id, room_index),
+            self.channel_name
+        )
+    
+    async def resume_realm(self, data):
+        token = data.get('resumeToken')
+        if data.get('realmId') is not None and token:
+            # After a restart the realm may only exist in a snapshot so far;
+            # only someone holding a token saved in it may bring it back
+            await restore_realm(
+                str(data['realmId']),
+                accept=lambda state: any(p[0] == self.user_id and p[7] == token for p in state['players'])
+            )
+        # Only now is the session known, so the lock is taken here rather
+        # than by realm_serialized
+        await self.resume_in_session(data)
+    
+    @realm_serialized
+    async def resume_in_session(self, data):
+        resumed = session_manager.resume_player(
+            data.get('resumeToken'),
             self.user_id,
-            self.user.username,
-            skin
+            self.channel_name
         )
+        if not resumed:
+            # Grace period is over (or the token is bogus); client falls back to joinRealm
+            await self.push({
+                'type': 'failedToResume'
+            })
+            return
+        
+        session, player, changed_players, left_uids, resume_token = resumed
+        # resumedRealm tells the client its group
+        session.announce_proximity(self.user_id, player['proximity_id'])
+        await sync_chat_groups(self.channel_layer, session, [self.user_id])
+        
+        # Only what changed in the room while the player was away
+        await self.push({
+            'type': 'resumedRealm',
+            'player': player,
+            'changed': changed_players,
+            'left': left_uids,
+            'seq': session.room_seq[player['room']],
+            'resumeToken': resume_token,
+            'moveInterval': int(settings.MOVE_BROADCAST_INTERVAL * 1000)
+        })
+    
+    @realm_serialized
+    async def sync_room(self, data):
+        """Catch a client up from the last sequence number it applied"""
+        session = session_manager.get_player_session(self.user_id)
+        if not session:
+            return
         
-        session = session_manager.get_session(realm_id)
         player = session.get_player(self.user_id)
+        if not player:
+            return
         
-        # Join realm group
-        self.realm_group_name = f"realm_{realm_id}"
-        await self.channel_layer.group_add(
-            self.realm_group_name,
-            self.channel_name
-        )
+        events = session.get_events_since(player['room'], data.get('seq'))
+        if events is None:
+            # Too far behind for the log; a snapshot is cheaper anyway
+            await self.send_room_snapshot(session, player['room'])
+            return
         
-        # Send joined confirmation
-        await self.send(text_data=json.dumps({
-            'type': 'joinedRealm',
-            'player': player,
-            'players': session.get_players_in_room(player['room'])
-        }))
+        await self.push({
+            'type': 'roomDelta',
+            'room': player['room'],
+            'seq': session.room_seq[player['room']],
+            'events': [room_event_message(e) for e in events]
+        })
+    
+    async def send_room_snapshot(self, session, room_index):
+        await self.push({
+            'type': 'roomSnapshot',
+            **session.get_room_snapshot(room_index)
+        })
+    
+    async def broadcast_to_room(self, session, room_index, event):
+        """Fan out this player's own room event to the others.
         
-        # Notify others in room
-        room_players = session.get_players_in_room(player['room'])
-        for p in room_players:
-            if p['uid'] != self.user_id:
-                await self.channel_layer.send(
-                    p['channel_name'],
-                    {
-                        'type': 'player_joined_room',
-                        'player': player
-                    }
-                )
+        The sender is excluded from the fan-out, so its client gets a small
+        ``ack`` with the event's sequence number to keep its count gapless.
+        """
+        event = await send_to_room(self.channel_layer, session, room_index, event, exclude=self.user_id)
+        await self.push({
+            'type': 'ack',
+            'seq': event['seq']
+        })
     
+    def start_ticks(self, session):
+        if session.tick_task is None and (session.pending_moves or session.proximity_changes):
+            session.tick_task = asyncio.create_task(run_session_ticks(session))
+    
+    @realm_serialized
     async def move_player(self, data):
         x = data.get('x')
         y = data.get('y')
+        # The client numbers its moves; batches echo the newest one applied
+        client_input = data.get('input') if type(data.get('input')) is int else None
         
         session = session_manager.get_player_session(self.user_id)
         if not session:
@@ -366,35 +1350,19 @@ class GameConsumer(AsyncWebsocketConsumer):
         if not player:
             return
         
-        # Update position
-        changed_players = session.move_player(self.user_id, x, y)
+        changed_players = []
+        if type(x) is int and type(y) is int and session.is_walkable(player['room'], x, y):
+            changed_players = session.move_player(self.user_id, x, y)
+        # A rejected move still goes out, so the client snaps back to
+        # where the server has it
+        session.queue_move(player['room'], self.user_id, player['x'], player['y'], client_input)
         
-        # Notify others in room
-        room_players = session.get_players_in_room(player['room'])
-        for p in room_players:
-            if p['uid'] != self.user_id:
-                await self.channel_layer.send(
-                    p['channel_name'],
-                    {
-                        'type': 'player_moved',
-                        'uid': self.user_id,
-                        'x': x,
-                        'y': y
-                    }
-                )
-        
-        # Send proximity updates
-        for uid in changed_players:
-            changed_player = session.get_player(uid)
-            if changed_player:
-                await self.channel_layer.send(
-                    changed_player['channel_name'],
-                    {
-                        'type': 'proximity_update',
-                        'proximity_id': changed_player['proximity_id']
-                    }
-                )
+        if settings.MOVE_BROADCAST_INTERVAL <= 0:
+            await flush_moves(self.channel_layer, session, player['room'])
+        session.note_proximity_changes(changed_players)
+        self.start_ticks(session)
     
+    @realm_serialized
     async def teleport(self, data):
         room_index = data.get('roomIndex')
         x = data.get('x')
@@ -408,79 +1376,59 @@ class GameConsumer(AsyncWebsocketConsumer):
         if not player:
             return
         
+        if not session.can_teleport(player, room_index, x, y):
+            # Nothing has changed yet; the client stays where it was
+            await self.push({
+                'type': 'error',
+                'message': 'Invalid teleport'
+            })
+            return
+        
         old_room = player['room']
         
         if old_room != room_index:
             # Notify old room players
-            old_room_players = session.get_players_in_room(old_room)
-            for p in old_room_players:
-                if p['uid'] != self.user_id:
-                    await self.channel_layer.send(
-                        p['channel_name'],
-                        {
-                            'type': 'player_left_room',
-                            'uid': self.user_id
-                        }
-                    )
+            await send_to_room(self.channel_layer, session, old_room, {
+                'type': 'player_left_room',
+                'uid': self.user_id
+            }, exclude=self.user_id)
             
             # Change room
             changed_players = session.change_room(self.user_id, room_index, x, y)
+            await sync_chat_groups(self.channel_layer, session, [self.user_id])
             
             # Notify new room players
-            new_room_players = session.get_players_in_room(room_index)
-            for p in new_room_players:
-                if p['uid'] != self.user_id:
-                    await self.channel_layer.send(
-                        p['channel_name'],
-                        {
-                            'type': 'player_joined_room',
-                            'player': player
-                        }
-                    )
+            await send_to_room(self.channel_layer, session, room_index, {
+                'type': 'player_joined_room',
+                'player': player
+            }, exclude=self.user_id)
             
-            # Send proximity updates
-            for uid in changed_players:
-                changed_player = session.get_player(uid)
-                if changed_player:
-                    await self.channel_layer.send(
-                        changed_player['channel_name'],
-                        {
-                            'type': 'proximity_update',
-                            'proximity_id': changed_player['proximity_id']
-                        }
-                    )
+            # Sequence numbers are per room, so start the client over
+            await self.send_room_snapshot(session, room_index)
         else:
             # Same room teleport
             changed_players = session.move_player(self.user_id, x, y)
             
             # Notify others
-            room_players = session.get_players_in_room(room_index)
-            for p in room_players:
-                if p['uid'] != self.user_id:
-                    await self.channel_layer.send(
-                        p['channel_name'],
-                        {
-                            'type': 'player_teleported',
-                            'uid': self.user_id,
-                            'x': x,
-                            'y': y
-                        }
-                    )
-            
-            # Send proximity updates
-            for uid in changed_players:
-                changed_player = session.get_player(uid)
-                if changed_player:
-                    await self.channel_layer.send(
-                        changed_player['channel_name'],
-                        {
-                            'type': 'proximity_update',
-                            'proximity_id': changed_player['proximity_id']
-                        }
-                    )
+            await self.broadcast_to_room(session, room_index, {
+                'type': 'player_teleported',
+                'uid': self.user_id,
+                'x': x,
+                'y': y
+            })
+        
+        session.note_proximity_changes(changed_players)
+        self.start_ticks(session)
     
+    @realm_serialized
     async def changed_skin(self, data):
         skin = data.get('skin')
+        if skin not in get_catalog():
+            await self.push({
+                'type': 'error',
+                'message': 'Unknown skin'
+            })
+            return
         
         session = session_manager.get_player_session(self.user_id)
         if not session:
@@ -493,24 +1441,30 @@ class GameConsumer(AsyncWebsocketConsumer):
         player['skin'] = skin
         
         # Notify others in room
-        room_players = session.get_players_in_room(player['room'])
-        for p in room_players:
-            if p['uid'] != self.user_id:
-                await self.channel_layer.send(
-                    p['channel_name'],
-                    {
-                        'type': 'player_changed_skin',
-                        'uid': self.user_id,
-                        'skin': skin
-                    }
-                )
+        await self.broadcast_to_room(session, player['room'], {
+            'type': 'player_changed_skin',
+            'uid': self.user_id,
+            'skin': skin
+        })
     
+    @realm_serialized
     async def send_message(self, data):
+        """Chat to the player's room, the whole realm, their proximity group
+        or (with ``to``) one player. Every recipient, sender included, gets
+        the same pre-encoded frame from one group_send."""
         message = data.get('message', '').strip()
         
         if not message or len(message) > 300:
             return
         
+        scope = data.get('scope', 'room')
+        if scope not in CHAT_SCOPES:
+            await self.push({
+                'type': 'error',
+                'message': 'Unknown chat scope'
+            })
+            return
+        
         session = session_manager.get_player_session(self.user_id)
         if not session:
             return
@@ -519,65 +1473,527 @@ class GameConsumer(AsyncWebsocketConsumer):
         if not player:
             return
         
-        # Notify others in room
-        room_players = session.get_players_in_room(player['room'])
-        for p in room_players:
-            await self.channel_layer.send(
-                p['channel_name'],
-                {
-                    'type': 'receive_message',
-                    'uid': self.user_id,
-                    'username': player['username'],
-                    'message': message
-                }
-            )
+        chat = {
+            'uid': self.user_id,
+            'username': player['username'],
+            'message': message,
+            'scope': scope
+        }
+        if scope == 'direct':
+            await self.send_direct_message(session, chat, str(data.get('to')))
+            return
+        
+        if scope == 'proximity':
+            key = session.announced_proximity.get(self.user_id)
+            if key is None:
+                await self.push({
+                    'type': 'error',
+                    'message': 'Nobody is near you'
+                })
+                return
+        else:
+            key = player['room']
+        group = chat_group(session.realm_id, scope, key)
+        await self.channel_layer.group_send(group, chat_frame(session.realm_id, chat))
+        session.stats.sent += session.chat_group_sizes[group]
+    
+    async def send_direct_message(self, session, chat, to):
+        recipient = session.get_player(to)
+        if not recipient or not recipient['channel_name']:
+            await self.push({
+                'type': 'error',
+                'message': 'That player is not here'
+            })
+            return
+        event = chat_frame(session.realm_id, {**chat, 'to': to})
+        # The sender sees their own message as sent
+        for channel_name in {recipient['channel_name'], self.channel_name}:
+            try:
+                await self.channel_layer.send(channel_name, event)
+            except ChannelFull:
+                continue
+            session.stats.sent += 1
+    
+
+
+class GameConsumer(PlayerHandlers, AsyncWebsocketConsumer):
+    """WebSocket consumer for game interactions"""
+    
+    async def connect(self):
+        self.user = self.scope['user']
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+        
+        self.user_id = str(self.user.id)
+        self.realm_id = None
+        self.realm_owner = None
+        # Clients that can inflate raw deflate ask for it when connecting;
+        # large messages such as joinedRealm then go out as binary frames
+        query = parse_qs(self.scope['query_string'].decode())
+        self.deflate_frames = (
+            settings.WS_COMPRESS_MIN_BYTES > 0 and 'deflate-raw' in query.get('compress', [])
+        )
+        # Realm and size of our buffer as last added to outbound_depth
+        self.counted_outbox = None
+        self.reset_outbound(0)
+        await realm_router.start()
+        await session_snapshots.start()
+        await heatmap_recorder.start()
+        game_consumers.add(self)
+        await self.accept()
+    
+    async def disconnect(self, close_code):
+        if getattr(self, 'counted_outbox', None):
+            self.outbox = {}
+            self.count_outbox()
+        if getattr(self, 'realm_owner', None):
+            await self.release_realm(close_code)
+    
+    async def receive(self, text_data):
+        try:
+            data = json.loads(text_data)
+        except ValueError as e:
+            await self.push({
+                'type': 'error',
+                'message': str(e)
+            })
+            return
+        
+        event_type = data.get('type')
+        if event_type == 'ackSeq':
+            # Flow control lives with the connection, not the realm
+            await self.ack_seq(data)
+            return
+        
+        if event_type in PLAYER_ENTRY_EVENTS:
+            realm_id = str(data.get('realmId'))
+            owner = realm_router.get_owner(realm_id)
+            if self.realm_owner and self.realm_owner != owner:
+                # Leaving a realm that lives on another worker
+                await self.release_realm(1000)
+            self.realm_id = realm_id
+            self.realm_owner = owner
+        
+        await self.route(data)
+    
+    async def route(self, data):
+        """Handle a game event here, or forward it to the worker owning the realm"""
+        if self.realm_owner in (None, realm_router.worker_id):
+            await self.handle_event(data)
+            return
+        await realm_router.forward(self.realm_owner, self.forwarded('realm.forward', data=data))
+    
+    async def release_realm(self, close_code):
+        """Have the realm's owner drop (or, for a lost connection, suspend) this player"""
+        if self.realm_owner == realm_router.worker_id:
+            await self.handle_disconnect(close_code)
+        else:
+            await realm_router.forward(self.realm_owner, self.forwarded('realm.disconnect', code=close_code))
+        self.realm_owner = None
+    
+    def forwarded(self, message_type, **fields):
+        return {
+            'type': message_type,
+            'worker': realm_router.worker_id,
+            'channel_name': self.channel_name,
+            'user_id': self.user_id,
+            'username': self.user.username,
+            **fields
+        }
+    
+    async def notify_realm_moved(self):
+        """The realm now belongs to another worker; the client joins it there"""
+        self.realm_owner = None
+        await self.push({
+            'type': 'realmMoved',
+            'realmId': self.realm_id
+        })
+    
+    def reset_outbound(self, seq):
+        """Start flow control over from a state the client has as of ``seq``"""
+        self.sent_seq = seq
+        self.acked_seq = seq
+        self.outbox_seq = seq
+        self.behind_since = None
+        # Buffered room events belong to the old state; chat and the like are kept
+        self.outbox = {
+            key: message for key, message in getattr(self, 'outbox', {}).items()
+            if 'seq' not in message
+        }
+        self.outbox_keys = itertools.count()
+    
+    async def ack_seq(self, data):
+        """Client reports the last room sequence number it applied"""
+        seq = data.get('seq')
+        if not isinstance(seq, int):
+            return
+        self.acked_seq = max(self.acked_seq, min(seq, self.sent_seq))
+        if self.outbox and self.sent_seq - self.acked_seq <= settings.OUTBOUND_WINDOW:
+            await self.flush_outbox()
+    
+    async def push(self, message):
+        """Send a message to the client, buffering while it lags behind.
+        
+        A client is lagging once it has more than OUTBOUND_WINDOW room
+        events unacknowledged. Meanwhile position updates are coalesced per
+        player (latest wins) and everything else is kept in order; the lot
+        goes out as one roomDelta when the client catches up. Clients that
+        overflow the buffer or stall are disconnected.
+        """
+        if message['type'] in ROOM_BASE_TYPES:
+            # The client starts over from here; older buffered events are moot
+            self.reset_outbound(message['seq'])
+            await self.flush_outbox()
+            await self.send_frame(message)
+            return
+        if message['type'] == 'roomDelta':
+            # A syncRoom reply, already covering everything up to its seq
+            self.sent_seq = max(self.sent_seq, message['seq'])
+            await self.send_frame(message)
+            return
+        
+        if not self.lagging():
+            if 'seq' in message:
+                self.sent_seq = self.outbox_seq = max(self.sent_seq, message['seq'])
+            await self.send_frame(message)
+            return
+        
+        if self.behind_since is None:
+            self.behind_since = time.monotonic()
+        
+        if 'seq' in message:
+            self.outbox_seq = max(self.outbox_seq, message['seq'])
+        if message['type'] == 'ack':
+            # Own events need no delivery; the delta's seq covers them
+            pass
+        elif message['type'] == 'playersMoved':
+            # One batch holding each player's newest position
+            buffered = self.outbox.pop('playersMoved', None)
+            if buffered:
+                moves = {row[0]: row for row in buffered['moves']}
+                moves.update((row[0], row) for row in message['moves'])
+                message = {**message, 'moves': list(moves.values())}
+            self.outbox['playersMoved'] = message
+        else:
+            # A buffered move must not be replayed over a later teleport,
+            # join or leave of the same player
+            uid = message['player']['uid'] if 'player' in message else message.get('uid')
+            buffered = self.outbox.get('playersMoved')
+            if uid is not None and buffered and 'seq' in message:
+                buffered['moves'] = [row for row in buffered['moves'] if row[0] != uid]
+            if message['type'] in SUPERSEDABLE_TYPES:
+                key = (message['type'], message['uid'])
+                self.outbox.pop(key, None)
+                self.outbox[key] = message
+            else:
+                self.outbox[next(self.outbox_keys)] = message
+        
+        if (len(self.outbox) > settings.OUTBOUND_MAX_BUFFERED
+                or time.monotonic() - self.behind_since > settings.OUTBOUND_STALL_SECONDS):
+            self.outbox = {}
+            await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+        self.count_outbox()
+    
+    def lagging(self):
+        """Whether messages are being buffered rather than sent (see push)"""
+        return bool(self.outbox) or self.sent_seq - self.acked_seq > settings.OUTBOUND_WINDOW
+    
+    def count_outbox(self):
+        """Bring this connection's share of outbound_depth up to date"""
+        if self.counted_outbox:
+            realm_id, depth = self.counted_outbox
+            outbound_depth[realm_id] -= depth
+            if not outbound_depth[realm_id]:
+                del outbound_depth[realm_id]
+        self.counted_outbox = (self.realm_id, len(self.outbox)) if self.outbox else None
+        if self.outbox:
+            outbound_depth[self.realm_id] += len(self.outbox)
+    
+    async def flush_outbox(self):
+        """Send everything buffered, room events batched into roomDelta frames"""
+        outbox, self.outbox = self.outbox, {}
+        if self.counted_outbox:
+            self.count_outbox()
+        run = []
+        for message in outbox.values():
+            if 'seq' in message:
+                run.append(message)
+                continue
+            if run:
+                await self.send_delta(run, max(m['seq'] for m in run))
+                run = []
+            await self.send_frame(message)
+        if run or self.outbox_seq > self.sent_seq:
+            await self.send_delta(run, self.outbox_seq)
+        self.behind_since = None
+    
+    async def send_delta(self, messages, seq):
+        self.sent_seq = max(self.sent_seq, seq)
+        await self.send_frame({
+            'type': 'roomDelta',
+            'seq': seq,
+            'events': sorted(messages, key=lambda m: m['seq'])
+        })
+    
+    async def send_frame(self, message):
+        """Send one message, deflated if it is large and the client can inflate it"""
+        text = json.dumps(message)
+        if self.deflate_frames and len(text) >= settings.WS_COMPRESS_MIN_BYTES:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            await self.send(bytes_data=compressor.compress(text.encode()) + compressor.flush())
+        else:
+            await self.send(text_data=text)
     
     # Channel layer event handlers
     async def player_joined_room(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'playerJoinedRoom',
-            'player': event['player']
-        }))
+        await self.push(room_event_message(event))
     
     async def player_left_room(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'playerLeftRoom',
-            'uid': event['uid']
-        }))
-    
-    async def player_moved(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'playerMoved',
-            'uid': event['uid'],
-            'x': event['x'],
-            'y': event['y']
-        }))
+        await self.push(room_event_message(event))
+    
+    async def players_moved(self, event):
+        await self.push(room_event_message(event))
     
     async def player_teleported(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'playerTeleported',
-            'uid': event['uid'],
-            'x': event['x'],
-            'y': event['y']
-        }))
+        await self.push(room_event_message(event))
     
     async def player_changed_skin(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'playerChangedSkin',
-            'uid': event['uid'],
-            'skin': event['skin']
-        }))
-    
-    async def receive_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'receiveMessage',
-            'uid': event['uid'],
-            'username': event['username'],
-            'message': event['message']
-        }))
+        await self.push(room_event_message(event))
+    
+    async def chat_message(self, event):
+        """A chat message, encoded once by the sender's worker for every recipient"""
+        if event['realm'] != self.realm_id:
+            # From a group of a realm this connection has since left
+            return
+        if self.lagging():
+            await self.push(json.loads(event['frame']))
+        else:
+            await self.send(text_data=event['frame'])
+    
+    async def client_message(self, event):
+        """A reply from the worker that owns our realm"""
+        await self.push(event['message'])
     
     async def proximity_update(self, event):
-        await self.send(text_data=json.dumps({
+        await self.push({
             'type': 'proximityUpdate',
             'proximityId': event['proximity_id']
-        }))
+        })
+    
+    async def spectator_update(self, event):
+        await self.push({**event, 'type': 'spectatorUpdate'})
+    
+    async def player_kicked(self, event):
+        """An administrator removed us from the realm (see kick_player)"""
+        self.outbox = {}
+        await self.send_frame({
+            'type': 'kicked',
+            'reason': event['reason']
+        })
+        await self.close(code=KICKED_CLOSE_CODE)
+
+
+class PresenceConsumer(AsyncWebsocketConsumer):
+    """Live player counts for the dashboard.
+    
+    The client sends ``{"type": "subscribe", "realmIds": [...]}`` and gets
+    the current counts of the realms it may see, then a ``presence``
+    message whenever one of them changes.
+    """
+    
+    async def connect(self):
+        self.user = self.scope['user']
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+        self.realm_ids = set()
+        # Counts from the other workers arrive once this one has joined
+        await realm_router.start()
+        await self.accept()
+    
+    async def disconnect(self, close_code):
+        for realm_id in getattr(self, 'realm_ids', ()):
+            await self.channel_layer.group_discard(realm_group(realm_id), self.channel_name)
+    
+    async def receive(self, text_data):
+        try:
+            data = json.loads(text_data)
+            if data.get('type') != 'subscribe':
+                return
+            realm_ids = [int(realm_id) for realm_id in data['realmIds']][:settings.PRESENCE_MAX_REALMS]
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            await self.send(text_data=json.dumps({'type': 'error', 'message': str(e)}))
+            return
+        
+        visible = await database_sync_to_async(visible_realm_ids)(self.user, realm_ids)
+        for realm_id in self.realm_ids - visible:
+            await self.channel_layer.group_discard(realm_group(realm_id), self.channel_name)
+        for realm_id in visible - self.realm_ids:
+            await self.channel_layer.group_add(realm_group(realm_id), self.channel_name)
+        self.realm_ids = visible
+        await self.send_counts({
+            realm_id: {'count': count, 'usernames': usernames}
+            for realm_id, (count, usernames) in presence_index.lookup(visible).items()
+        })
+    
+    async def presence_counts(self, event):
+        await self.send_counts(event['realms'])
+    
+    async def send_counts(self, realms):
+        await self.send(text_data=json.dumps({'type': 'presence', 'realms': realms}))
+
+
+class RemotePlayer(PlayerHandlers):
+    """A player connected to another worker, as seen by their realm's owner"""
+    def __init__(self, channel_layer, message):
+        self.channel_layer = channel_layer
+        self.worker = message['worker']
+        self.channel_name = message['channel_name']
+        self.user_id = message['user_id']
+        self.user = SimpleNamespace(id=message['user_id'], username=message['username'])
+        self.spectating = None
+        # Keeps this player's forwarded events in the order they were sent
+        self.lock = asyncio.Lock()
+    
+    async def push(self, message):
+        try:
+            await self.channel_layer.send(self.channel_name, {
+                'type': 'client_message',
+                'message': message
+            })
+        except ChannelFull:
+            # Their consumer is hopelessly behind; it recovers via syncRoom
+            pass
+
+
+# Players forwarded to this worker by others, by their connection's channel
+remote_players = {}
+
+# Connections held by this worker, whichever worker owns their realm
+game_consumers = weakref.WeakSet()
+
+# Messages buffered for lagging connections held by this worker, by realm
+outbound_depth = Counter()
+
+
+async def handle_forwarded(message):
+    """Run a game event forwarded by the worker holding the player's connection"""
+    if message['type'].startswith('presence.'):
+        # Other workers' player counts share the worker channel
+        await presence_index.handle_message(message)
+        return
+    if message['type'].startswith('liveops.'):
+        # Requests from the admin site, wherever it is being served
+        result = await run_liveops(message)
+        await get_channel_layer().send(message['reply_channel'], {
+            'type': 'liveops.reply',
+            'result': result
+        })
+        return
+    player = remote_players.get(message['channel_name'])
+    if not player:
+        if message['type'] != 'realm.forward':
+            return
+        player = remote_players[message['channel_name']] = RemotePlayer(get_channel_layer(), message)
+    
+    async with player.lock:
+        if message['type'] == 'realm.disconnect':
+            remote_players.pop(message['channel_name'], None)
+            await player.handle_disconnect(message['code'])
+        else:
+            await player.handle_event(message['data'])
+
+
+async def handle_ring_change():
+    """Hand over realms another worker now owns and tidy up after dead workers"""
+    presence_index.forget_workers(realm_router.ring.workers)
+    for session in list(session_manager.iter_sessions()):
+        if not realm_router.is_local(session.realm_id):
+            async with session.lock:
+                heatmap_recorder.retire(session)
+                session_manager.remove_session(session.realm_id)
+                await sync_chat_groups(get_channel_layer(), session, list(session.chat_members))
+            # Its players rejoin on the new owner; nothing to restore
+            await session_snapshots.discard(session.realm_id)
+    
+    for channel_name, player in list(remote_players.items()):
+        if player.lock.locked():
+            continue
+        if not realm_router.is_live(player.worker):
+            # Their connection died with its worker; hold the spot as for any drop
+            del remote_players[channel_name]
+            async with player.lock:
+                await player.handle_disconnect(None)
+        elif not session_manager.get_player_session(player.user_id) and not player.spectating:
+            del remote_players[channel_name]
+    
+    for consumer in list(game_consumers):
+        if consumer.realm_owner and consumer.realm_owner != realm_router.get_owner(consumer.realm_id):
+            await consumer.notify_realm_moved()
+
+
+async def kick_player(realm_id, user_id, reason):
+    """Drop a player from a realm held here and close their connection"""
+    session = session_manager.get_session(realm_id)
+    if not session:
+        return False
+    channel_layer = get_channel_layer()
+    async with session.lock:
+        player = session.get_player(user_id)
+        if not player:
+            return False
+        await send_to_room(channel_layer, session, player['room'], {
+            'type': 'player_left_room',
+            'uid': user_id
+        }, exclude=user_id)
+        session_manager.logout_player(user_id)
+        await sync_chat_groups(channel_layer, session, [user_id])
+        if player['channel_name']:
+            await channel_layer.send(player['channel_name'], {
+                'type': 'player_kicked',
+                'reason': reason
+            })
+    return True
+
+
+async def drain_realm(realm_id, reason):
+    """Close a realm's session here, disconnecting its players and spectators.
+    
+    Returns how many connections were closed. Nothing stops people joining
+    again afterwards; they get a fresh session.
+    """
+    session = session_manager.get_session(realm_id)
+    if not session:
+        return 0
+    channel_layer = get_channel_layer()
+    async with session.lock:
+        channel_names = [p['channel_name'] for p in session.players.values() if p['channel_name']]
+        channel_names += list(session.spectators)
+        heatmap_recorder.retire(session)
+        session_manager.remove_session(realm_id)
+        await sync_chat_groups(channel_layer, session, list(session.chat_members))
+        for channel_name in channel_names:
+            await channel_layer.send(channel_name, {
+                'type': 'player_kicked',
+                'reason': reason
+            })
+    await session_snapshots.discard(realm_id)
+    return len(channel_names)
+
+
+async def run_liveops(message):
+    """Answer a live-ops request (see core.liveops) for this worker"""
+    if message['type'] == 'liveops.stats':
+        return {
+            'sessions': [session.live_stats() for session in session_manager.iter_sessions()],
+            'outbound': dict(outbound_depth)
+        }
+    if message['type'] == 'liveops.kick':
+        return await kick_player(message['realm_id'], message['user_id'], message['reason'])
+    if message['type'] == 'liveops.drain':
+        return await drain_realm(message['realm_id'], message['reason'])
+    return None
+
+
+realm_router = RealmRouter(handle_forwarded, handle_ring_change, presence_index.start)
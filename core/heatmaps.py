@@ -0,0 +1,259 @@
+import asyncio
+import atexit
+import logging
+import math
+import sys
+import zlib
+from array import array
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import RoomHeatmap
+from .png import encode_png
+
+logger = logging.getLogger(__name__)
+
+
+METRICS = ('occupancy', 'visits')
+
+# Heat colours from cold to hot as (position, red, green, blue, alpha)
+RAMP = (
+    (0.0, 0, 64, 255, 80),
+    (0.4, 0, 220, 160, 140),
+    (0.7, 255, 230, 0, 190),
+    (1.0, 255, 0, 0, 230),
+)
+
+
+def pack_counts(counts):
+    """Compress a uint32 array for storage, little-endian whatever the host"""
+    if sys.byteorder == 'big':
+        counts = array('I', counts)
+        counts.byteswap()
+    return zlib.compress(counts.tobytes(), 6)
+
+
+def unpack_counts(blob):
+    counts = array('I')
+    counts.frombytes(zlib.decompress(blob))
+    if sys.byteorder == 'big':
+        counts.byteswap()
+    return counts
+
+
+def add_counts(bounds, counts, other_bounds, other_counts):
+    """Sum two count grids into one covering both, as ``(bounds, counts)``"""
+    if bounds == other_bounds:
+        return bounds, array('I', (a + b for a, b in zip(counts, other_counts)))
+    min_x = min(bounds[0], other_bounds[0])
+    min_y = min(bounds[1], other_bounds[1])
+    max_x = max(bounds[0] + bounds[2], other_bounds[0] + other_bounds[2])
+    max_y = max(bounds[1] + bounds[3], other_bounds[1] + other_bounds[3])
+    width = max_x - min_x
+    merged = array('I', bytes(4 * width * (max_y - min_y)))
+    for (x0, y0, w, h), grid in ((bounds, counts), (other_bounds, other_counts)):
+        for row in range(h):
+            start = (y0 - min_y + row) * width + (x0 - min_x)
+            for i in range(w):
+                merged[start + i] += grid[row * w + i]
+    return [min_x, min_y, width, max_y - min_y], merged
+
+
+class RoomHeat:
+    """Tile counters for one room of a live session.
+
+    Each count is one bounds check and one array increment; arrays are
+    only allocated once the room sees a player.
+    """
+    __slots__ = ('bounds', 'visits', 'occupancy')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.visits = None
+        self.occupancy = None
+
+    def index(self, x, y):
+        min_x, min_y, width, height = self.bounds
+        dx, dy = x - min_x, y - min_y
+        if 0 <= dx < width and 0 <= dy < height:
+            return dy * width + dx
+        return None
+
+    def new_grid(self):
+        return array('I', bytes(4 * self.bounds[2] * self.bounds[3]))
+
+    def visit(self, x, y):
+        i = self.index(x, y)
+        if i is not None:
+            if self.visits is None:
+                self.visits = self.new_grid()
+            self.visits[i] += 1
+
+    def sample(self, x, y):
+        i = self.index(x, y)
+        if i is not None:
+            if self.occupancy is None:
+                self.occupancy = self.new_grid()
+            self.occupancy[i] += 1
+
+    def take(self):
+        """``(visits, occupancy)`` counted since the last take, or None"""
+        if self.visits is None and self.occupancy is None:
+            return None
+        counts = (self.visits or self.new_grid(), self.occupancy or self.new_grid())
+        self.visits = self.occupancy = None
+        return counts
+
+
+def room_heat(room):
+    """Counters for a compiled room; None for a room without tiles"""
+    return RoomHeat(room['bounds']) if room['bounds'] else None
+
+
+class HeatmapRecorder:
+    """Aggregates where players go and stand, off the game's hot path.
+
+    Moves are counted as they happen (see RoomHeat); every
+    HEATMAP_SAMPLE_SECONDS each connected player's tile is counted once
+    more as occupancy. Every HEATMAP_FLUSH_SECONDS the counters are swapped
+    for empty ones on the event loop and added to that hour's RoomHeatmap
+    rows from a thread. ``sessions()`` returns the live sessions.
+    """
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.retired = []
+        self.started = False
+
+    async def start(self):
+        """Begin sampling and flushing; called by the first connection a worker accepts"""
+        if self.started or settings.HEATMAP_SAMPLE_SECONDS <= 0:
+            return
+        self.started = True
+        atexit.register(self.flush_all)
+        asyncio.ensure_future(self.sample_loop())
+        asyncio.ensure_future(self.flush_loop())
+
+    async def sample_loop(self):
+        while True:
+            await asyncio.sleep(settings.HEATMAP_SAMPLE_SECONDS)
+            for session in self.sessions():
+                for player in list(session.players.values()):
+                    heat = session.heat[player['room']]
+                    if heat and player['channel_name']:
+                        heat.sample(player['x'], player['y'])
+
+    async def flush_loop(self):
+        while True:
+            await asyncio.sleep(settings.HEATMAP_FLUSH_SECONDS)
+            try:
+                await asyncio.to_thread(self.write, self.take(), timezone.now())
+            except Exception:
+                logger.exception('Writing heatmaps failed')
+
+    def retire(self, session):
+        """Keep the counts of a session about to be dropped for the next flush"""
+        self.retired += self.take_session(session)
+
+    def take_session(self, session):
+        pending = []
+        for room_index, heat in enumerate(session.heat):
+            counts = heat.take() if heat else None
+            if counts:
+                pending.append((session.realm_id, room_index, heat.bounds, *counts))
+        return pending
+
+    def take(self):
+        pending, self.retired = self.retired, []
+        for session in self.sessions():
+            pending += self.take_session(session)
+        return pending
+
+    def flush_all(self):
+        self.write(self.take(), timezone.now())
+
+    def write(self, pending, now):
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        for realm_id, room_index, bounds, visits, occupancy in pending:
+            # A second attempt covers another worker creating the row first
+            for attempt in range(2):
+                try:
+                    self.add_to_hour(realm_id, room_index, hour, bounds, visits, occupancy)
+                    break
+                except IntegrityError:
+                    # Or the realm was deleted, and its counts can go
+                    continue
+
+    def add_to_hour(self, realm_id, room_index, hour, bounds, visits, occupancy):
+        with transaction.atomic():
+            row = RoomHeatmap.objects.select_for_update().filter(
+                realm_id=realm_id, room=room_index, hour=hour
+            ).first()
+            if row is None:
+                RoomHeatmap.objects.create(
+                    realm_id=realm_id, room=room_index, hour=hour, bounds=list(bounds),
+                    visits=pack_counts(visits), occupancy=pack_counts(occupancy)
+                )
+                return
+            _, visits = add_counts(row.bounds, unpack_counts(row.visits), list(bounds), visits)
+            row.bounds, occupancy = add_counts(row.bounds, unpack_counts(row.occupancy), list(bounds), occupancy)
+            row.visits = pack_counts(visits)
+            row.occupancy = pack_counts(occupancy)
+            row.save()
+
+
+def latest_update(realm_id, room_index):
+    return RoomHeatmap.objects.filter(realm_id=realm_id, room=room_index).aggregate(
+        latest=Max('updated_at')
+    )['latest']
+
+
+def load_heatmap(realm_id, room_index, metric, hours):
+    """``(bounds, counts)`` of a room over the last ``hours``, or None"""
+    since = timezone.now() - timedelta(hours=hours)
+    bounds = counts = None
+    rows = RoomHeatmap.objects.filter(
+        realm_id=realm_id, room=room_index, hour__gt=since - timedelta(hours=1)
+    ).only('bounds', metric)
+    for row in rows.iterator():
+        row_counts = unpack_counts(getattr(row, metric))
+        if counts is None:
+            bounds, counts = row.bounds, row_counts
+        else:
+            bounds, counts = add_counts(bounds, counts, row.bounds, row_counts)
+    return (bounds, counts) if counts is not None else None
+
+
+def build_palette():
+    """256 RGBA colours along RAMP, index 0 transparent"""
+    palette = [bytes(4)]
+    for i in range(1, 256):
+        t = i / 255
+        for (p0, *c0), (p1, *c1) in zip(RAMP, RAMP[1:]):
+            if t <= p1:
+                f = (t - p0) / (p1 - p0)
+                palette.append(bytes(round(a + (b - a) * f) for a, b in zip(c0, c1)))
+                break
+    return palette
+
+
+PALETTE = build_palette()
+
+
+def render_heatmap(bounds, counts):
+    """A PNG with one square of HEATMAP_TILE_PIXELS per tile (fewer for big
+    rooms), coloured on a log scale up to the busiest tile"""
+    _, _, width, height = bounds
+    scale = max(1, min(settings.HEATMAP_TILE_PIXELS, settings.HEATMAP_MAX_PIXELS // max(width, height)))
+    top = math.log1p(max(counts)) or 1
+    rows = []
+    for y in range(height):
+        row = b''.join(
+            PALETTE[math.ceil(math.log1p(c) / top * 255) if c else 0] * scale
+            for c in counts[y * width:(y + 1) * width]
+        )
+        rows.extend([row] * scale)
+    return encode_png(width * scale, height * scale, rows, level=6, filter_up=False)
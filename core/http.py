@@ -0,0 +1,13 @@
+def parse_accept_encoding(value):
+    """Encodings an Accept-Encoding value allows, leaving out those with q=0"""
+    accepted = set()
+    for part in value.split(','):
+        token, _, params = part.partition(';')
+        key, _, q = params.partition('=')
+        try:
+            weight = float(q) if key.strip() == 'q' else 1.0
+        except ValueError:
+            weight = 0.0
+        if weight > 0:
+            accepted.add(token.strip().lower())
+    return accepted
@@ -0,0 +1,65 @@
+import asyncio
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import consumers
+
+
+# Callers join the cluster first (RealmRouter.start_once); until then every
+# realm looks like this worker's
+async def ask(worker, message):
+    """Have a worker run a live-ops request and return its answer, or None
+    if it does not answer within LIVEOPS_TIMEOUT"""
+    if worker == consumers.realm_router.worker_id:
+        return await consumers.run_liveops(message)
+    channel_layer = get_channel_layer()
+    reply_channel = await channel_layer.new_channel('liveops.')
+    await consumers.realm_router.forward(worker, {**message, 'reply_channel': reply_channel})
+    try:
+        reply = await asyncio.wait_for(channel_layer.receive(reply_channel), settings.LIVEOPS_TIMEOUT)
+    except asyncio.TimeoutError:
+        return None
+    return reply['result']
+
+
+async def collect_stats():
+    """Every worker's live sessions, as ``(sessions, silent workers)``.
+
+    Each session's stats (see Session.live_stats) gain the ``worker`` that
+    owns it and ``outbound``: the messages buffered for its lagging
+    connections, summed over the workers holding them.
+    """
+    workers = sorted(consumers.realm_router.ring.workers)
+    answers = await asyncio.gather(*(ask(worker, {'type': 'liveops.stats'}) for worker in workers))
+    sessions = []
+    outbound = {}
+    silent = []
+    for worker, answer in zip(workers, answers):
+        if answer is None:
+            silent.append(worker)
+            continue
+        for stats in answer['sessions']:
+            sessions.append({**stats, 'worker': worker})
+        for realm_id, depth in answer['outbound'].items():
+            outbound[realm_id] = outbound.get(realm_id, 0) + depth
+    for stats in sessions:
+        stats['outbound'] = outbound.get(stats['realm_id'], 0)
+    sessions.sort(key=lambda stats: (-stats['players'], stats['realm_id']))
+    return sessions, silent
+
+
+async def kick(realm_id, user_id, reason):
+    """Remove a player from a live realm; False if they are not in it, None
+    if the owning worker did not answer"""
+    owner = consumers.realm_router.get_owner(realm_id)
+    return await ask(owner, {
+        'type': 'liveops.kick', 'realm_id': realm_id, 'user_id': user_id, 'reason': reason
+    })
+
+
+async def drain(realm_id, reason):
+    """Close a live realm; the number of connections closed, None if the
+    owning worker did not answer"""
+    owner = consumers.realm_router.get_owner(realm_id)
+    return await ask(owner, {'type': 'liveops.drain', 'realm_id': realm_id, 'reason': reason})
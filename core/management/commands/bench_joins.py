@@ -0,0 +1,114 @@
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections
+from django.db.models import Subquery
+
+from core.models import Profile, Realm
+
+
+# Pragmas matching SQLite's out-of-the-box behaviour, used by --baseline
+BASELINE_PRAGMAS = {
+    'journal_mode': 'DELETE',
+    'synchronous': 'FULL',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure realm join throughput while map saves run concurrently, '
+        'against a scratch copy of the configured database'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=5.0)
+        parser.add_argument('--readers', type=int, default=8)
+        parser.add_argument('--writers', type=int, default=2)
+        parser.add_argument(
+            '--baseline', action='store_true',
+            help='Run without the SQLITE_PRAGMAS tuning for comparison'
+        )
+
+    def handle(self, *args, **options):
+        if options['baseline']:
+            settings.SQLITE_PRAGMAS = BASELINE_PRAGMAS
+        connections.close_all()
+
+        with tempfile.TemporaryDirectory() as scratch:
+            if connection.vendor == 'sqlite':
+                # A file rather than the in-memory default, so that journaling
+                # and locking behave as they do against the real database
+                connection.settings_dict['TEST']['NAME'] = os.path.join(scratch, 'bench.sqlite3')
+            # Readers and writers run on their own connections, so a rolled
+            # back transaction could not hold their rows
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                counts = self.run_bench(options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        seconds = options['seconds']
+        self.stdout.write(f"backend:   {connection.vendor} ({'baseline' if options['baseline'] else 'tuned'})")
+        self.stdout.write(f"joins/s:   {counts['joins'] / seconds:.0f}")
+        self.stdout.write(f"saves/s:   {counts['saves'] / seconds:.0f}")
+        self.stdout.write(f"errors:    {counts['errors']}")
+
+    def run_bench(self, options):
+        user = User.objects.create_user(username='bench')
+        map_data = self.build_map()
+        realm = Realm.objects.create(owner=user, name='bench', map_data=map_data)
+
+        counts = {'joins': 0, 'saves': 0, 'errors': 0}
+        lock = threading.Lock()
+        deadline = time.monotonic() + options['seconds']
+
+        def run(work, key):
+            done = errors = 0
+            try:
+                while time.monotonic() < deadline:
+                    try:
+                        work()
+                        done += 1
+                    except OperationalError:
+                        errors += 1
+            finally:
+                connection.close()
+            with lock:
+                counts[key] += done
+                counts['errors'] += errors
+
+        def join():
+            # Same query GameConsumer.get_realm_data issues on join; the map
+            # itself comes from the worker's artifact cache
+            skin = Profile.objects.filter(user_id=user.id).values('skin')[:1]
+            Realm.objects.annotate(skin=Subquery(skin)).only(
+                'map_blob_id', 'owner_id', 'only_owner'
+            ).get(id=realm.id)
+
+        def save():
+            realm.name = f'bench {time.monotonic()}'
+            realm.map_data = map_data
+            realm.save(update_fields=['name', 'map_data'])
+
+        threads = [threading.Thread(target=run, args=(join, 'joins')) for _ in range(options['readers'])]
+        threads += [threading.Thread(target=run, args=(save, 'saves')) for _ in range(options['writers'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return counts
+
+    def build_map(self, size=64):
+        tilemap = {
+            f'{x}, {y}': {'floor': 'ground_0', 'impassable': False}
+            for x in range(size) for y in range(size)
+        }
+        return {
+            'spawnpoint': {'roomIndex': 0, 'x': size // 2, 'y': size // 2},
+            'rooms': [{'name': 'Main Room', 'tilemap': tilemap}],
+        }
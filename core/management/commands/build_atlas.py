@@ -0,0 +1,76 @@
+import json
+import math
+import re
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image, UnidentifiedImageError
+
+
+CHARACTER_FILE = re.compile(r'^Character_(\d{3})\.png$')
+
+# Frame size within each character sheet, as drawn by the client
+FRAME_SIZE = (32, 32)
+
+
+def read_sheet(path):
+    try:
+        with Image.open(path) as image:
+            return image.convert('RGBA')
+    except (OSError, UnidentifiedImageError):
+        raise CommandError(f'{path} is not a readable image.')
+
+
+class Command(BaseCommand):
+    help = 'Pack the character spritesheets into one atlas image plus a JSON manifest'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source', default=str(Path(settings.BASE_DIR) / 'static' / 'sprites' / 'characters')
+        )
+        parser.add_argument(
+            '--output', default=str(Path(settings.BASE_DIR) / 'static' / 'sprites' / 'characters-atlas'),
+            help='Path without extension; .png and .json are written'
+        )
+
+    def handle(self, *args, **options):
+        source = Path(options['source'])
+        sheets = sorted(
+            (match.group(1), path) for path in source.iterdir()
+            if (match := CHARACTER_FILE.match(path.name))
+        )
+        if not sheets:
+            raise CommandError(f'No Character_NNN.png files in {source}.')
+
+        decoded = {skin: read_sheet(path) for skin, path in sheets}
+        cell_width, cell_height = decoded[sheets[0][0]].size
+        if any(image.size != (cell_width, cell_height) for image in decoded.values()):
+            raise CommandError('All character sheets must be the same size.')
+
+        # A near-square grid of equal cells
+        columns = math.ceil(math.sqrt(len(sheets)))
+        grid_rows = math.ceil(len(sheets) / columns)
+        width, height = columns * cell_width, grid_rows * cell_height
+        atlas = Image.new('RGBA', (width, height))
+
+        offsets = {}
+        for index, (skin, _) in enumerate(sheets):
+            x, y = index % columns * cell_width, index // columns * cell_height
+            offsets[skin] = [x, y]
+            atlas.paste(decoded[skin], (x, y))
+
+        output = Path(options['output'])
+        output.parent.mkdir(parents=True, exist_ok=True)
+        atlas.save(output.with_suffix('.png'), optimize=True)
+        manifest = {
+            'version': 1,
+            'size': [width, height],
+            'cell': [cell_width, cell_height],
+            'frame': list(FRAME_SIZE),
+            'skins': offsets,
+        }
+        output.with_suffix('.json').write_text(json.dumps(manifest, separators=(',', ':')) + '\n')
+        self.stdout.write(
+            f'Packed {len(sheets)} sheets into {output.with_suffix(".png")} ({width}x{height})'
+        )
@@ -0,0 +1,36 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.map_stream import iter_export, iter_gzip
+from core.models import Realm
+
+
+class Command(BaseCommand):
+    help = 'Write a realm map as NDJSON to a file (gzipped if it ends in .gz) or stdout'
+
+    def add_arguments(self, parser):
+        parser.add_argument('realm_id', type=int)
+        parser.add_argument('-o', '--output', default='-', help='Output path, - for stdout')
+        parser.add_argument('--gzip', action='store_true', help='Gzip even when writing to stdout')
+
+    def handle(self, *args, **options):
+        try:
+            realm = Realm.objects.select_related('map_blob').get(id=options['realm_id'])
+        except Realm.DoesNotExist:
+            raise CommandError(f"Realm {options['realm_id']} does not exist.")
+
+        output = options['output']
+        chunks = iter_export(realm.name, realm.map_data)
+        if options['gzip'] or output.endswith('.gz'):
+            chunks = iter_gzip(chunks)
+
+        out = sys.stdout.buffer if output == '-' else open(output, 'wb')
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+        if output != '-':
+            self.stderr.write(f'Exported realm {realm.id} to {output}')
@@ -0,0 +1,52 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from core.map_stream import read_import
+from core.maps import MapValidationError
+from core.models import Realm
+
+
+class Command(BaseCommand):
+    help = 'Create a realm, or replace its map, from an export_realm file (plain or gzipped)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Input path, - for stdin')
+        parser.add_argument('--owner', help='Username that will own a new realm')
+        parser.add_argument('--realm', type=int, help='Replace the map of this realm instead')
+        parser.add_argument('--name', help='Name for a new realm (default: the exported name)')
+
+    def handle(self, *args, **options):
+        if bool(options['owner']) == bool(options['realm']):
+            raise CommandError('Pass either --owner to create a realm or --realm to replace a map.')
+
+        path = options['path']
+        try:
+            if path == '-':
+                name, map_data = read_import(sys.stdin.buffer)
+            else:
+                with open(path, 'rb') as f:
+                    name, map_data = read_import(f)
+        except OSError as e:
+            raise CommandError(str(e))
+        except MapValidationError as e:
+            raise CommandError(f'{path}: {e}')
+
+        try:
+            if options['realm']:
+                realm = Realm.objects.get(id=options['realm'])
+                realm.map_data = map_data
+                realm.save()
+            else:
+                realm = Realm.objects.create(
+                    owner=User.objects.get(username=options['owner']),
+                    name=(options['name'] or name or 'Imported Realm')[:100],
+                    map_data=map_data
+                )
+        except (Realm.DoesNotExist, User.DoesNotExist) as e:
+            raise CommandError(str(e))
+        except MapValidationError as e:
+            raise CommandError(f'{path}: {e}')
+
+        self.stdout.write(f'Imported {path} into realm {realm.id} ({len(map_data["rooms"])} rooms)')
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import selectors
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from types import SimpleNamespace
+
+from channels.layers import channel_layers
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from core import consumers
+from core.recorder import CONNECT, DISCONNECT, DISCONNECT_PAYLOAD, MAP, decode_event, read_log, session_recorder
+from core.skins import get_catalog
+
+
+class CountingChannelLayer:
+    """Stands in for the channel layer: keeps group memberships and counts
+    the messages that would be delivered, without delivering them"""
+    extensions = ['groups']
+
+    def __init__(self):
+        self.groups = defaultdict(set)
+        self.messages = Counter()
+        self.bytes = Counter()
+
+    async def send(self, channel, message):
+        self.count(message, 1)
+
+    async def group_send(self, group, message):
+        self.count(message, len(self.groups.get(group, ())))
+
+    async def group_add(self, group, channel):
+        self.groups[group].add(channel)
+
+    async def group_discard(self, group, channel):
+        self.groups[group].discard(channel)
+
+    def count(self, message, recipients):
+        if recipients:
+            self.messages[message['type']] += recipients
+            self.bytes[message['type']] += recipients * len(json.dumps(message, separators=(',', ':')))
+
+
+class ReplayPlayer(consumers.PlayerHandlers):
+    """One recorded connection, run through the same handlers as a live one"""
+    def __init__(self, channel_layer, channel_name, user_id, username, map_artifacts):
+        self.channel_layer = channel_layer
+        self.channel_name = channel_name
+        self.user_id = str(user_id)
+        self.user = SimpleNamespace(id=user_id, username=username)
+        self.map_artifacts = map_artifacts
+        # Keeps this connection's events in the order they were recorded
+        self.lock = asyncio.Lock()
+
+    async def push(self, message):
+        self.channel_layer.count(message, 1)
+
+    async def get_realm_data(self, realm_id):
+        # The map as it was recorded, open to everyone, default skin
+        return self.map_artifacts, None, False, get_catalog().resolve(None)
+
+
+class VirtualClockSelector(selectors.DefaultSelector):
+    """Instead of sleeping until the next timer is due, moves the loop's
+    clock forward to it; real I/O is still waited for when nothing is"""
+    def __init__(self):
+        super().__init__()
+        self.now = 0.0
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            return super().select(None)
+        self.now += timeout
+        return []
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """Runs every timer in order, as fast as the code in between allows"""
+    def __init__(self):
+        self.clock = VirtualClockSelector()
+        super().__init__(self.clock)
+
+    def time(self):
+        return self.clock.now
+
+
+class Command(BaseCommand):
+    help = (
+        'Replay session recordings (SESSION_RECORD_DIR) against a headless '
+        'session manager and report throughput and fan-out'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('logs', nargs='+', help='.grl files; logs of the same realm are merged')
+        parser.add_argument(
+            '--speed', choices=['max', 'original'], default='max',
+            help='max runs on a virtual clock, so timers (move batches, proximity '
+                 'dwell) fire as they did but nothing waits for them; original '
+                 'sleeps between events as recorded'
+        )
+
+    def handle(self, *args, **options):
+        records, maps = self.load(options['logs'])
+        if not records:
+            raise CommandError('The logs hold no events.')
+
+        # Headless: nothing saved, restored or recorded, nothing sent anywhere
+        consumers.session_snapshots.store = None
+        session_recorder.directory = None
+        layer = CountingChannelLayer()
+        channel_layers.set('default', layer)
+
+        loop = VirtualClockLoop() if options['speed'] == 'max' else asyncio.new_event_loop()
+        try:
+            began = time.perf_counter()
+            handled, replay_seconds = loop.run_until_complete(self.replay(records, maps, layer))
+            elapsed = time.perf_counter() - began
+            for task in asyncio.all_tasks(loop):
+                task.cancel()
+            loop.run_until_complete(asyncio.sleep(0))
+        finally:
+            loop.close()
+
+        sent = sum(layer.messages.values())
+        self.stdout.write(f'recorded:   {replay_seconds:.1f} s of traffic, {len(maps)} realm(s)')
+        self.stdout.write(f'replayed:   {elapsed:.2f} s ({options["speed"]} speed)')
+        self.stdout.write(f'events:     {handled} ({handled / elapsed:.0f}/s)')
+        self.stdout.write(f'sent:       {sent} messages, {sum(layer.bytes.values()) / 1024:.0f} KiB')
+        self.stdout.write(f'fan-out:    {sent / handled:.1f} messages per event')
+        for message_type, count in layer.messages.most_common():
+            self.stdout.write(f'  {message_type:<20} {count:>9}  {layer.bytes[message_type] / 1024:>9.0f} KiB')
+
+    def load(self, paths):
+        """Every record of every log, in time order, as ``(seconds, realm id,
+        connection key, kind, payload)``, and the map of each realm"""
+        records = []
+        maps = {}
+        for number, path in enumerate(paths):
+            try:
+                started, log = read_log(path)
+            except (OSError, ValueError) as e:
+                raise CommandError(str(e))
+            # Named <realm id>-<date>-<time>-<pid>.grl
+            realm_id = Path(path).name.split('-', 1)[0]
+            for ms, kind, connection, payload in log:
+                if kind == MAP:
+                    maps.setdefault(realm_id, decode_event(kind, payload))
+                else:
+                    records.append((started + ms / 1000, realm_id, (number, connection), kind, payload))
+        records.sort(key=lambda record: record[0])
+        if records and set(maps) != {record[1] for record in records}:
+            raise CommandError('A log is missing its map; was the realm ever joined?')
+        return records, maps
+
+    async def replay(self, records, maps, layer):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        first = records[0][0]
+        players = {}
+        tasks = []
+
+        async def run(player, kind, payload):
+            async with player.lock:
+                if kind == DISCONNECT:
+                    code, = DISCONNECT_PAYLOAD.unpack(payload)
+                    await player.handle_disconnect(None if code == -1 else code)
+                else:
+                    await player.handle_event(decode_event(kind, payload))
+
+        handled = 0
+        for at, realm_id, key, kind, payload in records:
+            delay = start + (at - first) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if kind == CONNECT:
+                user_id, username = json.loads(payload)
+                players[key] = ReplayPlayer(
+                    layer, f'replay.{key[0]}-{key[1]}', user_id, username, maps[realm_id]
+                )
+                continue
+            # Connections run concurrently, as they would live
+            tasks.append(asyncio.ensure_future(run(players[key], kind, payload)))
+            handled += 1
+        await asyncio.gather(*tasks)
+
+        # Let the last move batches and proximity changes go out
+        await asyncio.sleep(max(settings.MOVE_BROADCAST_INTERVAL, 0.1) + settings.PROXIMITY_DWELL_SECONDS)
+        return handled, records[-1][0] - first
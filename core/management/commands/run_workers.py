@@ -0,0 +1,85 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Serve the app from several Daphne processes sharing one listening socket'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int,
+            help='Number of Daphne processes (default: WEB_CONCURRENCY or the CPU '
+                 'count with REDIS_URL set, otherwise 1)'
+        )
+        parser.add_argument('--host', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        if workers is None:
+            workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+            if workers > 1 and not settings.REDIS_URL:
+                self.stderr.write(
+                    f'REDIS_URL is not set, so running 1 worker instead of {workers}; '
+                    'workers need a shared channel layer to agree on who owns each realm.'
+                )
+                workers = 1
+        if workers < 1:
+            raise CommandError('--workers must be at least 1.')
+        if workers > 1 and not settings.REDIS_URL:
+            raise CommandError(
+                'Running more than one worker needs REDIS_URL, so workers can '
+                'share a channel layer and agree on who owns each realm.'
+            )
+
+        # Bound once here and inherited by every worker, so the kernel
+        # spreads incoming connections between them
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((options['host'], options['port']))
+        sock.listen(socket.SOMAXCONN)
+        sock.set_inheritable(True)
+
+        module, _, name = settings.ASGI_APPLICATION.rpartition('.')
+        command = [sys.executable, '-m', 'daphne', '--fd', str(sock.fileno()), f'{module}:{name}']
+        stopping = False
+
+        def spawn():
+            return subprocess.Popen(command, pass_fds=[sock.fileno()])
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for process in processes:
+                if process.poll() is None:
+                    process.send_signal(signum)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        processes = [spawn() for _ in range(workers)]
+        self.stdout.write(
+            f"Serving on {options['host']}:{options['port']} with {workers} worker(s)"
+        )
+
+        while True:
+            if stopping:
+                for process in processes:
+                    process.wait()
+                break
+            for i, process in enumerate(processes):
+                if process.poll() is not None:
+                    # A crashed worker's realms fail over to the others until
+                    # its replacement joins the ring
+                    self.stderr.write(f'Worker {process.pid} exited with {process.returncode}; restarting')
+                    processes[i] = spawn()
+            time.sleep(1)
+
+        sock.close()
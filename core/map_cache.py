@@ -0,0 +1,51 @@
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .models import MapBlob
+
+
+class ArtifactCache:
+    """Compiled map artifacts by map hash, least recently used dropped first.
+
+    Realms with the same map (see MapBlob) get the very same artifacts,
+    so a worker holds one copy of a map's collision grids however many
+    sessions run on it, and joining a realm whose map is cached reads only
+    the realm row. Artifacts are never changed once built, so sharing them
+    is safe.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def share(self, artifacts):
+        """The cached copy of these artifacts, caching them if there is none"""
+        digest = artifacts.get('map_version')
+        if digest is None:
+            return artifacts
+        cached = self.entries.get(digest)
+        if cached is not None and cached.get('version') == artifacts.get('version'):
+            self.entries.move_to_end(digest)
+            return cached
+        self.entries[digest] = artifacts
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return artifacts
+
+    async def get(self, digest):
+        """Artifacts of the blob with this hash, or None if there is no such blob"""
+        cached = self.entries.get(digest)
+        if cached is not None:
+            self.entries.move_to_end(digest)
+            return cached
+        try:
+            blob = await MapBlob.objects.only('map_artifacts').aget(hash=digest)
+        except MapBlob.DoesNotExist:
+            return None
+        if not blob.map_artifacts:
+            # A map that does not compile is never cached
+            return blob.map_artifacts
+        return self.share(blob.map_artifacts)
+
+
+map_artifact_cache = ArtifactCache(settings.MAP_ARTIFACT_CACHE_SIZE)
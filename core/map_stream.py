@@ -0,0 +1,127 @@
+import json
+import zlib
+
+from django.conf import settings
+
+from .maps import MapValidationError, finish_map, normalize_room
+
+
+# Realm map transfer format: newline-delimited JSON. The first line is a
+# header holding everything but the rooms, then one line per room. Both
+# sides only ever hold one room's text at a time.
+FORMAT = 'gather-map'
+FORMAT_VERSION = 1
+
+GZIP_MAGIC = b'\x1f\x8b'
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_export(name, map_data):
+    """Yield a map as NDJSON lines, header first"""
+    header = {k: v for k, v in map_data.items() if k != 'rooms'}
+    header.update(format=FORMAT, version=FORMAT_VERSION, name=name, rooms=len(map_data['rooms']))
+    yield json.dumps(header, separators=(',', ':')).encode() + b'\n'
+    for room in map_data['rooms']:
+        yield json.dumps(room, separators=(',', ':')).encode() + b'\n'
+
+
+def iter_gzip(chunks):
+    """Gzip an iterable of byte strings on the fly"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _decoded_chunks(stream, max_bytes):
+    """Read a plain or gzipped stream, failing once it inflates past max_bytes"""
+    first = stream.read(CHUNK_SIZE)
+    inflater = zlib.decompressobj(31) if first[:2] == GZIP_MAGIC else None
+    total = 0
+    chunk = first
+    while chunk:
+        if inflater:
+            # Bounded steps, so a small gzip bomb never inflates all at once
+            data = inflater.decompress(chunk, CHUNK_SIZE)
+            while True:
+                total += len(data)
+                if total > max_bytes:
+                    break
+                yield data
+                if not inflater.unconsumed_tail:
+                    break
+                data = inflater.decompress(inflater.unconsumed_tail, CHUNK_SIZE)
+        else:
+            total += len(chunk)
+            if total <= max_bytes:
+                yield chunk
+        if total > max_bytes:
+            raise MapValidationError(f'Map is larger than {max_bytes // (1024 * 1024)} MB.')
+        chunk = stream.read(CHUNK_SIZE)
+    if inflater and not inflater.eof:
+        raise MapValidationError('Map file is truncated.')
+
+
+def _lines(stream, max_bytes):
+    # Rooms can span many chunks; join each line's pieces once
+    parts = []
+    for data in _decoded_chunks(stream, max_bytes):
+        start = 0
+        end = data.find(b'\n')
+        while end != -1:
+            parts.append(data[start:end])
+            line = b''.join(parts)
+            parts = []
+            if line.strip():
+                yield line
+            start = end + 1
+            end = data.find(b'\n', start)
+        parts.append(data[start:])
+    line = b''.join(parts)
+    if line.strip():
+        yield line
+
+
+def read_import(stream, max_bytes=None):
+    """Parse an exported map from a binary file-like object.
+
+    Returns ``(name, map_data)``, the map already normalized. The stream
+    may be gzipped. Nothing is read past MAP_IMPORT_MAX_BYTES of decoded
+    data or MAP_MAX_ROOMS rooms, and each room is normalized as it is read,
+    so only its parsed text and the normalized map are ever held.
+    """
+    if max_bytes is None:
+        max_bytes = settings.MAP_IMPORT_MAX_BYTES
+    lines = _lines(stream, max_bytes)
+    try:
+        header = json.loads(next(lines, b'{}'))
+        if not isinstance(header, dict) or header.pop('format', None) != FORMAT:
+            raise MapValidationError('Not a realm map export.')
+        if header.pop('version', None) != FORMAT_VERSION:
+            raise MapValidationError('Unsupported realm map export version.')
+        name = header.pop('name', '')
+        room_count = header.pop('rooms', None)
+        if not isinstance(room_count, int) or not 0 < room_count <= settings.MAP_MAX_ROOMS:
+            raise MapValidationError(f'A map can have at most {settings.MAP_MAX_ROOMS} rooms.')
+
+        rooms = []
+        for line in lines:
+            if len(rooms) == room_count:
+                raise MapValidationError('Map file has more rooms than its header says.')
+            rooms.append(normalize_room(json.loads(line), len(rooms), room_count))
+    except MapValidationError:
+        raise
+    except (ValueError, zlib.error) as e:
+        raise MapValidationError(f'Map file is not valid: {e}')
+    if len(rooms) != room_count:
+        raise MapValidationError('Map file is truncated.')
+    return (name if isinstance(name, str) else ''), finish_map(header, rooms)
+
+
+async def as_async(chunks):
+    """Wrap a sync iterator so Django streams it under ASGI instead of
+    collecting it into a list first"""
+    for chunk in chunks:
+        yield chunk
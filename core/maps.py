@@ -0,0 +1,191 @@
+import base64
+import hashlib
+import json
+
+from django.conf import settings
+
+
+# Bump when the artifact layout changes so stored ones get rebuilt
+ARTIFACTS_VERSION = 1
+
+# Longest private area id a tile may carry, and most areas in one room
+MAX_ZONE_ID_LENGTH = 64
+MAX_ZONES_PER_ROOM = 1024
+
+
+class MapValidationError(ValueError):
+    """Raised for map data that does not follow the realm map schema"""
+
+
+def parse_tile_key(key):
+    """'3, 4' (or '3,4', ' 3 , 4 ') -> (3, 4)"""
+    try:
+        x, y = key.split(',')
+        return int(x), int(y)
+    except (AttributeError, ValueError):
+        raise MapValidationError(f'Bad tile key {key!r}; expected "x, y".')
+
+
+def _require_int(value, what):
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise MapValidationError(f'{what} must be an integer.')
+    return value
+
+
+def _check_point(point, what, room_count):
+    if not isinstance(point, dict):
+        raise MapValidationError(f'{what} must be an object with roomIndex, x and y.')
+    room_index = _require_int(point.get('roomIndex'), f'{what}.roomIndex')
+    if not 0 <= room_index < room_count:
+        raise MapValidationError(f'{what} points at room {room_index}, which does not exist.')
+    return {
+        'roomIndex': room_index,
+        'x': _require_int(point.get('x'), f'{what}.x'),
+        'y': _require_int(point.get('y'), f'{what}.y'),
+    }
+
+
+class NormalizedMap(dict):
+    """Map data that normalize_map has checked; it is handed back as is
+    rather than checked and copied again"""
+
+
+def normalize_map(map_data):
+    """Check map data against the schema and return a normalized copy.
+
+    Tile keys are rewritten to the canonical "x, y" form; everything else
+    about a tile is kept, but the fields the server relies on are type
+    checked.
+    """
+    if isinstance(map_data, NormalizedMap):
+        return map_data
+    if not isinstance(map_data, dict):
+        raise MapValidationError('Map data must be an object.')
+    rooms = map_data.get('rooms')
+    if not isinstance(rooms, list) or not rooms:
+        raise MapValidationError('Map data needs a non-empty "rooms" list.')
+    if len(rooms) > settings.MAP_MAX_ROOMS:
+        raise MapValidationError(f'A map can have at most {settings.MAP_MAX_ROOMS} rooms.')
+    return finish_map(map_data, [normalize_room(room, index, len(rooms)) for index, room in enumerate(rooms)])
+
+
+def normalize_room(room, index, room_count):
+    """Normalized copy of one room of a map with ``room_count`` rooms"""
+    if not isinstance(room, dict) or not isinstance(room.get('tilemap', {}), dict):
+        raise MapValidationError(f'Room {index} must be an object with a "tilemap" object.')
+    name = room.get('name', '')
+    if not isinstance(name, str):
+        raise MapValidationError(f'Room {index} name must be a string.')
+
+    tilemap = {}
+    zones = set()
+    for key, tile in room.get('tilemap', {}).items():
+        x, y = parse_tile_key(key)
+        if not isinstance(tile, dict):
+            raise MapValidationError(f'Tile {key!r} in room {index} must be an object.')
+        if not isinstance(tile.get('impassable', False), bool):
+            raise MapValidationError(f'Tile {key!r} in room {index}: impassable must be true or false.')
+        zone = tile.get('privateAreaId')
+        if zone is not None:
+            if not isinstance(zone, str) or not 0 < len(zone) <= MAX_ZONE_ID_LENGTH:
+                raise MapValidationError(
+                    f'Tile {key!r} in room {index}: privateAreaId must be a string of 1 to '
+                    f'{MAX_ZONE_ID_LENGTH} characters.'
+                )
+            zones.add(zone)
+        tile = dict(tile)
+        if 'teleporter' in tile:
+            tile['teleporter'] = _check_point(
+                tile['teleporter'], f'Teleporter at {key!r} in room {index}', room_count
+            )
+        tilemap[f'{x}, {y}'] = tile
+    if len(zones) > MAX_ZONES_PER_ROOM:
+        raise MapValidationError(f'Room {index} has more than {MAX_ZONES_PER_ROOM} private areas.')
+
+    if tilemap:
+        xs = [parse_tile_key(key)[0] for key in tilemap]
+        ys = [parse_tile_key(key)[1] for key in tilemap]
+        if (max(xs) - min(xs) >= settings.MAP_MAX_ROOM_SIZE
+                or max(ys) - min(ys) >= settings.MAP_MAX_ROOM_SIZE):
+            raise MapValidationError(
+                f'Room {index} is larger than {settings.MAP_MAX_ROOM_SIZE} tiles across.'
+            )
+
+    return {**room, 'name': name, 'tilemap': tilemap}
+
+
+def finish_map(map_data, normalized_rooms):
+    """The normalized map made of ``map_data``'s other fields and rooms
+    already passed through normalize_room"""
+    spawnpoint = _check_point(map_data.get('spawnpoint'), 'spawnpoint', len(normalized_rooms))
+    spawn_tiles = normalized_rooms[spawnpoint['roomIndex']]['tilemap']
+    spawn_tile = spawn_tiles.get(f"{spawnpoint['x']}, {spawnpoint['y']}")
+    if spawn_tiles and (spawn_tile is None or spawn_tile.get('impassable')):
+        raise MapValidationError('The spawnpoint must be on a walkable tile.')
+
+    return NormalizedMap(map_data, spawnpoint=spawnpoint, rooms=normalized_rooms)
+
+
+def map_version(map_data):
+    """Content hash of normalized map data"""
+    canonical = json.dumps(map_data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def compile_room(room):
+    """Bounds, passability bitmap, teleporter index and zones for one room.
+
+    ``walkable`` is base64 of a row-major bitmap over the bounds, one bit
+    per tile (least significant first): set where a tile exists and is not
+    impassable. ``zones`` maps each private area id to its tile keys.
+    """
+    tiles = {parse_tile_key(key): tile for key, tile in room['tilemap'].items()}
+    if not tiles:
+        return {'bounds': None, 'walkable': '', 'teleporters': {}, 'zones': {}}
+
+    min_x = min(x for x, _ in tiles)
+    min_y = min(y for _, y in tiles)
+    width = max(x for x, _ in tiles) - min_x + 1
+    height = max(y for _, y in tiles) - min_y + 1
+
+    bitmap = bytearray((width * height + 7) // 8)
+    teleporters = {}
+    zones = {}
+    for (x, y), tile in tiles.items():
+        if not tile.get('impassable'):
+            bit = (y - min_y) * width + (x - min_x)
+            bitmap[bit >> 3] |= 1 << (bit & 7)
+        if 'teleporter' in tile:
+            target = tile['teleporter']
+            teleporters[f'{x}, {y}'] = [target['roomIndex'], target['x'], target['y']]
+        if tile.get('privateAreaId'):
+            zones.setdefault(tile['privateAreaId'], []).append(f'{x}, {y}')
+
+    return {
+        'bounds': [min_x, min_y, width, height],
+        'walkable': base64.b64encode(bytes(bitmap)).decode(),
+        'teleporters': teleporters,
+        'zones': {zone: sorted(keys) for zone, keys in sorted(zones.items())},
+    }
+
+
+def compile_map(map_data, previous=None):
+    """Validate and normalize map data and build its runtime artifacts.
+
+    Returns ``(normalized_map, artifacts)``. Artifacts are what a live
+    session needs, so joining a realm never has to load or walk the
+    tilemaps. ``previous`` artifacts are reused when the map is unchanged.
+    """
+    normalized = normalize_map(map_data)
+    version = map_version(normalized)
+    if (previous and previous.get('version') == ARTIFACTS_VERSION
+            and previous.get('map_version') == version):
+        return normalized, previous
+    artifacts = {
+        'version': ARTIFACTS_VERSION,
+        'map_version': version,
+        'spawnpoint': normalized['spawnpoint'],
+        'rooms': [compile_room(room) for room in normalized['rooms']],
+    }
+    return normalized, artifacts
+
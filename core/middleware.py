@@ -0,0 +1,49 @@
+import brotli
+from django.conf import settings
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+
+from .http import parse_accept_encoding
+
+
+# Content types worth compressing; images, archives and the like already are
+COMPRESSIBLE_TYPES = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+    'image/svg+xml',
+)
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """Gzip, or Brotli when accepted, for sizeable text responses.
+
+    Responses under COMPRESS_MIN_BYTES are left alone. Brotli is only used
+    for responses other than HTML: pages carry the CSRF token next to user
+    content, and Django's BREACH padding exists for gzip alone.
+    """
+    def process_response(self, request, response):
+        content_type = response.get('Content-Type', '').split(';')[0]
+        if not content_type.startswith(COMPRESSIBLE_TYPES) or response.has_header('Content-Encoding'):
+            return response
+        if not response.streaming and len(response.content) < settings.COMPRESS_MIN_BYTES:
+            return response
+
+        accept_encoding = request.META.get('HTTP_ACCEPT_ENCODING', '')
+        if (not response.streaming and content_type != 'text/html'
+                and 'br' in parse_accept_encoding(accept_encoding)):
+            patch_vary_headers(response, ('Accept-Encoding',))
+            compressed = brotli.compress(response.content, quality=settings.COMPRESS_BROTLI_QUALITY)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(compressed))
+            # The body differs from the uncompressed one, so a strong ETag no longer holds
+            etag = response.get('ETag')
+            if etag and etag.startswith('"'):
+                response.headers['ETag'] = 'W/' + etag
+            response.headers['Content-Encoding'] = 'br'
+            return response
+
+        return super().process_response(request, response)
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-19 17:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_realm_map_artifacts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomHeatmap',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('room', models.PositiveIntegerField()),
+                ('hour', models.DateTimeField()),
+                ('bounds', models.JSONField()),
+                ('visits', models.BinaryField()),
+                ('occupancy', models.BinaryField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('realm', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='heatmaps', to='core.realm')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='roomheatmap',
+            constraint=models.UniqueConstraint(fields=('realm', 'room', 'hour'), name='unique_room_heatmap_hour'),
+        ),
+    ]
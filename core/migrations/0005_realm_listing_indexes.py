@@ -0,0 +1,55 @@
+# Generated by Django 4.2.30 on 2026-10-19 17:48
+
+from django.conf import settings
+from django.db import DatabaseError, migrations, models, transaction
+import django.db.models.deletion
+
+
+def create_name_trigram_index(apps, schema_editor):
+    """Index UPPER(name) by trigram on PostgreSQL, where it serves the
+    icontains lookups of the admin search. Other databases cannot index a
+    LIKE that matches anywhere, so they go without."""
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    try:
+        # Needs the privilege to create extensions; without it names go unindexed
+        with transaction.atomic(using=connection.alias):
+            schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    except DatabaseError:
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS realm_name_trgm_idx ON core_realm '
+        'USING gin ((UPPER("name"::text)) gin_trgm_ops)'
+    )
+
+
+def drop_name_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS realm_name_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0004_roomheatmap'),
+    ]
+
+    operations = [
+        # The composite index goes in before the owner's own is dropped
+        migrations.AddIndex(
+            model_name='realm',
+            index=models.Index(fields=['owner', '-created_at', '-id'], name='realm_owner_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='realm',
+            index=models.Index(fields=['-created_at', '-id'], name='realm_created_idx'),
+        ),
+        migrations.AlterField(
+            model_name='realm',
+            name='owner',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(create_name_trigram_index, drop_name_trigram_index),
+    ]
@@ -0,0 +1,98 @@
+# Generated by Django 4.2.30 on 2026-10-19 19:02
+
+from collections import Counter
+import hashlib
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def content_hash(map_data):
+    """core.maps.map_version as of this migration"""
+    canonical = json.dumps(map_data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def move_maps_to_blobs(apps, schema_editor):
+    """Store each distinct map once and point its realms at it.
+
+    Every realm saved since 0002 holds its normalized map and the artifacts
+    compiled from it, hash included, so they move over as they are. Maps
+    that never compiled have no artifacts and are hashed as stored.
+    """
+    Realm = apps.get_model('core', 'Realm')
+    MapBlob = apps.get_model('core', 'MapBlob')
+    refcounts = Counter()
+    for realm in Realm.objects.only('map_data', 'map_artifacts').iterator():
+        map_data, artifacts = realm.map_data, realm.map_artifacts or {}
+        digest = artifacts.get('map_version') or content_hash(map_data)
+        MapBlob.objects.get_or_create(hash=digest, defaults={'map_data': map_data, 'map_artifacts': artifacts})
+        realm.map_blob_id = digest
+        realm.save(update_fields=['map_blob'])
+        refcounts[digest] += 1
+    for digest, refcount in refcounts.items():
+        MapBlob.objects.filter(hash=digest).update(refcount=refcount)
+
+
+def copy_maps_from_blobs(apps, schema_editor):
+    Realm = apps.get_model('core', 'Realm')
+    for realm in Realm.objects.select_related('map_blob').iterator():
+        realm.map_data = realm.map_blob.map_data
+        realm.map_artifacts = realm.map_blob.map_artifacts
+        realm.save(update_fields=['map_data', 'map_artifacts'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_realm_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MapBlob',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('map_data', models.JSONField()),
+                ('map_artifacts', models.JSONField()),
+                ('refcount', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='realm',
+            name='is_template',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='realm',
+            name='map_blob',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='realms', to='core.mapblob'),
+        ),
+        # Nullable while it goes, so that unapplying can add it back to
+        # existing rows before filling it in
+        migrations.AlterField(
+            model_name='realm',
+            name='map_data',
+            field=models.JSONField(null=True),
+        ),
+        migrations.RunPython(move_maps_to_blobs, copy_maps_from_blobs),
+        migrations.RemoveField(
+            model_name='realm',
+            name='map_artifacts',
+        ),
+        migrations.RemoveField(
+            model_name='realm',
+            name='map_data',
+        ),
+        migrations.AlterField(
+            model_name='realm',
+            name='map_blob',
+            field=models.ForeignKey(editable=False, on_delete=django.db.models.deletion.PROTECT, related_name='realms', to='core.mapblob'),
+        ),
+        migrations.AddIndex(
+            model_name='realm',
+            index=models.Index(condition=models.Q(('is_template', True)), fields=['is_template'], name='realm_template_idx'),
+        ),
+    ]
@@ -1,5 +1,8 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from .maps import ARTIFACTS_VERSION, MapValidationError, compile_map, map_version, normalize_map
 import uuid
 
 
@@ -12,16 +15,157 @@ class Profile(models.Model):
         return f"{self.user.username}'s profile"
 
 
+class MapBlob(models.Model):
+    """A realm map stored once however many realms use it.
+
+    Keyed by the hash of the normalized map (core.maps.map_version), so
+    realms with identical maps, such as clones of a template, share one row
+    and its compiled artifacts. ``refcount`` is the number of realms
+    pointing at it; a blob goes once the last of them lets go. Realms never
+    change a blob: saving an edited map points the realm at another one.
+    """
+    hash = models.CharField(max_length=64, primary_key=True)
+    map_data = models.JSONField()
+    # Derived from map_data; see core.maps.compile_map
+    map_artifacts = models.JSONField()
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.hash[:12]
+
+    @classmethod
+    def acquire(cls, map_data, count=1):
+        """The blob holding this map, stored if new, with ``count`` more
+        references taken on it. Raises MapValidationError for bad maps."""
+        normalized = normalize_map(map_data)
+        digest = map_version(normalized)
+        while True:
+            blob = cls.objects.filter(hash=digest).first()
+            if blob is None:
+                _, artifacts = compile_map(normalized)
+                blob, _ = cls.objects.get_or_create(
+                    hash=digest, defaults={'map_data': normalized, 'map_artifacts': artifacts}
+                )
+            elif blob.map_artifacts.get('version') != ARTIFACTS_VERSION:
+                _, blob.map_artifacts = compile_map(normalized)
+                cls.objects.filter(hash=digest).update(map_artifacts=blob.map_artifacts)
+            # Nothing updated means the last reference was released meanwhile
+            if cls.objects.filter(hash=digest).update(refcount=F('refcount') + count):
+                blob.refcount += count
+                return blob
+
+    @classmethod
+    def release(cls, digest, count=1):
+        """Drop ``count`` references, and the blob with the last of them"""
+        cls.objects.filter(hash=digest).update(refcount=F('refcount') - count)
+        cls.objects.filter(hash=digest, refcount=0).delete()
+
+
 class Realm(models.Model):
-    owner = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Indexed by realm_owner_created_idx, which leads with it
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     name = models.CharField(max_length=100)
     share_id = models.UUIDField(default=uuid.uuid4, unique=True)
-    map_data = models.JSONField()
+    # The map, shared with every realm whose map is the same; read and
+    # assign it through map_data
+    map_blob = models.ForeignKey(MapBlob, on_delete=models.PROTECT, related_name='realms', editable=False)
     only_owner = models.BooleanField(default=False)
+    # Offered to everyone as a starting point for new realms
+    is_template = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    def __init__(self, *args, **kwargs):
+        # A map assigned but not saved yet
+        self._new_map_data = None
+        super().__init__(*args, **kwargs)
+
     def __str__(self):
         return self.name
 
+    @property
+    def map_data(self):
+        if self._new_map_data is not None:
+            return self._new_map_data
+        return self.map_blob.map_data
+
+    @map_data.setter
+    def map_data(self, value):
+        self._new_map_data = value
+
+    @property
+    def map_artifacts(self):
+        return self.map_blob.map_artifacts
+
+    def clean(self):
+        if self._new_map_data is not None:
+            try:
+                # Kept, so saving does not check the map all over again
+                self._new_map_data = normalize_map(self._new_map_data)
+            except MapValidationError as e:
+                raise ValidationError({'map_data': str(e)})
+
+    def save(self, *args, **kwargs):
+        # Raises MapValidationError for maps that do not fit the schema
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            if 'map_data' not in update_fields:
+                super().save(*args, **kwargs)
+                return
+            kwargs['update_fields'] = {*update_fields, 'map_blob'} - {'map_data'}
+        if self._new_map_data is None:
+            super().save(*args, **kwargs)
+            return
+
+        previous = self.map_blob_id
+        with transaction.atomic():
+            blob = MapBlob.acquire(self._new_map_data)
+            self.map_blob = blob
+            super().save(*args, **kwargs)
+            if previous is not None:
+                # An unchanged map gives back the reference it just took
+                MapBlob.release(previous)
+        self._new_map_data = None
+
     class Meta:
         ordering = ['-created_at']
+        # Listings page newest first by (created_at, id); see core.pagination.
+        # The name search index is PostgreSQL only; see migration 0005.
+        indexes = [
+            models.Index(fields=['owner', '-created_at', '-id'], name='realm_owner_created_idx'),
+            models.Index(fields=['-created_at', '-id'], name='realm_created_idx'),
+            models.Index(fields=['is_template'], condition=models.Q(is_template=True), name='realm_template_idx'),
+        ]
+
+
+def clone_realm(source, owner, name, count=1):
+    """``count`` new realms for ``owner`` sharing the map of ``source``"""
+    with transaction.atomic():
+        # Taken first, so the blob cannot go while the clones are made
+        if not MapBlob.objects.filter(hash=source.map_blob_id).update(refcount=F('refcount') + count):
+            raise Realm.DoesNotExist('The realm was deleted.')
+        return Realm.objects.bulk_create([
+            Realm(owner=owner, name=name, map_blob_id=source.map_blob_id) for _ in range(count)
+        ])
+
+
+class RoomHeatmap(models.Model):
+    """Where players were in one room of a realm during one hour.
+
+    Counts are zlib-compressed little-endian uint32 arrays, one per tile of
+    ``bounds`` ([min_x, min_y, width, height]) row by row; see core.heatmaps.
+    """
+    realm = models.ForeignKey(Realm, on_delete=models.CASCADE, related_name='heatmaps')
+    room = models.PositiveIntegerField()
+    hour = models.DateTimeField()
+    bounds = models.JSONField()
+    # Moves onto each tile
+    visits = models.BinaryField()
+    # Times a player was seen standing on each tile, every HEATMAP_SAMPLE_SECONDS
+    occupancy = models.BinaryField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['realm', 'room', 'hour'], name='unique_room_heatmap_hour'),
+        ]
@@ -0,0 +1,40 @@
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+
+def encode_cursor(realm):
+    """Opaque cursor for the page that starts after this realm"""
+    key = f'{realm.created_at.isoformat()}|{realm.id}'
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """``(created_at, id)`` from encode_cursor; ValueError if it is not one"""
+    try:
+        key = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, realm_id = key.split('|')
+        return datetime.fromisoformat(created_at), int(realm_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError('Invalid cursor.') from e
+
+
+def keyset_page(queryset, cursor=None, size=24):
+    """One page of realms, newest first, and the cursor of the next page or None.
+
+    Pages continue from the last realm seen rather than an offset, so each
+    one is a range scan of the (created_at, id) indexes however deep it is,
+    and realms created meanwhile do not shift later pages.
+    """
+    queryset = queryset.order_by('-created_at', '-id')
+    if cursor:
+        created_at, realm_id = decode_cursor(cursor)
+        # The first condition alone bounds the index range
+        queryset = queryset.filter(created_at__lte=created_at).filter(
+            Q(created_at__lt=created_at) | Q(id__lt=realm_id)
+        )
+    realms = list(queryset[:size + 1])
+    if len(realms) > size:
+        return realms[:size], encode_cursor(realms[size - 1])
+    return realms, None
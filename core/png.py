@@ -0,0 +1,32 @@
+import struct
+import zlib
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def encode_png(width, height, rows, level=9, filter_up=True):
+    """Encode RGBA rows as a PNG, Up-filtered (cheap, and good for pixel art).
+
+    Unfiltered is much faster to encode from Python, for large images that
+    are rendered on request rather than built once.
+    """
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body))
+
+    raw = bytearray()
+    previous = bytes(width * 4)
+    for row in rows:
+        if filter_up:
+            raw.append(2)
+            raw += bytes((a - b) & 0xFF for a, b in zip(row, previous))
+            previous = row
+        else:
+            raw.append(0)
+            raw += row
+    return (
+        PNG_SIGNATURE
+        + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+        + chunk(b'IDAT', zlib.compress(bytes(raw), level))
+        + chunk(b'IEND', b'')
+    )
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db.models import Q
+
+from .models import Realm
+
+logger = logging.getLogger(__name__)
+
+
+# Channel layer group every worker's channel joins to hear the others' counts
+PRESENCE_GROUP = 'presence'
+
+# Dashboard subscribers to one realm's count join this group
+REALM_GROUP_PREFIX = 'presence.'
+
+
+def realm_group(realm_id):
+    return f'{REALM_GROUP_PREFIX}{realm_id}'
+
+
+def visible_realm_ids(user, realm_ids):
+    """The realms among ``realm_ids`` on this user's dashboard: owned or visited"""
+    visited = [str(share_id) for share_id in user.profile.visited_realms]
+    return {
+        str(realm_id) for realm_id in Realm.objects.filter(id__in=realm_ids).filter(
+            Q(owner=user) | Q(share_id__in=visited)
+        ).values_list('id', flat=True)
+    }
+
+
+class PresenceIndex:
+    """How many players are in each live realm, and a few of their names.
+
+    The session manager updates it whenever a player joins or leaves, so a
+    lookup never walks the sessions. Counts are kept per worker: a worker
+    knows its own realms, and with several workers each one broadcasts its
+    changes (and periodically all its counts) to the others over the channel
+    layer, so any of them can answer for any realm. A realm briefly held by
+    two workers while it moves between them is counted on both.
+    """
+    def __init__(self):
+        # Worker id -> {realm id: (count, usernames)}
+        self.workers = {}
+        # Worker id -> monotonic time its counts lapse unless refreshed
+        self.expires = {}
+        self.worker_id = 'local'
+        self.clustered = False
+        self.changed = set()
+        self.flush_handle = None
+        self.started = None
+
+    def update(self, realm_id, players):
+        """Record the players now in a realm this worker holds"""
+        realm_id = str(realm_id)
+        counts = self.workers.setdefault(self.worker_id, {})
+        if players:
+            usernames = sorted(p['username'] for p in players)[:settings.PRESENCE_USERNAMES]
+            counts[realm_id] = (len(players), usernames)
+        elif counts.pop(realm_id, None) is None:
+            return
+        self.changed.add(realm_id)
+        self.schedule_flush()
+
+    def lookup(self, realm_ids):
+        """``{realm id: (count, usernames)}`` for these realms, 0 for empty ones.
+
+        Safe to call from threads other than the event loop.
+        """
+        now = time.monotonic()
+        live = [
+            counts for worker, counts in list(self.workers.items())
+            if worker == self.worker_id or self.expires.get(worker, 0) > now
+        ]
+        result = {}
+        for realm_id in realm_ids:
+            realm_id = str(realm_id)
+            count, usernames = 0, []
+            for counts in live:
+                entry = counts.get(realm_id)
+                if entry:
+                    count += entry[0]
+                    usernames += entry[1]
+            result[realm_id] = (count, sorted(usernames)[:settings.PRESENCE_USERNAMES])
+        return result
+
+    def schedule_flush(self):
+        # Joins and leaves arriving together go out as one message
+        if self.flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Outside the server (management commands); nobody to tell
+            return
+        self.flush_handle = loop.call_later(
+            settings.PRESENCE_PUSH_SECONDS,
+            lambda: asyncio.ensure_future(self.flush())
+        )
+
+    async def flush(self):
+        self.flush_handle = None
+        changed, self.changed = self.changed, set()
+        channel_layer = get_channel_layer()
+        if not changed or channel_layer is None:
+            return
+        try:
+            for realm_id, (count, usernames) in self.lookup(changed).items():
+                await channel_layer.group_send(realm_group(realm_id), {
+                    'type': 'presence.counts',
+                    'realms': {realm_id: {'count': count, 'usernames': usernames}}
+                })
+            if self.clustered:
+                await self.publish(channel_layer, changed)
+        except Exception:
+            logger.exception('Publishing presence changes failed')
+
+    async def publish(self, channel_layer, realm_ids=None):
+        """Tell the other workers our counts for these realms, or all of them"""
+        counts = self.workers.get(self.worker_id, {})
+        if realm_ids is None:
+            realms = {realm_id: list(entry) for realm_id, entry in counts.items()}
+        else:
+            realms = {realm_id: list(counts.get(realm_id, (0, []))) for realm_id in realm_ids}
+        await channel_layer.group_send(PRESENCE_GROUP, {
+            'type': 'presence.update',
+            'worker': self.worker_id,
+            'full': realm_ids is None,
+            'realms': realms
+        })
+
+    async def start(self, router):
+        """Share counts with the other workers; called once the router has joined"""
+        if self.started is None:
+            self.started = asyncio.ensure_future(self._start(router))
+        await asyncio.shield(self.started)
+
+    async def _start(self, router):
+        # Counts recorded before joining were ours all along
+        self.workers[router.worker_id] = self.workers.pop(self.worker_id, {})
+        self.worker_id = router.worker_id
+        self.clustered = True
+        channel_layer = get_channel_layer()
+        await channel_layer.group_add(PRESENCE_GROUP, self.worker_id)
+        await channel_layer.group_send(PRESENCE_GROUP, {
+            'type': 'presence.sync',
+            'worker': self.worker_id
+        })
+        asyncio.ensure_future(self.refresh_loop(channel_layer))
+
+    async def refresh_loop(self, channel_layer):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_REFRESH_SECONDS)
+            try:
+                # Group memberships expire too
+                await channel_layer.group_add(PRESENCE_GROUP, self.worker_id)
+                await self.publish(channel_layer)
+            except Exception:
+                logger.exception('Presence refresh failed')
+
+    async def handle_message(self, message):
+        """A ``presence.*`` message from another worker"""
+        worker = message['worker']
+        if worker == self.worker_id:
+            return
+        if message['type'] == 'presence.sync':
+            # A worker that just started wants everyone's counts
+            await self.publish(get_channel_layer())
+            return
+
+        counts = self.workers.setdefault(worker, {})
+        if message['full']:
+            counts.clear()
+        for realm_id, (count, usernames) in message['realms'].items():
+            if count:
+                counts[realm_id] = (count, usernames)
+            else:
+                counts.pop(realm_id, None)
+        self.expires[worker] = time.monotonic() + 3 * settings.PRESENCE_REFRESH_SECONDS
+
+    def forget_workers(self, live_workers):
+        """Drop the counts of workers that left the ring"""
+        for worker in list(self.workers):
+            if worker != self.worker_id and worker not in live_workers:
+                self.workers.pop(worker, None)
+                self.expires.pop(worker, None)
+
+
+presence_index = PresenceIndex()
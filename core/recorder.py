@@ -0,0 +1,194 @@
+import asyncio
+import atexit
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Log header: magic, format version, unix time the log was started
+HEADER = struct.Struct('>3sBd')
+MAGIC = b'GRL'
+VERSION = 1
+
+# Each record: milliseconds since the log started, kind, connection number
+# within the log, payload length
+RECORD = struct.Struct('>IBII')
+
+# Record kinds and their payloads
+MAP = 0         # zlib'd JSON map artifacts of the realm, once per log
+CONNECT = 1     # JSON [user id, username], before a connection's first event
+EVENT = 2       # the event as compact JSON
+MOVE = 3        # movePlayer as MOVE_PAYLOAD: the bulk of all traffic
+DISCONNECT = 4  # close code as DISCONNECT_PAYLOAD, -1 for none
+
+MOVE_PAYLOAD = struct.Struct('>hhI')
+DISCONNECT_PAYLOAD = struct.Struct('>h')
+
+FLUSH_SECONDS = 1.0
+
+
+def encode_event(data):
+    """``(kind, payload)`` for an inbound event"""
+    if data.get('type') == 'movePlayer' and set(data) == {'type', 'x', 'y', 'input'}:
+        x, y, client_input = data['x'], data['y'], data['input']
+        if all(type(v) is int for v in (x, y, client_input)):
+            try:
+                return MOVE, MOVE_PAYLOAD.pack(x, y, client_input)
+            except struct.error:
+                pass
+    return EVENT, json.dumps(data, separators=(',', ':')).encode()
+
+
+def decode_event(kind, payload):
+    """The event (or for MAP, the map artifacts) a record holds"""
+    if kind == MAP:
+        return json.loads(zlib.decompress(payload))
+    if kind == MOVE:
+        x, y, client_input = MOVE_PAYLOAD.unpack(payload)
+        return {'type': 'movePlayer', 'x': x, 'y': y, 'input': client_input}
+    return json.loads(payload)
+
+
+def read_log(path):
+    """``(started, records)`` of a log, records as ``(ms, kind, connection,
+    payload)``. A record cut short by a crash ends the log."""
+    with open(path, 'rb') as f:
+        blob = f.read()
+    magic, version, started = HEADER.unpack_from(blob)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{path} is not a session recording')
+    records = []
+    offset = HEADER.size
+    while offset + RECORD.size <= len(blob):
+        ms, kind, connection, length = RECORD.unpack_from(blob, offset)
+        offset += RECORD.size
+        if offset + length > len(blob):
+            break
+        records.append((ms, kind, connection, blob[offset:offset + length]))
+        offset += length
+    return started, records
+
+
+class RealmLog:
+    """The recording of one realm by this process"""
+    def __init__(self, path):
+        self.path = path
+        self.started = time.monotonic()
+        self.buffer = bytearray(HEADER.pack(MAGIC, VERSION, time.time()))
+        self.connections = {}
+        self.has_map = False
+
+    def append(self, kind, connection, payload):
+        ms = int((time.monotonic() - self.started) * 1000)
+        self.buffer += RECORD.pack(ms, kind, connection, len(payload))
+        self.buffer += payload
+
+    def connection(self, player):
+        """The player's connection number, logging who they are the first time"""
+        number = self.connections.get(player.channel_name)
+        if number is None:
+            number = self.connections[player.channel_name] = len(self.connections)
+            self.append(CONNECT, number, json.dumps(
+                [player.user_id, player.user.username], separators=(',', ':')
+            ).encode())
+        return number
+
+
+class SessionRecorder:
+    """Appends every inbound game event to a binary log per realm.
+
+    Off unless SESSION_RECORD_DIR is set; SESSION_RECORD_REALMS limits it
+    to some realms. A log covers one realm for the life of one process and
+    is replayed with ``manage.py replay_sessions``. Records are buffered on
+    the event loop and written from a thread about once a second.
+    """
+    def __init__(self, directory, realm_ids=()):
+        self.directory = Path(directory) if directory else None
+        self.realm_ids = {str(realm_id) for realm_id in realm_ids}
+        self.logs = {}
+        self.flush_handle = None
+        self.lock = asyncio.Lock()
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def get_log(self, realm_id, session):
+        if self.realm_ids and realm_id not in self.realm_ids:
+            return None
+        log = self.logs.get(realm_id)
+        if log is None:
+            if not realm_id.isdigit():
+                # Realm ids come from clients; never let one pick the file name
+                return None
+            name = f"{realm_id}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.grl"
+            log = self.logs[realm_id] = RealmLog(self.directory / name)
+            if len(self.logs) == 1:
+                atexit.register(self.flush_all)
+        if not log.has_map and session is not None:
+            log.append(MAP, 0, zlib.compress(
+                json.dumps(session.map_artifacts, separators=(',', ':')).encode()
+            ))
+            log.has_map = True
+        return log
+
+    def record_event(self, realm_id, session, player, data):
+        log = self.get_log(realm_id, session)
+        if log:
+            kind, payload = encode_event(data)
+            log.append(kind, log.connection(player), payload)
+            self.schedule_flush()
+
+    def record_disconnect(self, realm_id, session, player, close_code):
+        log = self.get_log(realm_id, session)
+        if log:
+            code = close_code if isinstance(close_code, int) else -1
+            log.append(DISCONNECT, log.connection(player), DISCONNECT_PAYLOAD.pack(code))
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(
+                FLUSH_SECONDS,
+                lambda: asyncio.ensure_future(self.flush())
+            )
+
+    def take_pending(self):
+        pending = []
+        for log in self.logs.values():
+            if log.buffer:
+                pending.append((log.path, bytes(log.buffer)))
+                log.buffer.clear()
+        return pending
+
+    async def flush(self):
+        self.flush_handle = None
+        # One writer at a time keeps each file's records in order
+        async with self.lock:
+            try:
+                await asyncio.to_thread(self.write, self.take_pending())
+            except OSError:
+                logger.exception('Writing session recordings failed')
+
+    def flush_all(self):
+        self.write(self.take_pending())
+
+    def write(self, pending):
+        if pending:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        for path, data in pending:
+            with open(path, 'ab') as f:
+                f.write(data)
+
+
+session_recorder = SessionRecorder(settings.SESSION_RECORD_DIR, [
+    realm_id for realm_id in settings.SESSION_RECORD_REALMS.split(',') if realm_id
+])
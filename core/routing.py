@@ -3,4 +3,5 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/game/$', consumers.GameConsumer.as_asgi()),
+    re_path(r'ws/presence/$', consumers.PresenceConsumer.as_asgi()),
 ]
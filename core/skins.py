@@ -0,0 +1,63 @@
+import functools
+import hashlib
+import json
+
+from django.contrib.staticfiles import finders
+from django.core.exceptions import ImproperlyConfigured
+from django.templatetags.static import static
+
+
+# Written by `manage.py build_atlas`, as <name>.png and <name>.json
+SKIN_ATLAS = 'sprites/characters-atlas'
+
+# Given to players whose stored skin is no longer in the catalog
+DEFAULT_SKIN = '009'
+
+
+class SkinCatalog:
+    """The character skins players can pick, with what clients need to draw them.
+
+    Built from the atlas manifest, so a skin exists exactly when its sheet
+    was packed. ``payload`` is what /api/skins/ serves and pages embed.
+    """
+    def __init__(self, manifest):
+        self.ids = tuple(sorted(manifest['skins']))
+        self._ids = frozenset(self.ids)
+        self.payload = {
+            'version': manifest['version'],
+            'atlas': {
+                'url': static(SKIN_ATLAS + '.png'),
+                'size': manifest['size'],
+                'cell': manifest['cell'],
+            },
+            'frame': manifest['frame'],
+            'skins': {
+                skin: {
+                    'sheet': static(f'sprites/characters/Character_{skin}.png'),
+                    'atlas': manifest['skins'][skin],
+                }
+                for skin in self.ids
+            },
+        }
+        self.body = json.dumps(self.payload, separators=(',', ':')).encode()
+        self.etag = hashlib.sha256(self.body).hexdigest()[:16]
+
+    def __contains__(self, skin):
+        return isinstance(skin, str) and skin in self._ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def resolve(self, skin):
+        """``skin`` if it exists, otherwise the default"""
+        return skin if skin in self else DEFAULT_SKIN
+
+
+@functools.lru_cache(maxsize=None)
+def get_catalog():
+    """The catalog, built on first use and kept for the life of the process"""
+    path = finders.find(SKIN_ATLAS + '.json')
+    if path is None:
+        raise ImproperlyConfigured('The skin atlas is not built; run `python manage.py build_atlas`.')
+    with open(path) as f:
+        return SkinCatalog(json.load(f))
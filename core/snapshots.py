@@ -0,0 +1,163 @@
+import asyncio
+import atexit
+import json
+import logging
+import os
+import struct
+import tempfile
+import time
+import zlib
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Snapshot header: magic, format version, unix time it was taken
+HEADER = struct.Struct('>3sBd')
+MAGIC = b'GSS'
+VERSION = 3
+
+# Redis key prefix for snapshots, one key per realm
+REDIS_PREFIX = 'gather:session-snapshot:'
+
+
+def encode(state):
+    """Pack a session state into a versioned, compressed blob"""
+    body = json.dumps(state, separators=(',', ':')).encode()
+    return HEADER.pack(MAGIC, VERSION, time.time()) + zlib.compress(body)
+
+
+def decode(blob, max_age):
+    """Unpack a blob from encode(), or None if it is foreign, old or corrupt"""
+    try:
+        magic, version, taken_at = HEADER.unpack_from(blob)
+        if magic != MAGIC or version != VERSION or time.time() - taken_at > max_age:
+            return None
+        return json.loads(zlib.decompress(blob[HEADER.size:]))
+    except (struct.error, zlib.error, ValueError):
+        return None
+
+
+class DiskSnapshotStore:
+    """One file per realm in a local directory"""
+    def __init__(self, directory):
+        self.directory = Path(directory)
+
+    def path(self, realm_id):
+        # Realm ids come from clients; never let one pick the file name
+        if not str(realm_id).isdigit():
+            return None
+        return self.directory / f'{realm_id}.snapshot'
+
+    def save(self, realm_id, blob):
+        path = self.path(realm_id)
+        if not path:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp, path)
+
+    def delete(self, realm_id):
+        path = self.path(realm_id)
+        if path:
+            path.unlink(missing_ok=True)
+
+    def take(self, realm_id):
+        """Read a snapshot and remove it so it is restored only once"""
+        path = self.path(realm_id)
+        try:
+            blob = path.read_bytes()
+        except (AttributeError, OSError):
+            return None
+        path.unlink(missing_ok=True)
+        return blob
+
+
+class RedisSnapshotStore:
+    """One key per realm in Redis, shared by every worker and host"""
+    def __init__(self, url, max_age):
+        import redis
+
+        self.redis = redis.from_url(url)
+        self.max_age = max_age
+
+    def save(self, realm_id, blob):
+        self.redis.set(REDIS_PREFIX + str(realm_id), blob, ex=int(self.max_age))
+
+    def delete(self, realm_id):
+        self.redis.delete(REDIS_PREFIX + str(realm_id))
+
+    def take(self, realm_id):
+        return self.redis.getdel(REDIS_PREFIX + str(realm_id))
+
+
+def get_store():
+    if settings.REDIS_URL:
+        return RedisSnapshotStore(settings.REDIS_URL, settings.SESSION_SNAPSHOT_MAX_AGE)
+    if settings.SESSION_SNAPSHOT_DIR:
+        return DiskSnapshotStore(settings.SESSION_SNAPSHOT_DIR)
+    return None
+
+
+class SessionSnapshots:
+    """Saves live sessions now and then and at exit, for the next process.
+
+    ``collect()`` returns ``{realm_id: state}`` for every session this
+    process holds, with None for sessions nobody is in any more. Snapshots
+    are taken on the event loop and written from a thread.
+    """
+    def __init__(self, collect):
+        self.collect = collect
+        self.store = get_store()
+        self.started = False
+
+    async def start(self):
+        """Begin periodic saving; called by the first connection a worker accepts"""
+        if self.started or not self.store:
+            return
+        self.started = True
+        atexit.register(self.save_all)
+        asyncio.ensure_future(self.save_loop())
+
+    async def save_loop(self):
+        while True:
+            await asyncio.sleep(settings.SESSION_SNAPSHOT_SECONDS)
+            try:
+                await asyncio.to_thread(self.write, self.collect())
+            except Exception:
+                logger.exception('Saving session snapshots failed')
+
+    def save_all(self):
+        # At exit the loop is gone, so collect and write right here
+        states = self.collect()
+        self.write(states)
+        logger.info('Saved %d session snapshots', sum(1 for s in states.values() if s))
+
+    def write(self, states):
+        for realm_id, state in states.items():
+            if state:
+                self.store.save(realm_id, encode(state))
+            else:
+                self.store.delete(realm_id)
+
+    async def load(self, realm_id, accept=None):
+        """The state saved for a realm by an earlier process, if still fresh.
+
+        A state ``accept(state)`` turns down is saved back untouched.
+        """
+        if not self.store:
+            return None
+        blob = await asyncio.to_thread(self.store.take, realm_id)
+        state = decode(blob, settings.SESSION_SNAPSHOT_MAX_AGE) if blob else None
+        if state and accept and not accept(state):
+            await asyncio.to_thread(self.store.save, realm_id, blob)
+            return None
+        return state
+
+    async def discard(self, realm_id):
+        if self.store:
+            await asyncio.to_thread(self.store.delete, realm_id)
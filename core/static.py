@@ -0,0 +1,134 @@
+import asyncio
+import json
+import mimetypes
+from pathlib import Path
+
+from django.conf import settings
+
+from .http import parse_accept_encoding
+
+
+# Cache-Control for content-hashed names; their content can never change
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+
+# Precompressed copies written by core.storage, most preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+CHUNK_SIZE = 64 * 1024
+
+
+def accepted_encodings(headers):
+    for name, value in headers:
+        if name == b'accept-encoding':
+            return parse_accept_encoding(value.decode('latin-1'))
+    return set()
+
+
+class StaticFile:
+    """A collected file and its precompressed variants, looked up once"""
+    def __init__(self, path, cache_control):
+        content_type, _ = mimetypes.guess_type(path.name)
+        content_type = content_type or 'application/octet-stream'
+        if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+            content_type += '; charset=utf-8'
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.variants = []
+        for encoding, suffix in ENCODINGS + ((None, ''),):
+            variant = path.with_name(path.name + suffix)
+            if variant.is_file():
+                stat = variant.stat()
+                etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}{"-" + encoding if encoding else ""}"'
+                self.variants.append((encoding, variant, stat.st_size, etag))
+
+    def headers(self, encoding, size, etag):
+        headers = [
+            (b'content-type', self.content_type.encode()),
+            (b'cache-control', self.cache_control.encode()),
+            (b'etag', etag.encode()),
+        ]
+        if len(self.variants) > 1:
+            headers.append((b'vary', b'Accept-Encoding'))
+        if encoding:
+            headers.append((b'content-encoding', encoding.encode()))
+        if size is not None:
+            headers.append((b'content-length', str(size).encode()))
+        return headers
+
+    async def respond(self, scope, send):
+        accepted = accepted_encodings(scope['headers'])
+        encoding, path, size, etag = next(
+            v for v in self.variants if v[0] is None or v[0] in accepted
+        )
+
+        if_none_match = dict(scope['headers']).get(b'if-none-match', b'').decode('latin-1')
+        if etag in [tag.strip() for tag in if_none_match.split(',')]:
+            await send({'type': 'http.response.start', 'status': 304, 'headers': self.headers(encoding, None, etag)})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': self.headers(encoding, size, etag)})
+        if scope['method'] == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        f = await asyncio.to_thread(open, path, 'rb')
+        try:
+            while True:
+                chunk = await asyncio.to_thread(f.read, CHUNK_SIZE)
+                more = len(chunk) == CHUNK_SIZE
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': more})
+                if not more:
+                    break
+        finally:
+            f.close()
+
+
+class StaticFilesApp:
+    """ASGI app serving STATIC_ROOT in front of Django.
+
+    Content-hashed names listed in the collectstatic manifest get
+    far-future, immutable caching; anything else is cached for
+    STATIC_MAX_AGE seconds and revalidated by ETag. Clients that accept
+    Brotli or gzip get the precompressed copy. Paths not found in
+    STATIC_ROOT fall through to the wrapped app.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.prefix = '/' + settings.STATIC_URL.lstrip('/')
+        self.root = Path(settings.STATIC_ROOT).resolve() if settings.STATIC_ROOT else None
+        self.files = {}
+        self.hashed_names = None
+
+    async def __call__(self, scope, receive, send):
+        if (scope['type'] != 'http' or not self.root or scope['method'] not in ('GET', 'HEAD')
+                or not scope['path'].startswith(self.prefix)):
+            return await self.app(scope, receive, send)
+
+        static_file = self.find(scope['path'][len(self.prefix):])
+        if static_file is None:
+            return await self.app(scope, receive, send)
+        await static_file.respond(scope, send)
+
+    def find(self, name):
+        if name in self.files:
+            return self.files[name]
+        path = (self.root / name).resolve()
+        # Never serve anything outside STATIC_ROOT, nor the variants directly
+        if (not path.is_relative_to(self.root) or not path.is_file()
+                or path.suffix in ('.gz', '.br')):
+            return None
+
+        if self.hashed_names is None:
+            try:
+                manifest = json.loads((self.root / 'staticfiles.json').read_text())
+                self.hashed_names = set(manifest['paths'].values())
+            except (OSError, ValueError, KeyError):
+                self.hashed_names = set()
+        if name in self.hashed_names:
+            cache_control = IMMUTABLE_CACHE
+        else:
+            cache_control = f'public, max-age={settings.STATIC_MAX_AGE}'
+
+        # Collected files only change on deploy, i.e. with a new process
+        self.files[name] = StaticFile(path, cache_control)
+        return self.files[name]
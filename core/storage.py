@@ -0,0 +1,43 @@
+import gzip
+import os
+
+import brotli
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+
+# Extensions worth precompressing; images are compressed already
+COMPRESSIBLE_EXTENSIONS = {'.js', '.css', '.json', '.svg', '.html', '.txt', '.map'}
+
+# Files smaller than this gain nothing from a compressed copy
+MIN_COMPRESS_SIZE = 256
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Content-hashed static files, each text file with .gz and .br copies.
+
+    collectstatic does the work once per deploy, so requests only pick the
+    variant the client accepts (see core.static.StaticFilesApp).
+    """
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        names = set(self.hashed_files) | set(self.hashed_files.values())
+        for name in sorted(names):
+            if os.path.splitext(name)[1] in COMPRESSIBLE_EXTENSIONS:
+                self.compress(name)
+
+    def compress(self, name):
+        path = self.path(name)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return
+        if len(content) < MIN_COMPRESS_SIZE:
+            return
+        # mtime=0 keeps the output identical between deploys
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(content, compresslevel=9, mtime=0))
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(content, quality=11))
@@ -1,3 +1,1049 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import tempfile
+from collections import OrderedDict
+from datetime import timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import brotli
+from asgiref.sync import async_to_sync
+from channels.layers import channel_layers
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.staticfiles import finders
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import AsyncClient, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from PIL import Image
+
+from . import snapshots
+from .consumers import SLOW_CONSUMER_CLOSE_CODE, GameConsumer, PlayerHandlers, Session, session_manager, session_snapshots
+from .heatmaps import HeatmapRecorder, RoomHeat, load_heatmap
+from .map_cache import map_artifact_cache
+from .http import parse_accept_encoding
+from .map_stream import iter_export, iter_gzip, read_import
+from .maps import MapValidationError, compile_map, map_version, normalize_map
+from .middleware import CompressionMiddleware
+from .models import MapBlob, Profile, Realm, clone_realm
+from .pagination import decode_cursor, encode_cursor
+from .presence import presence_index
+from .recorder import session_recorder
+from .skins import SKIN_ATLAS
+
+
+TEST_MAP = {
+    'spawnpoint': {'roomIndex': 0, 'x': 5, 'y': 5},
+    'rooms': [
+        {'name': 'Main', 'tilemap': {f'{x}, {y}': {'floor': 'grass'} for x in range(10) for y in range(10)}},
+    ],
+}
+
+
+def setUpModule():
+    # The atlas is a build artifact, and joining a realm needs its catalog
+    if not finders.find(SKIN_ATLAS + '.json'):
+        call_command('build_atlas', stdout=io.StringIO())
+
+
+# Static files are not collected for tests, so names are not hashed
+TEST_STORAGES = {
+    **settings.STORAGES,
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+
+# Moves go out as they are made and nobody is ever close enough to share a
+# proximity group, so no tick task outlives a test
+@override_settings(
+    STORAGES=TEST_STORAGES,
+    MOVE_BROADCAST_INTERVAL=0,
+    PROXIMITY_RANGE=0,
+    PROXIMITY_LEAVE_RANGE=0,
+    HEATMAP_SAMPLE_SECONDS=0,
+)
+class ConsumerTestCase(TransactionTestCase):
+    """Players connected to one realm over real sockets"""
+
+    def setUp(self):
+        self.alice = User.objects.create_user(username='alice', password='x')
+        self.bob = User.objects.create_user(username='bob', password='x')
+        self.carol = User.objects.create_user(username='carol', password='x')
+        self.realm = Realm.objects.create(owner=self.alice, name='Office', map_data=TEST_MAP)
+        self.resume_tokens = {}
+
+    def tearDown(self):
+        # Connections left open end with the test's event loop; the session
+        # would otherwise outlive them
+        session_manager.remove_session(str(self.realm.id))
+
+    async def connect(self, user):
+        client = WebsocketCommunicator(GameConsumer.as_asgi(), '/ws/game/')
+        client.scope['user'] = user
+        connected, _ = await client.connect()
+        self.assertTrue(connected)
+        return client
+
+    async def receive_all(self, client):
+        messages = []
+        while not await client.receive_nothing(0.05):
+            messages.append(await client.receive_json_from())
+        return messages
+
+    async def join(self, user):
+        """Join the realm; returns the client and the room seq it is at"""
+        client = await self.connect(user)
+        await client.send_json_to({'type': 'joinRealm', 'realmId': self.realm.id})
+        joined = await client.receive_json_from()
+        self.assertEqual(joined['type'], 'joinedRealm')
+        self.resume_tokens[user.username] = joined['resumeToken']
+        # Our own playerJoinedRoom comes back as an ack
+        ack = await client.receive_json_from()
+        self.assertEqual((ack['type'], ack['seq']), ('ack', joined['seq'] + 1))
+        await self.receive_all(client)
+        return client, ack['seq']
+
+    async def move(self, client, *steps):
+        for x, y in steps:
+            await client.send_json_to({'type': 'movePlayer', 'x': x, 'y': y})
+
+
+class RoomSyncTests(ConsumerTestCase):
+    async def test_room_events_are_numbered(self):
+        alice, alice_seq = await self.join(self.alice)
+        bob, seq = await self.join(self.bob)
+        self.assertEqual(seq, alice_seq + 1)
+        [joined] = await self.receive_all(alice)
+        self.assertEqual((joined['type'], joined['seq']), ('playerJoinedRoom', seq))
+
+        await self.move(alice, (1, 1), (2, 1))
+        moves = await self.receive_all(bob)
+        self.assertEqual([m['type'] for m in moves], ['playersMoved', 'playersMoved'])
+        self.assertEqual([m['seq'] for m in moves], [seq + 1, seq + 2])
+
+    async def test_sync_room_sends_missed_events(self):
+        alice, _ = await self.join(self.alice)
+        bob, seq = await self.join(self.bob)
+        await self.move(alice, (1, 1), (2, 1), (3, 1))
+        await self.receive_all(bob)
+
+        await bob.send_json_to({'type': 'syncRoom', 'seq': seq + 1})
+        delta = await bob.receive_json_from()
+        self.assertEqual(delta['type'], 'roomDelta')
+        self.assertEqual(delta['seq'], seq + 3)
+        self.assertEqual([e['seq'] for e in delta['events']], [seq + 2, seq + 3])
+        self.assertEqual(delta['events'][-1]['moves'][0][1][-1], [3, 1])
+
+    @override_settings(ROOM_EVENT_LOG_SIZE=2)
+    async def test_sync_room_beyond_the_log_sends_snapshot(self):
+        alice, _ = await self.join(self.alice)
+        bob, seq = await self.join(self.bob)
+        await self.move(alice, (1, 1), (2, 1), (3, 1), (4, 1))
+        await self.receive_all(bob)
+
+        await bob.send_json_to({'type': 'syncRoom', 'seq': seq})
+        snapshot = await bob.receive_json_from()
+        self.assertEqual(snapshot['type'], 'roomSnapshot')
+        self.assertEqual(snapshot['seq'], seq + 4)
+        positions = {row[1]: row[2:4] for row in snapshot['players']}
+        self.assertEqual(positions, {'alice': [4, 1], 'bob': [5, 5]})
+
+
+class ResumeTests(ConsumerTestCase):
+    async def test_resume_sends_room_changes(self):
+        alice, _ = await self.join(self.alice)
+        bob, seq = await self.join(self.bob)
+        carol, _ = await self.join(self.carol)
+
+        # A dropped connection, not a clean leave
+        await bob.disconnect(code=4000)
+        await self.move(alice, (2, 2))
+        await carol.disconnect(code=1000)
+
+        bob = await self.connect(self.bob)
+        await bob.send_json_to({
+            'type': 'resumeRealm',
+            'realmId': self.realm.id,
+            'resumeToken': self.resume_tokens['bob'],
+        })
+        resumed = await bob.receive_json_from()
+        self.assertEqual(resumed['type'], 'resumedRealm')
+        self.assertEqual([(p['username'], p['x'], p['y']) for p in resumed['changed']], [('alice', 2, 2)])
+        self.assertEqual(resumed['left'], [str(self.carol.id)])
+        self.assertEqual(resumed['seq'], seq + 3)
+        self.assertNotEqual(resumed['resumeToken'], self.resume_tokens['bob'])
+
+    async def test_room_does_not_hear_of_a_dropped_player(self):
+        alice, _ = await self.join(self.alice)
+        bob, _ = await self.join(self.bob)
+        await self.receive_all(alice)
+        await bob.disconnect(code=4000)
+        self.assertEqual(await self.receive_all(alice), [])
+
+    @override_settings(RESUME_GRACE_SECONDS=0)
+    async def test_room_hears_once_the_grace_period_ends(self):
+        alice, _ = await self.join(self.alice)
+        bob, _ = await self.join(self.bob)
+        await self.receive_all(alice)
+        await bob.disconnect(code=4000)
+        left = await alice.receive_json_from(timeout=2)
+        self.assertEqual((left['type'], left['uid']), ('playerLeftRoom', str(self.bob.id)))
+
+        bob = await self.connect(self.bob)
+        await bob.send_json_to({
+            'type': 'resumeRealm',
+            'realmId': self.realm.id,
+            'resumeToken': self.resume_tokens['bob'],
+        })
+        self.assertEqual(await bob.receive_json_from(), {'type': 'failedToResume'})
+
+    async def test_resume_with_unknown_token_fails(self):
+        await self.join(self.alice)
+        bob = await self.connect(self.bob)
+        await bob.send_json_to({'type': 'resumeRealm', 'realmId': self.realm.id, 'resumeToken': 'nope'})
+        self.assertEqual(await bob.receive_json_from(), {'type': 'failedToResume'})
+
+
+
+class SnapshotEncodingTests(SimpleTestCase):
+    state = {'realm': '1', 'map_version': 'abc', 'seq': [3], 'players': [[1, 'alice', 5, 5, 0, 'bob', None, 't', None]]}
+
+    def test_round_trip(self):
+        self.assertEqual(snapshots.decode(snapshots.encode(self.state), 60), self.state)
+
+    def test_truncated_blob_is_ignored(self):
+        blob = snapshots.encode(self.state)
+        self.assertIsNone(snapshots.decode(blob[:snapshots.HEADER.size - 1], 60))
+        self.assertIsNone(snapshots.decode(blob[:-4], 60))
+
+    def test_corrupt_blob_is_ignored(self):
+        blob = bytearray(snapshots.encode(self.state))
+        blob[-6] ^= 0xff
+        self.assertIsNone(snapshots.decode(bytes(blob), 60))
+
+    def test_stale_or_other_version_is_ignored(self):
+        blob = snapshots.encode(self.state)
+        self.assertIsNone(snapshots.decode(blob, -1))
+        header = snapshots.HEADER.pack(snapshots.MAGIC, snapshots.VERSION - 1, 0)
+        self.assertIsNone(snapshots.decode(header + blob[snapshots.HEADER.size:], 60))
+
+    async def test_disk_store_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            saved = snapshots.SessionSnapshots(dict)
+            saved.store = snapshots.DiskSnapshotStore(directory)
+            saved.write({'1': self.state, '2': self.state})
+            saved.store.path('2').write_bytes(b'GSS\x03 not a snapshot')
+
+            self.assertEqual(await saved.load('1'), self.state)
+            # Taken, so a second process does not restore it again
+            self.assertIsNone(await saved.load('1'))
+            self.assertIsNone(await saved.load('2'))
+            self.assertIsNone(saved.store.path('../1'))
+
+
+class SnapshotRestoreTests(ConsumerTestCase):
+    """Realms come back from a snapshot after a restart"""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = snapshots.DiskSnapshotStore(directory.name)
+        patcher = mock.patch.object(session_snapshots, 'store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def restart(self):
+        """Save the realm's session and drop it, as a new process starts without it"""
+        realm_id = str(self.realm.id)
+        session_snapshots.write({realm_id: session_manager.snapshot_session(session_manager.get_session(realm_id))})
+        session_manager.remove_session(realm_id)
+
+    async def resume(self, user, token):
+        client = await self.connect(user)
+        await client.send_json_to({'type': 'resumeRealm', 'realmId': self.realm.id, 'resumeToken': token})
+        return await client.receive_json_from()
+
+    async def test_resume_after_restart(self):
+        bob, _ = await self.join(self.bob)
+        await self.move(bob, (4, 5))
+        await self.receive_all(bob)
+        await bob.disconnect(code=4000)
+        await self.restart()
+
+        resumed = await self.resume(self.bob, self.resume_tokens['bob'])
+        self.assertEqual(resumed['type'], 'resumedRealm')
+        self.assertEqual((resumed['player']['x'], resumed['player']['y']), (4, 5))
+
+    async def test_snapshot_of_an_edited_map_is_dropped(self):
+        bob, _ = await self.join(self.bob)
+        await bob.disconnect(code=4000)
+        await self.restart()
+        self.realm.map_data = edited(TEST_MAP, 20, 20)
+        await self.realm.asave()
+
+        self.assertEqual(await self.resume(self.bob, self.resume_tokens['bob']), {'type': 'failedToResume'})
+        self.assertIsNone(self.store.take(self.realm.id))
+
+    async def test_resume_without_a_saved_token_leaves_the_snapshot(self):
+        bob, _ = await self.join(self.bob)
+        await bob.disconnect(code=4000)
+        await self.restart()
+
+        self.assertEqual(await self.resume(self.carol, self.resume_tokens['bob']), {'type': 'failedToResume'})
+        self.assertEqual(await self.resume(self.bob, 'nope'), {'type': 'failedToResume'})
+        self.assertIsNone(session_manager.get_session(str(self.realm.id)))
+        self.assertEqual((await self.resume(self.bob, self.resume_tokens['bob']))['type'], 'resumedRealm')
+
+class FlowControlTests(ConsumerTestCase):
+    @override_settings(OUTBOUND_WINDOW=2)
+    async def test_lagging_client_gets_coalesced_delta(self):
+        alice, _ = await self.join(self.alice)
+        bob, seq = await self.join(self.bob)
+        await self.move(alice, *[(x, 1) for x in range(7)])
+        await alice.send_json_to({'type': 'sendMessage', 'message': 'hi'})
+
+        # Bob never acknowledged joining, so two more events fill the window
+        # and everything after them waits for him
+        sent = await self.receive_all(bob)
+        self.assertEqual([m['seq'] for m in sent], [seq + 1, seq + 2])
+
+        await bob.send_json_to({'type': 'ackSeq', 'seq': seq + 2})
+        flushed = await self.receive_all(bob)
+        self.assertEqual([m['type'] for m in flushed], ['roomDelta', 'receiveMessage'])
+        delta = flushed[0]
+        self.assertEqual(delta['seq'], seq + 7)
+        # Five buffered batches arrive as one, holding alice's newest position
+        [moved] = delta['events']
+        self.assertEqual(moved['type'], 'playersMoved')
+        self.assertEqual(moved['seq'], seq + 7)
+        self.assertEqual([row[1][-1] for row in moved['moves']], [[6, 1]])
+
+    @override_settings(OUTBOUND_WINDOW=1)
+    async def test_teleports_supersede_buffered_moves(self):
+        alice, _ = await self.join(self.alice)
+        bob, seq = await self.join(self.bob)
+        await self.move(alice, (1, 1), (2, 1), (3, 1))
+        # To the spawnpoint, the one place reachable without a teleporter tile
+        await alice.send_json_to({'type': 'teleport', 'roomIndex': 0, 'x': 5, 'y': 5})
+        await self.move(alice, (4, 4))
+        self.assertEqual([m['seq'] for m in await self.receive_all(bob)], [seq + 1])
+
+        await bob.send_json_to({'type': 'ackSeq', 'seq': seq + 1})
+        [delta] = await self.receive_all(bob)
+        self.assertEqual([e['type'] for e in delta['events']], ['playerTeleported', 'playersMoved'])
+        self.assertEqual(delta['events'][1]['moves'][0][1][-1], [4, 4])
+
+    @override_settings(OUTBOUND_WINDOW=0, OUTBOUND_MAX_BUFFERED=2)
+    async def test_overflowing_client_is_disconnected(self):
+        alice, _ = await self.join(self.alice)
+        bob, _ = await self.join(self.bob)
+        for i in range(4):
+            await alice.send_json_to({'type': 'sendMessage', 'message': str(i)})
+        output = await bob.receive_output()
+        while output['type'] != 'websocket.close':
+            output = await bob.receive_output()
+        self.assertEqual(output['code'], SLOW_CONSUMER_CLOSE_CODE)
+
+
+
+class ChatScopeTests(ConsumerTestCase):
+    async def receive_until(self, client, message_type):
+        while True:
+            message = await client.receive_json_from(timeout=2)
+            if message['type'] == message_type:
+                return message
+
+    async def test_direct_message_reaches_only_the_two_players(self):
+        alice, _ = await self.join(self.alice)
+        bob, _ = await self.join(self.bob)
+        carol, _ = await self.join(self.carol)
+        for client in (alice, bob):
+            await self.receive_all(client)
+
+        await alice.send_json_to({'type': 'sendMessage', 'scope': 'direct', 'to': str(self.bob.id), 'message': 'hi'})
+        for client in (alice, bob):
+            [chat] = await self.receive_all(client)
+            self.assertEqual(
+                (chat['type'], chat['scope'], chat['to'], chat['message']),
+                ('receiveMessage', 'direct', str(self.bob.id), 'hi')
+            )
+        self.assertEqual(await self.receive_all(carol), [])
+
+    @override_settings(PROXIMITY_RANGE=1, PROXIMITY_LEAVE_RANGE=1, PROXIMITY_DWELL_SECONDS=0)
+    async def test_proximity_message_stays_in_the_group(self):
+        alice, _ = await self.join(self.alice)
+        bob, _ = await self.join(self.bob)
+        carol, _ = await self.join(self.carol)
+        await self.move(carol, (0, 0))
+        await self.move(alice, (5, 6))
+        update = await self.receive_until(alice, 'proximityUpdate')
+        self.assertEqual((await self.receive_until(bob, 'proximityUpdate'))['proximityId'], update['proximityId'])
+        for client in (alice, bob, carol):
+            await self.receive_all(client)
+
+        await alice.send_json_to({'type': 'sendMessage', 'scope': 'proximity', 'message': 'psst'})
+        for client in (alice, bob):
+            [chat] = await self.receive_all(client)
+            self.assertEqual((chat['type'], chat['scope'], chat['message']), ('receiveMessage', 'proximity', 'psst'))
+        self.assertEqual(await self.receive_all(carol), [])
+        # The tick that announced the group stops once nothing is pending
+        session = session_manager.get_session(str(self.realm.id))
+        while session.tick_task:
+            await asyncio.sleep(0.05)
+
+    async def test_bad_scope_or_recipient_is_rejected(self):
+        alice, _ = await self.join(self.alice)
+        bob, _ = await self.join(self.bob)
+        await self.receive_all(alice)
+        cases = {
+            'Unknown chat scope': {'scope': 'everyone'},
+            'That player is not here': {'scope': 'direct', 'to': str(self.carol.id)},
+            'Nobody is near you': {'scope': 'proximity'},
+        }
+        for error, fields in cases.items():
+            with self.subTest(error):
+                await alice.send_json_to({'type': 'sendMessage', 'message': 'hi', **fields})
+                self.assertEqual(await alice.receive_json_from(), {'type': 'error', 'message': error})
+        self.assertEqual(await self.receive_all(bob), [])
+
+
+
+@override_settings(SPECTATOR_UPDATE_SECONDS=0.05)
+class SpectatorTests(ConsumerTestCase):
+    async def test_spectator_watches_without_playing(self):
+        alice, _ = await self.join(self.alice)
+        carol = await self.connect(self.carol)
+        await carol.send_json_to({'type': 'spectateRealm', 'realmId': self.realm.id})
+        watching = await carol.receive_json_from()
+        self.assertEqual(watching['type'], 'spectatingRealm')
+        self.assertEqual([row[1] for row in watching['players']], ['alice'])
+
+        session = session_manager.get_session(str(self.realm.id))
+        self.assertEqual(list(session.players), [str(self.alice.id)])
+        self.assertIsNone(session_manager.get_player_session(str(self.carol.id)))
+
+        await self.move(alice, (4, 5))
+        update = await carol.receive_json_from(timeout=1)
+        self.assertEqual((update['type'], update['moved']), ('spectatorUpdate', [[str(self.alice.id), 4, 5]]))
+        # Players are never told about spectators
+        self.assertEqual([m['type'] for m in await self.receive_all(alice)], ['playersMoved'])
+
+        await carol.disconnect()
+        while session.spectator_task:
+            await asyncio.sleep(0.05)
+
+
+class LiveOpsAdminTests(ConsumerTestCase):
+    """Kick and drain from the live sessions admin page"""
+
+    def setUp(self):
+        super().setUp()
+        self.clients = {}
+        for username, fields in (('root', {'is_staff': True, 'is_superuser': True}), ('viewer', {'is_staff': True})):
+            client = self.clients[username] = AsyncClient()
+            client.force_login(User.objects.create_user(username=username, password='x', **fields))
+        # Signed in, but not staff
+        self.clients['alice'] = AsyncClient()
+        self.clients['alice'].force_login(self.alice)
+
+    async def kick(self, username, target):
+        return await self.clients[username].post(
+            '/admin/core/realm/live/', {'realm_id': self.realm.id, 'action': 'kick', 'username': target}
+        )
+
+    async def test_only_staff_who_may_change_realms_can_kick(self):
+        alice, _ = await self.join(self.alice)
+        bob, _ = await self.join(self.bob)
+        self.assertEqual((await self.kick('alice', 'bob')).status_code, 302)
+        self.assertEqual((await self.kick('viewer', 'bob')).status_code, 403)
+        self.assertEqual((await self.clients['viewer'].get('/admin/core/realm/live/')).status_code, 403)
+        self.assertIsNotNone(session_manager.get_player_session(str(self.bob.id)))
+
+        await self.receive_all(alice)
+        self.assertEqual((await self.kick('root', 'bob')).status_code, 302)
+        self.assertEqual(await bob.receive_json_from(), {'type': 'kicked', 'reason': mock.ANY})
+        left = await alice.receive_json_from()
+        self.assertEqual((left['type'], left['uid']), ('playerLeftRoom', str(self.bob.id)))
+        self.assertIsNone(session_manager.get_player_session(str(self.bob.id)))
+
+    async def test_drain_closes_everyone(self):
+        alice, _ = await self.join(self.alice)
+        bob, _ = await self.join(self.bob)
+        await self.receive_all(alice)
+        response = await self.clients['root'].post(
+            '/admin/core/realm/live/', {'realm_id': self.realm.id, 'action': 'drain'}
+        )
+        self.assertEqual(response.status_code, 302)
+        for client in (alice, bob):
+            self.assertEqual((await client.receive_json_from())['type'], 'kicked')
+        self.assertIsNone(session_manager.get_session(str(self.realm.id)))
+
+class RecordReplayTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        patcher = mock.patch.multiple(session_recorder, directory=self.directory, logs={}, flush_handle=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def replay(self, logs):
+        """What replay_sessions reports sending, less its timings"""
+        layer = channel_layers['default']
+        output = io.StringIO()
+        try:
+            with mock.patch.object(session_snapshots, 'store', None):
+                call_command('replay_sessions', *logs, stdout=output)
+        finally:
+            channel_layers.set('default', layer)
+        return [line for line in output.getvalue().splitlines() if not line.startswith(('replayed:', 'events:'))]
+
+    async def test_replay_is_repeatable(self):
+        alice, _ = await self.join(self.alice)
+        bob, _ = await self.join(self.bob)
+        await self.move(alice, (4, 5), (3, 5), (3, 4))
+        await bob.send_json_to({'type': 'sendMessage', 'message': 'hi'})
+        for client in (alice, bob):
+            await self.receive_all(client)
+            await client.disconnect(code=1000)
+        session_recorder.flush_handle.cancel()
+        session_recorder.flush_all()
+
+        logs = [str(path) for path in self.directory.glob('*.grl')]
+        self.assertEqual(len(logs), 1)
+        first = await asyncio.to_thread(self.replay, logs)
+        self.assertEqual(await asyncio.to_thread(self.replay, logs), first)
+        sent = dict(line.split(None, 1) for line in first if line.startswith('  '))
+        # Three steps to each player, one chat line to each
+        self.assertEqual(sent['players_moved'].split()[0], '6')
+        self.assertEqual(sent['chat_message'].split()[0], '2')
+
+class MapRulesTests(ConsumerTestCase):
+    async def test_moves_off_the_map_are_rejected(self):
+        alice, _ = await self.join(self.alice)
+        bob, _ = await self.join(self.bob)
+        await self.receive_all(alice)
+        await self.move(alice, (50, 50))
+        # The batch still goes out, putting alice back where she was
+        [moved] = await self.receive_all(bob)
+        self.assertEqual(moved['moves'][0][1], [[5, 5]])
+
+    async def test_invalid_teleports_change_nothing(self):
+        alice, _ = await self.join(self.alice)
+        bob, _ = await self.join(self.bob)
+        await self.receive_all(alice)
+        targets = [
+            {'roomIndex': 'zz', 'x': 0, 'y': 0},
+            {'roomIndex': 1, 'x': 0, 'y': 0},
+            # Walkable, but there is no teleporter to it
+            {'roomIndex': 0, 'x': 1, 'y': 1},
+        ]
+        for target in targets:
+            with self.subTest(target):
+                await alice.send_json_to({'type': 'teleport', **target})
+                self.assertEqual(await alice.receive_json_from(), {'type': 'error', 'message': 'Invalid teleport'})
+        self.assertEqual(await self.receive_all(bob), [])
+        player = session_manager.get_player_session(str(self.alice.id)).get_player(str(self.alice.id))
+        self.assertEqual((player['room'], player['x'], player['y']), (0, 5, 5))
+
+
+
+@override_settings(PROXIMITY_RANGE=3, PROXIMITY_LEAVE_RANGE=5, PROXIMITY_DWELL_SECONDS=0.05)
+class ProximityTests(SimpleTestCase):
+    """Video chat groups, worked out by a session with nobody connected"""
+
+    def session(self, map_data=TEST_MAP):
+        """A session with players a at (0, 0) and b at (9, 0)"""
+        session = Session('1', compile_map(map_data)[1])
+        for uid, x in (('a', 0), ('b', 9)):
+            session.add_player(None, uid, uid, '009')
+            session.move_player(uid, x, 0)
+        return session
+
+    def test_groups_are_joined_near_and_left_far(self):
+        session = self.session()
+        self.assertEqual(sorted(session.move_player('b', 3, 0)), ['a', 'b'])
+        group = session.players['a']['proximity_id']
+        self.assertEqual(session.players['b']['proximity_id'], group)
+        # Between the two ranges nothing changes
+        for x in (4, 5, 4):
+            self.assertEqual(session.move_player('b', x, 0), [])
+            self.assertEqual(session.players['b']['proximity_id'], group)
+        self.assertEqual(session.move_player('b', 6, 0), ['b'])
+        self.assertIsNone(session.players['b']['proximity_id'])
+
+    async def test_change_is_announced_once_it_holds(self):
+        session = self.session()
+        session.note_proximity_changes(session.move_player('b', 3, 0))
+        self.assertEqual(session.settle_proximity(), [])
+        await asyncio.sleep(0.06)
+        self.assertEqual(sorted(p['uid'] for p in session.settle_proximity()), ['a', 'b'])
+        self.assertEqual(session.settle_proximity(), [])
+
+    async def test_crossing_an_edge_and_back_is_not_announced(self):
+        session = self.session()
+        session.note_proximity_changes(session.move_player('b', 3, 0))
+        session.note_proximity_changes(session.move_player('b', 9, 0))
+        await asyncio.sleep(0.06)
+        self.assertNotIn('b', [p['uid'] for p in session.settle_proximity()])
+
+
+def with_zone(map_data, zone, columns):
+    """A copy of the map with these columns of its first room in a private area"""
+    rooms = [dict(room, tilemap=dict(room['tilemap'])) for room in map_data['rooms']]
+    for key, tile in rooms[0]['tilemap'].items():
+        if int(key.split(',')[0]) in columns:
+            rooms[0]['tilemap'][key] = {**tile, 'privateAreaId': zone}
+    return {**map_data, 'rooms': rooms}
+
+
+@override_settings(PROXIMITY_RANGE=3, PROXIMITY_LEAVE_RANGE=5)
+class ZoneTests(SimpleTestCase):
+    def setUp(self):
+        self.session = Session('1', compile_map(with_zone(TEST_MAP, 'meeting', (0, 1)))[1])
+        for uid in ('a', 'b', 'c'):
+            self.session.add_player(None, uid, uid, '009')
+
+    def test_zone_grid(self):
+        self.assertEqual(self.session.zone_at(0, 1, 9), 'meeting')
+        self.assertIsNone(self.session.zone_at(0, 2, 0))
+        self.assertIsNone(self.session.zone_at(0, -1, 0))
+
+    def test_everyone_inside_shares_one_group(self):
+        self.session.move_player('a', 0, 0)
+        self.session.move_player('b', 1, 9)
+        group = self.session.players['a']['proximity_id']
+        self.assertEqual(self.session.players['b']['proximity_id'], group)
+        self.assertTrue(group.startswith('zone-'))
+
+    def test_players_outside_are_not_let_in(self):
+        self.session.move_player('a', 1, 0)
+        self.session.move_player('b', 2, 0)
+        self.assertIsNone(self.session.players['b']['proximity_id'])
+        # Outside, grouping by distance goes on as usual
+        self.session.move_player('c', 3, 0)
+        self.assertEqual(self.session.players['b']['proximity_id'], self.session.players['c']['proximity_id'])
+        self.assertNotEqual(self.session.players['c']['proximity_id'], self.session.players['a']['proximity_id'])
+
+    def test_bad_zone_ids_are_rejected(self):
+        for zone in ('', 'x' * 65, 7):
+            with self.subTest(zone=zone), self.assertRaises(MapValidationError):
+                normalize_map(with_zone(TEST_MAP, zone, (0,)))
+
+class NormalizeMapTests(TestCase):
+    def test_rewrites_tile_keys(self):
+        normalized = normalize_map({
+            'spawnpoint': {'roomIndex': 0, 'x': 1, 'y': 2},
+            'rooms': [{'name': 'Main', 'tilemap': {' 1 ,2': {'floor': 'grass'}}}],
+        })
+        self.assertEqual(list(normalized['rooms'][0]['tilemap']), ['1, 2'])
+
+    def test_rejects_maps_off_the_schema(self):
+        spawn = {'roomIndex': 0, 'x': 0, 'y': 0}
+        floor = {'0, 0': {'floor': 'grass'}}
+        cases = {
+            'not an object': [],
+            'no rooms': {'spawnpoint': spawn, 'rooms': []},
+            'room not an object': {'spawnpoint': spawn, 'rooms': ['Main']},
+            'name not a string': {'spawnpoint': spawn, 'rooms': [{'name': 1, 'tilemap': {}}]},
+            'bad tile key': {'spawnpoint': spawn, 'rooms': [{'tilemap': {'a, b': {}}}]},
+            'tile not an object': {'spawnpoint': spawn, 'rooms': [{'tilemap': {'0, 0': 'grass'}}]},
+            'impassable not a bool': {'spawnpoint': spawn, 'rooms': [{'tilemap': {'0, 0': {'impassable': 'yes'}}}]},
+            'teleporter to a missing room': {'spawnpoint': spawn, 'rooms': [{'tilemap': {
+                **floor, '1, 0': {'teleporter': {'roomIndex': 3, 'x': 0, 'y': 0}},
+            }}]},
+            'teleporter without coordinates': {'spawnpoint': spawn, 'rooms': [{'tilemap': {
+                **floor, '1, 0': {'teleporter': {'roomIndex': 0, 'x': 'zz', 'y': 0}},
+            }}]},
+            'too wide': {'spawnpoint': spawn, 'rooms': [{'tilemap': {**floor, '600, 0': {}}}]},
+            'no spawnpoint': {'rooms': [{'tilemap': floor}]},
+            'spawnpoint off the map': {'spawnpoint': {**spawn, 'x': 5}, 'rooms': [{'tilemap': floor}]},
+            'spawnpoint in a wall': {'spawnpoint': spawn, 'rooms': [{'tilemap': {'0, 0': {'impassable': True}}}]},
+        }
+        for case, map_data in cases.items():
+            with self.subTest(case), self.assertRaises(MapValidationError):
+                normalize_map(map_data)
+
+    @override_settings(MAP_MAX_ROOMS=2)
+    def test_rejects_too_many_rooms(self):
+        rooms = [{'tilemap': {}} for _ in range(3)]
+        with self.assertRaises(MapValidationError):
+            normalize_map({'spawnpoint': {'roomIndex': 0, 'x': 0, 'y': 0}, 'rooms': rooms})
+
+    def test_compiled_map_matches_its_tiles(self):
+        map_data, artifacts = compile_map(TEST_MAP)
+        self.assertEqual(artifacts['map_version'], map_version(map_data))
+        # Unchanged maps keep the artifacts they were given
+        self.assertIs(compile_map(map_data, artifacts)[1], artifacts)
+
+
+
+class MapImportTests(SimpleTestCase):
+    def exported(self, map_data, compress=False):
+        chunks = iter_export('Office', map_data)
+        return io.BytesIO(b''.join(iter_gzip(chunks) if compress else chunks))
+
+    def test_round_trip(self):
+        for compress in (False, True):
+            with self.subTest(compress=compress):
+                name, map_data = read_import(self.exported(TEST_MAP, compress))
+                self.assertEqual((name, map_data), ('Office', normalize_map(TEST_MAP)))
+                # Normalized while reading, so not copied again on save
+                self.assertIs(normalize_map(map_data), map_data)
+
+    def test_bad_room_is_rejected(self):
+        bad = {**TEST_MAP, 'rooms': [{'tilemap': {'a, b': {}}}]}
+        with self.assertRaisesMessage(MapValidationError, 'Bad tile key'):
+            read_import(self.exported(bad))
+
+    def test_size_cap(self):
+        with self.assertRaisesMessage(MapValidationError, 'larger than'):
+            read_import(self.exported(TEST_MAP), max_bytes=1024)
+
+    def test_gzip_bomb_stops_at_the_cap(self):
+        bomb = io.BytesIO(gzip.compress(b'\n' * (16 * 1024 * 1024)))
+        self.assertLess(len(bomb.getvalue()), 64 * 1024)
+        with self.assertRaisesMessage(MapValidationError, 'larger than'):
+            read_import(bomb, max_bytes=1024 * 1024)
+
+    def test_truncated_gzip(self):
+        data = self.exported(TEST_MAP, compress=True).getvalue()
+        with self.assertRaises(MapValidationError):
+            read_import(io.BytesIO(data[:len(data) // 2]))
+
+
+class BuildAtlasTests(SimpleTestCase):
+    def test_packs_every_sheet(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = Path(directory) / 'atlas'
+            call_command('build_atlas', output=str(output), stdout=io.StringIO())
+            manifest = json.loads(output.with_suffix('.json').read_text())
+            with Image.open(output.with_suffix('.png')) as atlas:
+                self.assertEqual(list(atlas.size), manifest['size'])
+                x, y = manifest['skins']['009']
+                width, height = manifest['cell']
+                cell = atlas.convert('RGBA').crop((x, y, x + width, y + height))
+        sheets = Path(settings.BASE_DIR) / 'static' / 'sprites' / 'characters'
+        self.assertEqual(len(manifest['skins']), len(list(sheets.glob('Character_*.png'))))
+        with Image.open(sheets / 'Character_009.png') as sheet:
+            self.assertEqual(cell.tobytes(), sheet.convert('RGBA').tobytes())
+
+@override_settings(STORAGES=TEST_STORAGES, REALM_PAGE_SIZE=2)
+class RealmListTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', password='x')
+        self.client.force_login(self.owner)
+
+    def create_realms(self, count):
+        realms = [Realm.objects.create(owner=self.owner, name=f'Realm {i}', map_data=TEST_MAP) for i in range(count)]
+        # Ties on created_at are broken by id
+        Realm.objects.filter(pk__in=[r.pk for r in realms[1:4]]).update(created_at=timezone.now())
+        return realms
+
+    def test_realm_list_pages_by_cursor(self):
+        realms = self.create_realms(5)
+        expected = [r.pk for r in Realm.objects.filter(owner=self.owner).order_by('-created_at', '-id')]
+        seen, cursor, pages = [], None, 0
+        while True:
+            response = self.client.get('/api/realms/', {'cursor': cursor} if cursor else {})
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            seen += [realm['id'] for realm in page['realms']]
+            pages += 1
+            cursor = page['next']
+            if not cursor:
+                break
+        self.assertEqual(seen, expected)
+        self.assertEqual(sorted(seen), sorted(r.pk for r in realms))
+        self.assertEqual(pages, 3)
+
+    def test_realms_created_after_a_page_do_not_shift_the_next(self):
+        self.create_realms(3)
+        first = self.client.get('/api/realms/').json()
+        Realm.objects.create(owner=self.owner, name='Newer', map_data=TEST_MAP)
+        second = self.client.get('/api/realms/', {'cursor': first['next']}).json()
+        listed = [realm['id'] for realm in first['realms'] + second['realms']]
+        self.assertEqual(len(listed), 3)
+        self.assertEqual(len(set(listed)), 3)
+
+    def test_bad_cursor(self):
+        response = self.client.get('/api/realms/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cursor_round_trip(self):
+        realm, = self.create_realms(1)
+        self.assertEqual(decode_cursor(encode_cursor(realm)), (realm.created_at, realm.pk))
+
+    def test_admin_search_matches_anywhere_in_names_and_owners(self):
+        self.create_realms(1)
+        other = User.objects.create_user(username='someone', password='x')
+        Realm.objects.create(owner=other, name='Lobby', map_data=TEST_MAP)
+        admin = User.objects.create_superuser(username='admin', password='x')
+        self.client.force_login(admin)
+        for term, names in [('ealm', ['Realm 0']), ('OBB', ['Lobby']), ('meon', ['Lobby']), ('wne', ['Realm 0'])]:
+            with self.subTest(term):
+                response = self.client.get('/admin/core/realm/', {'q': term})
+                self.assertEqual([realm.name for realm in response.context['cl'].result_list], names)
+
+
+
+class PresenceViewTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(presence_index, 'workers', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.owner = User.objects.create_user(username='owner', password='x')
+        other = User.objects.create_user(username='other', password='x')
+        self.mine = Realm.objects.create(owner=self.owner, name='Mine', map_data=TEST_MAP)
+        self.visited = Realm.objects.create(owner=other, name='Visited', map_data=TEST_MAP)
+        self.stranger = Realm.objects.create(owner=other, name='Stranger', map_data=TEST_MAP)
+        self.owner.profile.visited_realms = [str(self.visited.share_id)]
+        self.owner.profile.save()
+        self.client.force_login(self.owner)
+        for realm in (self.mine, self.stranger):
+            presence_index.update(realm.id, [{'username': 'bob'}, {'username': 'alice'}])
+
+    def presence(self, ids, **headers):
+        return self.client.get('/api/realms/presence/', {'ids': ids, 'usernames': '1'}, headers=headers)
+
+    def test_counts_for_dashboard_realms_only(self):
+        response = self.presence(f'{self.mine.id},{self.visited.id},{self.stranger.id}')
+        self.assertEqual(response.json(), {'realms': {
+            str(self.mine.id): {'count': 2, 'usernames': ['alice', 'bob']},
+            str(self.visited.id): {'count': 0, 'usernames': []},
+        }})
+        self.assertEqual(self.presence(f'{self.mine.id}', if_none_match=response['ETag']).status_code, 200)
+        etag = self.presence(f'{self.mine.id}')['ETag']
+        self.assertEqual(self.presence(f'{self.mine.id}', if_none_match=etag).status_code, 304)
+
+    def test_bad_ids(self):
+        self.assertEqual(self.presence('1,x').status_code, 400)
+
+@override_settings(COMPRESS_MIN_BYTES=100)
+class CompressionTests(SimpleTestCase):
+    def respond(self, accept_encoding, content_type='application/json', size=1000):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        middleware = CompressionMiddleware(lambda request: HttpResponse('x' * size, content_type=content_type))
+        return middleware(request)
+
+    def test_parse_accept_encoding(self):
+        self.assertEqual(parse_accept_encoding('gzip, br;q=0.5, deflate;q=0, *;q=x'), {'gzip', 'br'})
+
+    def test_brotli_when_accepted(self):
+        response = self.respond('gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.content), b'x' * 1000)
+
+    def test_gzip_when_brotli_is_refused(self):
+        for accept_encoding in ('gzip, br;q=0', 'gzip, br;q=0.0', 'gzip'):
+            with self.subTest(accept_encoding):
+                self.assertEqual(self.respond(accept_encoding)['Content-Encoding'], 'gzip')
+
+    def test_html_is_never_brotli(self):
+        self.assertEqual(self.respond('br, gzip', content_type='text/html')['Content-Encoding'], 'gzip')
+
+    def test_small_and_binary_responses_are_left_alone(self):
+        self.assertFalse(self.respond('br', size=10).has_header('Content-Encoding'))
+        self.assertFalse(self.respond('br', content_type='image/png').has_header('Content-Encoding'))
+
+
+def edited(map_data, x, y):
+    """A copy of the map with one more floor tile in its first room"""
+    rooms = [dict(room, tilemap=dict(room['tilemap'])) for room in map_data['rooms']]
+    rooms[0]['tilemap'][f'{x}, {y}'] = {'floor': 'grass'}
+    return {**map_data, 'rooms': rooms}
+
+
+class MapBlobTests(TestCase):
+    """Realms share one stored map per distinct map, counted by refcount"""
+
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', password='x')
+        self.realm = Realm.objects.create(owner=self.owner, name='Office', map_data=TEST_MAP)
+
+    def refcount(self, realm):
+        return MapBlob.objects.get(hash=realm.map_blob_id).refcount
+
+    def test_equal_maps_share_a_blob(self):
+        # Tile keys are normalized before hashing
+        room = {**TEST_MAP['rooms'][0], 'tilemap': {
+            key.replace(' ', ''): tile for key, tile in TEST_MAP['rooms'][0]['tilemap'].items()
+        }}
+        other = Realm.objects.create(owner=self.owner, name='Copy', map_data={**TEST_MAP, 'rooms': [room]})
+        self.assertEqual(other.map_blob_id, self.realm.map_blob_id)
+        self.assertEqual(self.refcount(self.realm), 2)
+
+    def test_clones_share_the_source_blob(self):
+        clones = clone_realm(self.realm, self.owner, 'Clone', count=3)
+        self.assertEqual({clone.map_blob_id for clone in clones}, {self.realm.map_blob_id})
+        self.assertEqual(self.refcount(self.realm), 4)
+        self.assertEqual(MapBlob.objects.count(), 1)
+
+    def test_editing_a_clone_moves_it_to_a_new_blob(self):
+        clone, = clone_realm(self.realm, self.owner, 'Clone')
+        clone = Realm.objects.get(pk=clone.pk)
+        clone.map_data = edited(TEST_MAP, 20, 20)
+        clone.save()
+        self.assertNotEqual(clone.map_blob_id, self.realm.map_blob_id)
+        self.assertEqual(self.refcount(self.realm), 1)
+        self.assertEqual(self.refcount(clone), 1)
+
+        clone.delete()
+        self.assertFalse(MapBlob.objects.filter(hash=clone.map_blob_id).exists())
+        self.assertEqual(self.refcount(self.realm), 1)
+
+    def test_saving_an_unchanged_map_keeps_the_count(self):
+        self.realm.map_data = TEST_MAP
+        self.realm.save()
+        self.assertEqual(self.refcount(self.realm), 1)
+
+    def test_deleting_the_last_realm_deletes_the_blob(self):
+        clone, = clone_realm(self.realm, self.owner, 'Clone')
+        self.realm.delete()
+        self.assertEqual(self.refcount(clone), 1)
+        clone.delete()
+        self.assertFalse(MapBlob.objects.exists())
+
+    def test_invalid_maps_are_not_stored(self):
+        with self.assertRaises(MapValidationError):
+            Realm.objects.create(owner=self.owner, name='Broken', map_data={'rooms': []})
+        self.assertEqual(MapBlob.objects.count(), 1)
+
+
+
+@override_settings(STORAGES=TEST_STORAGES)
+class RealmDataTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', password='x')
+        Profile.objects.filter(user=self.owner).update(skin='012')
+        self.realm = Realm.objects.create(owner=self.owner, name='Office', map_data=TEST_MAP)
+
+    def get_realm_data(self, realm_id):
+        handlers = SimpleNamespace(user=self.owner)
+        return async_to_sync(PlayerHandlers.get_realm_data)(handlers, str(realm_id))
+
+    @mock.patch.object(map_artifact_cache, 'entries', OrderedDict())
+    def test_join_reads_one_row_once_the_map_is_cached(self):
+        # The realm with the joining player's skin, then the map
+        with self.assertNumQueries(2):
+            artifacts, owner_id, only_owner, skin = self.get_realm_data(self.realm.id)
+        self.assertEqual((artifacts['map_version'], owner_id, skin), (self.realm.map_blob_id, self.owner.id, '012'))
+        with self.assertNumQueries(1):
+            self.assertIs(self.get_realm_data(self.realm.id)[0], artifacts)
+
+    def test_missing_realm(self):
+        self.assertEqual(self.get_realm_data(self.realm.id + 1), (None, None, None, None))
+
+
+@override_settings(HEATMAP_TILE_PIXELS=4)
+class HeatmapTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', password='x')
+        self.client.force_login(self.owner)
+        self.realm = Realm.objects.create(owner=self.owner, name='Office', map_data=TEST_MAP)
+        self.recorder = HeatmapRecorder(list)
+        self.now = timezone.now()
+
+    def record(self, bounds, tiles, hours_ago=0):
+        """Store visits to these tiles as one flush, ``hours_ago``"""
+        heat = RoomHeat(bounds)
+        for x, y in tiles:
+            heat.visit(x, y)
+        self.recorder.write([(self.realm.id, 0, bounds, *heat.take())], self.now - timedelta(hours=hours_ago))
+
+    def test_counts_outside_the_room_are_dropped(self):
+        heat = RoomHeat([0, 0, 2, 2])
+        self.assertIsNone(heat.take())
+        heat.visit(1, 1)
+        heat.visit(2, 0)
+        heat.sample(-1, 0)
+        self.assertEqual([list(grid) for grid in heat.take()], [[0, 0, 0, 1], [0, 0, 0, 0]])
+        self.assertIsNone(heat.take())
+
+    def test_flushes_add_up_over_the_hours_asked_for(self):
+        self.record([0, 0, 2, 2], [(0, 0), (1, 1)])
+        # After the map grew, in the same hour
+        self.record([1, 1, 2, 2], [(2, 2), (1, 1)])
+        self.record([0, 0, 2, 2], [(0, 0)], hours_ago=48)
+        self.assertEqual(self.realm.heatmaps.count(), 2)
+
+        bounds, counts = load_heatmap(self.realm.id, 0, 'visits', 24)
+        self.assertEqual((bounds, list(counts)), ([0, 0, 3, 3], [1, 0, 0, 0, 2, 0, 0, 0, 1]))
+        self.assertEqual(load_heatmap(self.realm.id, 0, 'visits', 72)[1][0], 2)
+        self.assertIsNone(load_heatmap(self.realm.id, 1, 'visits', 24))
+
+    def test_view(self):
+        url = f'/api/realms/{self.realm.id}/heatmap/'
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.record([0, 0, 3, 2], [(0, 0)])
+
+        response = self.client.get(url, {'metric': 'visits'})
+        self.assertEqual(response['Content-Type'], 'image/png')
+        with Image.open(io.BytesIO(response.content)) as image:
+            self.assertEqual(image.size, (12, 8))
+        self.assertEqual(self.client.get(url, {'metric': 'speed'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'hours': 'all'}).status_code, 400)
+
+        other = User.objects.create_user(username='other', password='x')
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+class RealmCloneViewTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner', password='x')
+        self.client.force_login(self.owner)
+        self.realm = Realm.objects.create(owner=self.owner, name='Office', map_data=TEST_MAP)
+
+    def test_clone_shares_the_map(self):
+        response = self.client.post(f'/api/realms/{self.realm.pk}/clone/', {'count': 3}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['realms']), 3)
+        self.assertEqual(MapBlob.objects.get().refcount, 4)
+
+    def test_clone_count_is_bounded(self):
+        response = self.client.post(f'/api/realms/{self.realm.pk}/clone/', {'count': 0}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_others_realms_cannot_be_cloned(self):
+        other = User.objects.create_user(username='other', password='x')
+        theirs = Realm.objects.create(owner=other, name='Theirs', map_data=TEST_MAP)
+        response = self.client.post(f'/api/realms/{theirs.pk}/clone/', content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_create_from_template(self):
+        other = User.objects.create_user(username='other', password='x')
+        template = Realm.objects.create(owner=other, name='Template', map_data=TEST_MAP, is_template=True)
+        response = self.client.post(
+            '/api/realms/create/', {'name': 'Mine', 'template_id': template.pk}, content_type='application/json'
+        )
+        realm = Realm.objects.get(pk=response.json()['realm_id'])
+        self.assertEqual(realm.map_blob_id, template.map_blob_id)
+        self.assertEqual(MapBlob.objects.get().refcount, 3)
+
+    def test_create_from_missing_template(self):
+        other = User.objects.create_user(username='other', password='x')
+        theirs = Realm.objects.create(owner=other, name='Theirs', map_data=TEST_MAP)
+        for template_id in (theirs.pk, theirs.pk + 1):
+            response = self.client.post(
+                '/api/realms/create/', {'name': 'Mine', 'template_id': template_id}, content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 404)
+        self.assertEqual(Realm.objects.count(), 2)
+
+    def test_save_and_delete_release_the_map(self):
+        clone, = clone_realm(self.realm, self.owner, 'Clone')
+        response = self.client.post(
+            f'/api/realms/{clone.pk}/save/', {'map_data': edited(TEST_MAP, 20, 20)}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(MapBlob.objects.values_list('refcount', flat=True)), [1, 1])
+
+        self.client.post(f'/api/realms/{clone.pk}/delete/')
+        self.assertEqual(list(MapBlob.objects.values_list('hash', flat=True)), [self.realm.map_blob_id])
@@ -12,10 +12,19 @@ urlpatterns = [
     path('intro/<int:realm_id>/', views.intro, name='intro'),
     path('edit/<int:realm_id>/', views.edit_realm, name='edit_realm'),
     path('join/<uuid:share_id>/', views.join_by_share_id, name='join_by_share'),
+    path('api/realms/', views.list_realms, name='list_realms'),
     path('api/realms/create/', views.create_realm, name='create_realm'),
+    path('api/realms/import/', views.import_realm, name='import_realm'),
+    path('api/realms/presence/', views.realm_presence, name='realm_presence'),
+    path('api/realms/templates/', views.list_templates, name='list_templates'),
     path('api/realms/<int:realm_id>/', views.get_realm, name='get_realm'),
     path('api/realms/<int:realm_id>/save/', views.save_realm_map, name='save_realm_map'),
+    path('api/realms/<int:realm_id>/export/', views.export_realm, name='export_realm'),
+    path('api/realms/<int:realm_id>/import/', views.import_realm_map, name='import_realm_map'),
+    path('api/realms/<int:realm_id>/heatmap/', views.realm_heatmap, name='realm_heatmap'),
+    path('api/realms/<int:realm_id>/clone/', views.duplicate_realm, name='duplicate_realm'),
     path('api/realms/<int:realm_id>/delete/', views.delete_realm, name='delete_realm'),
     path('api/realms/<int:realm_id>/toggle-privacy/', views.toggle_realm_privacy, name='toggle_realm_privacy'),
     path('api/profile/update/', views.update_profile, name='update_profile'),
+    path('api/skins/', views.skin_catalog, name='skin_catalog'),
 ]
@@ -2,27 +2,24 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.http import JsonResponse
-from django.views.decorators.http import require_http_methods
+from django.conf import settings
+from django.db.models import Q
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.cache import cache_control
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.views.decorators.http import etag, require_http_methods
 from .forms import SignUpForm, SignInForm
-from .models import Realm, Profile
+from .models import Realm, Profile, clone_realm
+from .consumers import realm_router
+from .heatmaps import METRICS, latest_update, load_heatmap, render_heatmap
+from .pagination import keyset_page
+from .presence import presence_index, visible_realm_ids
+from .skins import get_catalog
+from .map_stream import as_async, iter_export, iter_gzip, read_import
+import hashlib
 import json
 
-# Available character skins
-AVAILABLE_SKINS = [
-    '001', '002', '003', '004', '005', '006', '007', '008', '009',
-    '010', '011', '012', '013', '014', '015', '016', '017', '018',
-    '019', '020', '021', '022', '023', '024', '025', '026', '027',
-    '028', '029', '030', '031', '032', '033', '034', '035', '036',
-    '037', '038', '039', '040', '041', '042', '043', '044', '045',
-    '046', '047', '048', '049', '050', '051', '052', '053', '054',
-    '055', '056', '057', '058', '059', '060', '061', '062', '063',
-    '064', '065', '066', '067', '068', '069', '070', '071', '072',
-    '073', '074', '075', '076', '077', '078', '079', '080', '081',
-    '082', '083'
-]
-
-
 def home(request):
     """Landing page"""
     if request.user.is_authenticated:
@@ -74,32 +71,78 @@ def signout(request):
     return redirect('home')
 
 
+# Realm fields listings show; maps stay in the database
+REALM_LIST_FIELDS = ('id', 'name', 'share_id', 'only_owner', 'created_at', 'owner_id')
+
+
+def listed_realms(user, visited=False):
+    """The user's own realms, or the others they have visited"""
+    if not visited:
+        return Realm.objects.filter(owner=user).only(*REALM_LIST_FIELDS)
+    visited_realm_ids = [str(sid) for sid in user.profile.visited_realms]
+    return Realm.objects.filter(share_id__in=visited_realm_ids).exclude(owner=user).select_related(
+        'owner'
+    ).only(*REALM_LIST_FIELDS, 'owner__username')
+
+
+def realm_templates():
+    """Realms marked is_template, which anyone can start a realm from"""
+    return Realm.objects.filter(is_template=True).only('id', 'name').order_by('name', 'id')
+
+
+def clone_source(user, realm_id):
+    """A realm the user may copy: one of their own, or a template"""
+    return get_object_or_404(
+        Realm.objects.filter(Q(owner=user) | Q(is_template=True)).only('id', 'name', 'map_blob_id'),
+        id=realm_id
+    )
+
+
+def page_link(request, key, cursor):
+    """This page's query string with one cursor replaced (or dropped for None)"""
+    query = request.GET.copy()
+    query.pop(key, None)
+    if cursor:
+        query[key] = cursor
+    return f'?{query.urlencode()}'
+
+
 @login_required
 def dashboard(request):
-    """Dashboard with realm list"""
-    realms = Realm.objects.filter(owner=request.user)
-    
-    # Get visited realms
-    profile = request.user.profile
-    visited_realm_ids = [str(sid) for sid in profile.visited_realms]
-    visited_realms = Realm.objects.filter(share_id__in=visited_realm_ids).exclude(owner=request.user)
+    """Dashboard with realm list, a page of owned and of visited realms at a time"""
+    try:
+        realms, realms_next = keyset_page(
+            listed_realms(request.user), request.GET.get('after'), settings.REALM_PAGE_SIZE
+        )
+        visited_realms, visited_next = keyset_page(
+            listed_realms(request.user, visited=True), request.GET.get('visited_after'), settings.REALM_PAGE_SIZE
+        )
+    except ValueError:
+        return redirect('dashboard')
     
     return render(request, 'app/dashboard.html', {
         'realms': realms,
-        'visited_realms': visited_realms
+        'templates': realm_templates(),
+        'visited_realms': visited_realms,
+        'realms_next': realms_next and page_link(request, 'after', realms_next),
+        'realms_first': 'after' in request.GET and page_link(request, 'after', None),
+        'visited_next': visited_next and page_link(request, 'visited_after', visited_next),
+        'visited_first': 'visited_after' in request.GET and page_link(request, 'visited_after', None),
     })
 
 
 @login_required
 def play(request, realm_id):
     """Game page"""
-    realm = get_object_or_404(Realm, id=realm_id)
+    realm = get_object_or_404(Realm.objects.select_related('map_blob'), id=realm_id)
     return render(request, 'play/play.html', {
         'realm': realm,
         'realm_id': realm_id,
         'user_id': request.user.id,
         'username': request.user.username,
-        'skin': request.user.profile.skin
+        'skin': get_catalog().resolve(request.user.profile.skin),
+        # ?spectate=1 watches the realm without taking a player's place
+        'spectate': request.GET.get('spectate') == '1'
     })
 
 
@@ -109,7 +152,23 @@ def create_realm(request):
     """Create a new realm"""
     try:
         data = json.loads(request.body)
+        template_id = data.get('template_id')
+        if template_id:
+            template_id = int(template_id)
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    # Outside the try, so a missing template is a 404 rather than a 400
+    template = clone_source(request.user, template_id) if template_id else None
+    try:
         name = data.get('name', 'My Realm')
+        if template:
+            # Starts out sharing the template's stored map; see MapBlob
+            realm, = clone_realm(template, request.user, name)
+            return JsonResponse({
+                'success': True,
+                'realm_id': realm.id,
+                'share_id': str(realm.share_id)
+            })
         map_data = data.get('map_data', {})
         
         realm = Realm.objects.create(
@@ -127,17 +186,81 @@ def create_realm(request):
         return JsonResponse({'success': False, 'error': str(e)}, status=400)
 
 
+@login_required
+@require_http_methods(["POST"])
+def duplicate_realm(request, realm_id):
+    """Copy one of the user's realms, or a template, ``count`` times.
+    
+    The copies share the source's stored map until each is edited, so
+    even a large batch is one row per realm.
+    """
+    source = clone_source(request.user, realm_id)
+    try:
+        data = json.loads(request.body or '{}')
+        count = int(data.get('count', 1))
+    except (ValueError, TypeError):
+        return JsonResponse({'success': False, 'error': 'count must be a number'}, status=400)
+    if not 1 <= count <= settings.REALM_CLONE_MAX:
+        return JsonResponse({
+            'success': False, 'error': f'count must be between 1 and {settings.REALM_CLONE_MAX}'
+        }, status=400)
+    name = str(data.get('name') or f'{source.name} (copy)')[:100]
+    try:
+        realms = clone_realm(source, request.user, name, count)
+    except Realm.DoesNotExist as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=404)
+    return JsonResponse({
+        'success': True,
+        'realms': [{'realm_id': realm.id, 'share_id': str(realm.share_id)} for realm in realms]
+    })
+
+
+@login_required
+@require_http_methods(["GET"])
+def list_templates(request):
+    """Realms new realms can be created from, by ``template_id``"""
+    return JsonResponse({
+        'templates': [{'id': realm.id, 'name': realm.name} for realm in realm_templates()]
+    })
+
+
+@login_required
+@require_http_methods(["GET"])
+def list_realms(request):
+    """A page of the user's realms, newest first: ?visited=1 for the ones
+    they visited, ?cursor= from the previous page's ``next``"""
+    visited = request.GET.get('visited') == '1'
+    try:
+        realms, next_cursor = keyset_page(
+            listed_realms(request.user, visited), request.GET.get('cursor'), settings.REALM_PAGE_SIZE
+        )
+    except ValueError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    return JsonResponse({
+        'realms': [{
+            'id': realm.id,
+            'name': realm.name,
+            'share_id': str(realm.share_id),
+            'only_owner': realm.only_owner,
+            'created_at': realm.created_at.isoformat(),
+            'owner_id': realm.owner_id,
+            **({'owner': realm.owner.username} if visited else {})
+        } for realm in realms],
+        'next': next_cursor
+    })
+
+
 @login_required
 def get_realm(request, realm_id):
     """Get realm data"""
-    realm = get_object_or_404(Realm, id=realm_id)
+    realm = get_object_or_404(Realm.objects.select_related('map_blob'), id=realm_id)
     return JsonResponse({
         'id': realm.id,
         'name': realm.name,
         'share_id': str(realm.share_id),
         'map_data': realm.map_data,
         'only_owner': realm.only_owner,
-        'owner_id': realm.owner.id
+        'owner_id': realm.owner_id
     })
 
 
@@ -150,6 +273,8 @@ def update_profile(request):
         profile = request.user.profile
         
         if 'skin' in data:
+            if data['skin'] not in get_catalog():
+                return JsonResponse({'success': False, 'error': 'Unknown skin'}, status=400)
             profile.skin = data['skin']
         
         if 'visited_realms' in data:
@@ -161,20 +286,97 @@ def update_profile(request):
         return JsonResponse({'success': False, 'error': str(e)}, status=400)
 
 
+@login_required
+@require_http_methods(["GET"])
+def realm_presence(request):
+    """Live player counts: ?ids=1,2,3 for many realms in one request.
+    
+    Realms the user does not own or has not visited are left out. Add
+    usernames=1 for a few of the players' names too.
+    """
+    try:
+        realm_ids = [int(i) for i in request.GET.get('ids', '').split(',') if i]
+    except ValueError:
+        return JsonResponse({'error': 'ids must be comma-separated realm ids'}, status=400)
+    realm_ids = realm_ids[:settings.PRESENCE_MAX_REALMS]
+    with_usernames = request.GET.get('usernames') == '1'
+    
+    # Other workers' counts arrive once this one has joined the cluster
+    realm_router.start_once()
+    counts = presence_index.lookup(sorted(visible_realm_ids(request.user, realm_ids), key=int))
+    realms = {}
+    for realm_id, (count, usernames) in counts.items():
+        realms[realm_id] = {'count': count}
+        if with_usernames:
+            realms[realm_id]['usernames'] = usernames
+    
+    body = json.dumps({'realms': realms}, separators=(',', ':'))
+    response = HttpResponse(body, content_type='application/json')
+    patch_cache_control(response, private=True, max_age=settings.PRESENCE_MAX_AGE)
+    response['ETag'] = '"%s"' % hashlib.md5(body.encode()).hexdigest()
+    return get_conditional_response(request, etag=response['ETag'], response=response)
+
+
+@cache_control(public=True, max_age=300)
+@etag(lambda request: get_catalog().etag)
+def skin_catalog(request):
+    """Skin catalog for clients; revalidated by ETag once the cache expires"""
+    return HttpResponse(get_catalog().body, content_type='application/json')
+
+
 @login_required
 def profile(request):
     """User profile page with skin selection"""
     return render(request, 'profile/profile.html', {
-        'skins': AVAILABLE_SKINS,
-        'current_skin': request.user.profile.skin
+        'skins': get_catalog().ids,
+        'current_skin': get_catalog().resolve(request.user.profile.skin),
+        'skin_catalog': get_catalog().payload
     })
 
 
+@login_required
+@require_http_methods(["GET"])
+def realm_heatmap(request, realm_id):
+    """PNG heatmap of one room for the realm's owner.
+    
+    ?room=0, ?metric=occupancy (where players stand) or visits (where they
+    walk), ?hours=24 to look back. Rendered on demand and cached until new
+    counts are stored.
+    """
+    realm = get_object_or_404(Realm, id=realm_id, owner=request.user)
+    try:
+        room_index = int(request.GET.get('room', 0))
+        hours = max(1, min(int(request.GET.get('hours', 24)), 24 * 90))
+    except ValueError:
+        return JsonResponse({'error': 'room and hours must be numbers'}, status=400)
+    metric = request.GET.get('metric', 'occupancy')
+    if metric not in METRICS:
+        return JsonResponse({'error': f"metric must be one of {', '.join(METRICS)}"}, status=400)
+    
+    latest = latest_update(realm.id, room_index)
+    if latest is None:
+        return JsonResponse({'error': 'Nobody has been in this room yet.'}, status=404)
+    key = f'heatmap:{realm.id}:{room_index}:{metric}:{hours}:{latest.timestamp()}'
+    png = cache.get(key)
+    if png is None:
+        bounds, counts = load_heatmap(realm.id, room_index, metric, hours) or (None, None)
+        if counts is None:
+            return JsonResponse({'error': 'Nobody has been in this room lately.'}, status=404)
+        png = render_heatmap(bounds, counts)
+        cache.set(key, png, settings.HEATMAP_CACHE_SECONDS)
+    
+    response = HttpResponse(png, content_type='image/png')
+    # New counts arrive at most once per flush
+    patch_cache_control(response, private=True, max_age=int(settings.HEATMAP_FLUSH_SECONDS))
+    response['ETag'] = '"%s"' % hashlib.md5(key.encode()).hexdigest()
+    return get_conditional_response(request, etag=response['ETag'], response=response)
+
+
 @login_required
 def edit_realm(request, realm_id):
     """Map editor page"""
     import json
-    realm = get_object_or_404(Realm, id=realm_id, owner=request.user)
+    realm = get_object_or_404(Realm.objects.select_related('map_blob'), id=realm_id, owner=request.user)
     return render(request, 'editor/editor.html', {
         'realm': realm,
         'map_data_json': json.dumps(realm.map_data)
@@ -195,6 +397,57 @@ def save_realm_map(request, realm_id):
         return JsonResponse({'success': False, 'error': str(e)}, status=400)
 
 
+@login_required
+def export_realm(request, realm_id):
+    """Download a realm's map as NDJSON, gzipped with ?gzip=1"""
+    realm = get_object_or_404(Realm.objects.select_related('map_blob'), id=realm_id, owner=request.user)
+    chunks = iter_export(realm.name, realm.map_data)
+    filename = f'realm-{realm.id}.ndjson'
+    if request.GET.get('gzip'):
+        chunks = iter_gzip(chunks)
+        filename += '.gz'
+        content_type = 'application/gzip'
+    else:
+        content_type = 'application/x-ndjson'
+    response = StreamingHttpResponse(as_async(chunks), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+@login_required
+@require_http_methods(["POST"])
+def import_realm(request):
+    """Create a realm from an exported map sent as the request body"""
+    try:
+        # Read straight from the request stream rather than request.body
+        name, map_data = read_import(request)
+        realm = Realm.objects.create(
+            owner=request.user,
+            name=(request.GET.get('name') or name or 'Imported Realm')[:100],
+            map_data=map_data
+        )
+        return JsonResponse({
+            'success': True,
+            'realm_id': realm.id,
+            'share_id': str(realm.share_id)
+        })
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+
+@login_required
+@require_http_methods(["POST"])
+def import_realm_map(request, realm_id):
+    """Replace a realm's map with an exported map sent as the request body"""
+    realm = get_object_or_404(Realm, id=realm_id, owner=request.user)
+    try:
+        _, realm.map_data = read_import(request)
+        realm.save()
+        return JsonResponse({'success': True})
+    except Exception as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+
+
 @login_required
 @require_http_methods(["POST"])
 def delete_realm(request, realm_id):
@@ -210,7 +463,7 @@ def toggle_realm_privacy(request, realm_id):
     """Toggle only_owner flag"""
     realm = get_object_or_404(Realm, id=realm_id, owner=request.user)
     realm.only_owner = not realm.only_owner
-    realm.save()
+    realm.save(update_fields=['only_owner'])
     return JsonResponse({'success': True, 'only_owner': realm.only_owner})
 
 
@@ -233,5 +486,6 @@ def intro(request, realm_id):
     realm = get_object_or_404(Realm, id=realm_id)
     return render(request, 'play/intro.html', {
         'realm': realm,
-        'skin': request.user.profile.skin
+        'skin': get_catalog().resolve(request.user.profile.skin),
+        'skin_catalog': get_catalog().payload
     })
@@ -9,16 +9,19 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 
 import os
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
-from core.routing import websocket_urlpatterns
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gather.settings')
 
+# Set up Django before anything below imports models
 django_asgi_app = get_asgi_application()
 
+from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.auth import AuthMiddlewareStack
+from core.routing import websocket_urlpatterns
+from core.static import StaticFilesApp
+
 application = ProtocolTypeRouter({
-    "http": django_asgi_app,
+    "http": StaticFilesApp(django_asgi_app),
     "websocket": AuthMiddlewareStack(
         URLRouter(
             websocket_urlpatterns
@@ -1,6 +1,7 @@
 /**
  * AnimatedCharacter.js
  * Component for rendering animated character sprites
+ * Requires skin-catalog.js and the page's skin-catalog data
  */
 
 class AnimatedCharacter {
@@ -32,12 +33,13 @@ class AnimatedCharacter {
         this.container.innerHTML = '';
         this.container.appendChild(this.canvas);
 
-        // Load sprite sheet
-        this.spriteSheet = new Image();
-        this.spriteSheet.src = `/static/sprites/characters/Character_${this.skin}.png`;
-        this.spriteSheet.onload = () => {
+        // Every skin is drawn from the shared atlas image
+        this.spriteSheet = window.skinCatalog.loadAtlas();
+        if (this.spriteSheet.complete) {
             this.startAnimation();
-        };
+        } else {
+            this.spriteSheet.addEventListener('load', () => this.startAnimation(), { once: true });
+        }
     }
 
     startAnimation() {
@@ -66,8 +68,9 @@ class AnimatedCharacter {
         const directionMap = { down: 0, left: 1, right: 2, up: 3 };
         const row = directionMap[this.direction] || 0;
         
-        const sx = this.frame * this.frameWidth;
-        const sy = row * this.frameHeight;
+        const [atlasX, atlasY] = window.skinCatalog.offset(this.skin);
+        const sx = atlasX + this.frame * this.frameWidth;
+        const sy = atlasY + row * this.frameHeight;
 
         // Draw scaled up sprite
         this.ctx.imageSmoothingEnabled = false;
@@ -80,7 +83,7 @@ class AnimatedCharacter {
 
     setSkin(skin) {
         this.skin = skin;
-        this.spriteSheet.src = `/static/sprites/characters/Character_${this.skin}.png`;
+        this.render();
     }
 
     setDirection(direction) {
@@ -0,0 +1,91 @@
+/**
+ * SkinCatalog.js
+ * The skins players can pick (served by /api/skins/) and how to draw them:
+ * pickers use the packed atlas, the game prefetches single sheets on demand
+ */
+
+class SkinCatalog {
+    constructor(catalog) {
+        this.catalog = catalog;
+        this.atlasImage = null;
+        this.sheets = new Map();
+    }
+
+    // Reads a catalog the page embedded with json_script
+    static fromScript(id = 'skin-catalog') {
+        return new SkinCatalog(JSON.parse(document.getElementById(id).textContent));
+    }
+
+    // Fetches the catalog; the browser revalidates it by ETag
+    static async load(url = '/api/skins/') {
+        const response = await fetch(url);
+        return new SkinCatalog(await response.json());
+    }
+
+    ids() {
+        return Object.keys(this.catalog.skins);
+    }
+
+    has(skin) {
+        return skin in this.catalog.skins;
+    }
+
+    get(skin) {
+        return this.catalog.skins[skin] || this.catalog.skins['009'];
+    }
+
+    // Top-left corner of a skin's sheet in the atlas
+    offset(skin) {
+        return this.get(skin).atlas;
+    }
+
+    // Shows a skin's whole sheet scaled to fill `element`, as a CSS background
+    applyThumbnail(element, skin) {
+        const [x, y] = this.offset(skin);
+        const [cellWidth, cellHeight] = this.catalog.atlas.cell;
+        const columns = this.catalog.atlas.size[0] / cellWidth;
+        const rows = this.catalog.atlas.size[1] / cellHeight;
+        const left = columns > 1 ? (x / cellWidth) / (columns - 1) * 100 : 0;
+        const top = rows > 1 ? (y / cellHeight) / (rows - 1) * 100 : 0;
+
+        element.style.backgroundImage = `url(${this.catalog.atlas.url})`;
+        element.style.backgroundRepeat = 'no-repeat';
+        element.style.backgroundSize = `${columns * 100}% ${rows * 100}%`;
+        element.style.backgroundPosition = `${left}% ${top}%`;
+    }
+
+    // The atlas as an <image>, loaded once and shared by every canvas user
+    loadAtlas() {
+        if (!this.atlasImage) {
+            this.atlasImage = new Image();
+            this.atlasImage.src = this.catalog.atlas.url;
+        }
+        return this.atlasImage;
+    }
+
+    // Starts loading the sheets of these skins only, each at most once
+    prefetch(skins) {
+        skins.forEach(skin => {
+            const sheet = this.get(skin).sheet;
+            if (!this.sheets.has(sheet)) {
+                const image = new Image();
+                image.src = sheet;
+                this.sheets.set(sheet, image);
+            }
+        });
+    }
+
+    sheet(skin) {
+        this.prefetch([skin]);
+        return this.sheets.get(this.get(skin).sheet);
+    }
+}
+
+if (typeof document !== 'undefined' && document.getElementById('skin-catalog')) {
+    window.skinCatalog = SkinCatalog.fromScript();
+}
+
+// Export for use in other scripts
+if (typeof module !== 'undefined' && module.exports) {
+    module.exports = SkinCatalog;
+}
@@ -1,6 +1,7 @@
 /**
  * SkinModal.js
  * Logic for the reusable skin selection modal
+ * Requires skin-catalog.js and the page's skin-catalog data
  */
 
 class SkinModal {
@@ -15,11 +16,7 @@ class SkinModal {
     }
 
     generateSkinList() {
-        const skins = [];
-        for (let i = 1; i <= 83; i++) {
-            skins.push(String(i).padStart(3, '0'));
-        }
-        return skins;
+        return window.skinCatalog.ids();
     }
 
     init() {
@@ -79,10 +76,10 @@ class SkinModal {
             }`;
             button.dataset.skin = skin;
             
-            const img = document.createElement('img');
-            img.src = `/static/sprites/characters/Character_${skin}.png`;
-            img.alt = `Skin ${skin}`;
-            img.className = 'w-full h-full object-contain';
+            const img = document.createElement('div');
+            img.className = 'w-full aspect-square';
+            img.title = `Skin ${skin}`;
+            window.skinCatalog.applyThumbnail(img, skin);
             
             const label = document.createElement('p');
             label.className = 'text-xs text-center mt-1';
@@ -115,9 +112,8 @@ class SkinModal {
         const label = document.getElementById('skinLabel');
         
         if (preview) {
-            preview.innerHTML = `<img src="/static/sprites/characters/Character_${skin}.png" 
-                                     alt="Preview" 
-                                     class="w-32 h-32 object-contain">`;
+            preview.innerHTML = '<div class="w-32 h-32"></div>';
+            window.skinCatalog.applyThumbnail(preview.firstElementChild, skin);
         }
         
         if (label) {
@@ -1,6 +1,7 @@
 /**
  * SkinSelector.js
  * Logic for skin selection with preview
+ * Requires skin-catalog.js and the page's skin-catalog data
  */
 
 class SkinSelector {
@@ -16,11 +17,7 @@ class SkinSelector {
     }
 
     generateSkinList() {
-        const skins = [];
-        for (let i = 1; i <= 83; i++) {
-            skins.push(String(i).padStart(3, '0'));
-        }
-        return skins;
+        return window.skinCatalog.ids();
     }
 
     init() {
@@ -46,10 +43,10 @@ class SkinSelector {
             }`;
             button.dataset.skin = skin;
             
-            const img = document.createElement('img');
-            img.src = `/static/sprites/characters/Character_${skin}.png`;
-            img.alt = `Skin ${skin}`;
-            img.className = 'w-full h-full object-contain';
+            const img = document.createElement('div');
+            img.className = 'w-full aspect-square';
+            img.title = `Skin ${skin}`;
+            window.skinCatalog.applyThumbnail(img, skin);
             
             const label = document.createElement('p');
             label.className = 'text-xs text-center mt-1';
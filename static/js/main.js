@@ -1,4 +1,22 @@
 // Main game initialization
+
+// Fetched once (and revalidated by ETag); sheets are only loaded for skins
+// that show up in our room
+const skinCatalog = SkinCatalog.load().then(catalog => {
+    window.skinCatalog = catalog;
+    return catalog;
+});
+
+function prefetchSkins(skins) {
+    skinCatalog.then(catalog => catalog.prefetch(skins));
+}
+
+// Where every player in our room should be drawn; the renderer samples
+// roomMotion.positions() each frame instead of jumping on every update.
+// Spectators are not in the room, so every player there is remote to them
+const roomMotion = new RoomMotion(window.REALM_DATA.spectate ? null : window.REALM_DATA.userId);
+window.roomMotion = roomMotion;
+
 document.addEventListener('DOMContentLoaded', () => {
     console.log('Gather Clone - Initializing...');
     console.log('Realm Data:', window.REALM_DATA);
@@ -12,8 +30,17 @@ document.addEventListener('DOMContentLoaded', () => {
     // Setup UI handlers
     setupUIHandlers();
 
-    // Join the realm once connected
+    // Join (or watch) the realm once connected
     window.signal.on('ws-connected', () => {
+        if (window.REALM_DATA.spectate) {
+            window.wsClient.spectateRealm(window.REALM_DATA.realmId, null);
+            return;
+        }
+        if (window.wsClient.resumeToken) {
+            console.log('Resuming realm:', window.REALM_DATA.realmId);
+            window.wsClient.resumeRealm(window.REALM_DATA.realmId);
+            return;
+        }
         console.log('Joining realm:', window.REALM_DATA.realmId);
         window.wsClient.joinRealm(window.REALM_DATA.realmId, null);
     });
@@ -27,6 +54,68 @@ function setupWebSocketHandlers() {
     window.signal.on('ws:joinedRealm', (data) => {
         console.log('Joined realm successfully', data);
         updatePlayerCount(data.players ? data.players.length : 1);
+        prefetchSkins((data.players || [data.player]).map(p => p.skin));
+        roomMotion.setInterval(data.moveInterval);
+        roomMotion.reset(data.players || [data.player]);
+    });
+
+    // Handle full room state (after a room change or falling too far behind)
+    window.signal.on('ws:roomSnapshot', (data) => {
+        updatePlayerCount(data.players.length);
+        // Rows are [uid, username, x, y, skin]
+        prefetchSkins(data.players.map(row => row[4]));
+        roomMotion.reset(data.players.map(([uid, , x, y]) => ({ uid, x, y })));
+    });
+
+    // Handle resume after a dropped connection
+    window.signal.on('ws:resumedRealm', (data) => {
+        console.log('Resumed realm', data);
+        handleProximityChange(data.player.proximity_id);
+        prefetchSkins([data.player.skin, ...data.changed.map(p => p.skin)]);
+        roomMotion.setInterval(data.moveInterval);
+        roomMotion.place(data.player.uid, data.player.x, data.player.y);
+        data.changed.forEach(p => roomMotion.place(p.uid, p.x, p.y));
+        data.left.forEach(uid => roomMotion.remove(uid));
+    });
+
+    // Grace period ran out; join again from scratch
+    window.signal.on('ws:failedToResume', () => {
+        window.wsClient.joinRealm(window.REALM_DATA.realmId, null);
+    });
+
+    // The realm was handed to another server worker; join it there
+    window.signal.on('ws:realmMoved', () => {
+        if (window.REALM_DATA.spectate) {
+            window.wsClient.spectateRealm(window.REALM_DATA.realmId, null);
+            return;
+        }
+        window.wsClient.joinRealm(window.REALM_DATA.realmId, null);
+    });
+
+    // Handle watching a room as a spectator; rows are [uid, username, x, y, skin]
+    window.signal.on('ws:spectatingRealm', (data) => {
+        updatePlayerCount(data.players.length);
+        prefetchSkins(data.players.map(row => row[4]));
+        roomMotion.setInterval(data.interval);
+        roomMotion.reset(data.players.map(([uid, , x, y]) => ({ uid, x, y })));
+    });
+
+    // Handle what changed in the watched room since the last update
+    window.signal.on('ws:spectatorUpdate', (data) => {
+        roomMotion.applyBatch({
+            t: data.t,
+            moves: data.moved.map(([uid, x, y]) => [uid, [[x, y]], null])
+        });
+        prefetchSkins(data.updated.map(row => row[4]));
+        data.updated.forEach(([uid, , x, y]) => roomMotion.place(uid, x, y));
+        data.left.forEach(uid => roomMotion.remove(uid));
+        updatePlayerCount(roomMotion.remote.size);
+    });
+
+    // Removed from the space by an administrator
+    window.signal.on('ws:kicked', (data) => {
+        alert(data.reason);
+        window.location.href = '/app/';
     });
 
     // Handle failed join
@@ -37,24 +126,37 @@ function setupWebSocketHandlers() {
     // Handle player joined
     window.signal.on('ws:playerJoinedRoom', (data) => {
         console.log('Player joined:', data.player);
+        prefetchSkins([data.player.skin]);
+        roomMotion.place(data.player.uid, data.player.x, data.player.y);
         addChatMessage('System', `${data.player.username} joined the space`);
     });
 
     // Handle player left
     window.signal.on('ws:playerLeftRoom', (data) => {
         console.log('Player left:', data.uid);
+        roomMotion.remove(data.uid);
         addChatMessage('System', 'A player left the space');
     });
 
-    // Handle player moved
-    window.signal.on('ws:playerMoved', (data) => {
-        console.log('Player moved:', data);
-        // Update player position in game
+    // Handle the room's batched moves (ours included, for reconciliation)
+    window.signal.on('ws:playersMoved', (data) => {
+        roomMotion.applyBatch(data);
+    });
+
+    // Handle teleports; these are not interpolated
+    window.signal.on('ws:playerTeleported', (data) => {
+        roomMotion.place(data.uid, data.x, data.y);
+    });
+
+    // Handle skin change
+    window.signal.on('ws:playerChangedSkin', (data) => {
+        prefetchSkins([data.skin]);
     });
 
-    // Handle chat message
+    // Handle chat message; our own come back too and are shown as sent
     window.signal.on('ws:receiveMessage', (data) => {
-        addChatMessage(data.username, data.message);
+        if (String(data.uid) === String(window.REALM_DATA.userId)) return;
+        addChatMessage(data.username, data.message, data.scope, data.uid);
     });
 
     // Handle proximity update
@@ -90,13 +192,16 @@ function setupUIHandlers() {
     // Send chat message
     const chatInput = document.getElementById('chat-input');
     const sendChatBtn = document.getElementById('send-chat');
+    const chatScope = document.getElementById('chat-scope');
     
     if (chatInput && sendChatBtn) {
         const sendMessage = () => {
             const message = chatInput.value.trim();
             if (message) {
-                window.wsClient.sendMessage(message);
-                addChatMessage('You', message);
+                const option = chatScope.selectedOptions[0];
+                const scope = option.dataset.uid ? 'direct' : chatScope.value;
+                window.wsClient.sendMessage(message, scope, option.dataset.uid);
+                addChatMessage('You', message, scope);
                 chatInput.value = '';
             }
         };
@@ -110,13 +215,22 @@ function setupUIHandlers() {
     }
 }
 
-function addChatMessage(username, message) {
+const CHAT_SCOPE_LABELS = { realm: 'Everyone', proximity: 'Nearby', direct: 'Private' };
+
+function addChatMessage(username, message, scope = 'room', uid = null) {
     const chatMessages = document.getElementById('chat-messages');
     if (!chatMessages) return;
 
     const messageEl = document.createElement('div');
     messageEl.className = 'text-sm';
-    messageEl.innerHTML = `<strong>${escapeHtml(username)}:</strong> ${escapeHtml(message)}`;
+    const label = CHAT_SCOPE_LABELS[scope] ? `<span class="text-gray-500">[${CHAT_SCOPE_LABELS[scope]}]</span> ` : '';
+    messageEl.innerHTML = `${label}<strong>${escapeHtml(username)}:</strong> ${escapeHtml(message)}`;
+    if (uid !== null) {
+        // Clicking a name replies to that player privately
+        const name = messageEl.querySelector('strong');
+        name.classList.add('cursor-pointer');
+        name.addEventListener('click', () => chatDirectTo(uid, username));
+    }
     chatMessages.appendChild(messageEl);
     
     // Auto-scroll to bottom
@@ -128,6 +242,21 @@ function addChatMessage(username, message) {
     }
 }
 
+function chatDirectTo(uid, username) {
+    const chatScope = document.getElementById('chat-scope');
+    if (!chatScope) return;
+    let option = chatScope.querySelector('option[data-uid]');
+    if (!option) {
+        option = document.createElement('option');
+        chatScope.appendChild(option);
+    }
+    option.value = 'direct';
+    option.dataset.uid = uid;
+    option.textContent = `To ${username}`;
+    chatScope.value = 'direct';
+    document.getElementById('chat-input').focus();
+}
+
 function updatePlayerCount(count) {
     const playerCountEl = document.getElementById('player-count');
     if (playerCountEl) {
@@ -0,0 +1,189 @@
+// Smooth movement on top of the server's batched playersMoved updates.
+//
+// Other players are drawn a little in the past, interpolating between the
+// positions the server sent; our own player moves as soon as we ask and is
+// only corrected when the server disagrees.
+
+// How many batch intervals remote players are drawn behind the server;
+// a batch may be late by up to this much without a visible stop
+const INTERPOLATION_INTERVALS = 2;
+
+// Positions older than this behind the render time are dropped
+const BUFFER_MS = 2000;
+
+// One remote player's recent positions, by server time
+class InterpolationBuffer {
+    constructor(x, y) {
+        this.samples = [{ t: -Infinity, x, y }];
+    }
+
+    // Tiles walked since the previous batch are spread evenly over the
+    // interval that batch covered, ending at `t`
+    push(t, steps, interval) {
+        const last = this.samples[this.samples.length - 1];
+        const start = Math.max(last.t, t - interval);
+        // Standing still until then
+        if (last.t === -Infinity) {
+            last.t = start;
+        } else if (start > last.t) {
+            this.samples.push({ t: start, x: last.x, y: last.y });
+        }
+        steps.forEach(([x, y], i) => {
+            this.samples.push({ t: start + (t - start) * (i + 1) / steps.length, x, y });
+        });
+    }
+
+    // Jump without interpolating (teleports, snapshots)
+    snap(x, y) {
+        this.samples = [{ t: -Infinity, x, y }];
+    }
+
+    sample(renderTime) {
+        const samples = this.samples;
+        while (samples.length > 2 && samples[1].t <= renderTime - BUFFER_MS) {
+            samples.shift();
+        }
+
+        // Past the newest position: stay on it rather than guess ahead
+        let i = samples.length - 1;
+        if (renderTime >= samples[i].t) {
+            return { x: samples[i].x, y: samples[i].y };
+        }
+        while (i > 0 && samples[i - 1].t > renderTime) {
+            i--;
+        }
+        if (i === 0) {
+            return { x: samples[0].x, y: samples[0].y };
+        }
+        const a = samples[i - 1];
+        const b = samples[i];
+        const f = (renderTime - a.t) / (b.t - a.t);
+        return { x: a.x + (b.x - a.x) * f, y: a.y + (b.y - a.y) * f };
+    }
+}
+
+// Our own player: moves are applied right away and numbered, and the
+// server's batches tell us which of them it has applied
+class LocalPrediction {
+    constructor() {
+        this.x = 0;
+        this.y = 0;
+        this.input = 0;
+        this.pending = [];
+    }
+
+    reset(x, y) {
+        this.x = x;
+        this.y = y;
+        this.pending = [];
+    }
+
+    move(x, y) {
+        this.input++;
+        this.x = x;
+        this.y = y;
+        this.pending.push({ input: this.input, x, y });
+        window.wsClient.movePlayer(x, y, this.input);
+    }
+
+    // The server's position as of our input number `input`. If it is not
+    // where we predicted, our later moves were built on a wrong position;
+    // drop them and go where the server has us. Returns whether we snapped.
+    reconcile(x, y, input) {
+        if (input === null) {
+            return false;
+        }
+        let predicted = null;
+        while (this.pending.length && this.pending[0].input <= input) {
+            predicted = this.pending.shift();
+        }
+        if (predicted === null || (predicted.x === x && predicted.y === y)) {
+            return false;
+        }
+        this.reset(x, y);
+        return true;
+    }
+}
+
+class RoomMotion {
+    constructor(selfUid) {
+        this.selfUid = String(selfUid);
+        this.local = new LocalPrediction();
+        this.remote = new Map();
+        this.interval = 200;
+        // Estimated server clock minus performance.now()
+        this.clockOffset = null;
+    }
+
+    setInterval(ms) {
+        this.interval = ms;
+    }
+
+    // Start over from a full room state: players as {uid, x, y}
+    reset(players) {
+        this.remote.clear();
+        players.forEach(p => this.place(p.uid, p.x, p.y));
+    }
+
+    place(uid, x, y) {
+        uid = String(uid);
+        if (uid === this.selfUid) {
+            this.local.reset(x, y);
+        } else if (this.remote.has(uid)) {
+            this.remote.get(uid).snap(x, y);
+        } else {
+            this.remote.set(uid, new InterpolationBuffer(x, y));
+        }
+    }
+
+    remove(uid) {
+        this.remote.delete(String(uid));
+    }
+
+    // A playersMoved batch: rows of [uid, steps, input]
+    applyBatch(data) {
+        this.observeClock(data.t);
+        data.moves.forEach(([uid, steps, input]) => {
+            uid = String(uid);
+            if (uid === this.selfUid) {
+                const [x, y] = steps[steps.length - 1];
+                if (this.local.reconcile(x, y, input)) {
+                    window.signal.emit('movement:corrected', { x, y });
+                }
+            } else if (this.remote.has(uid)) {
+                this.remote.get(uid).push(data.t, steps, this.interval);
+            }
+        });
+    }
+
+    // A packet that took less time than any before moves the estimate up at
+    // once; otherwise it drifts slowly, so a late batch does not jerk the view
+    observeClock(t) {
+        const offset = t - performance.now();
+        if (this.clockOffset === null || offset > this.clockOffset) {
+            this.clockOffset = offset;
+        } else {
+            this.clockOffset += (offset - this.clockOffset) * 0.02;
+        }
+    }
+
+    renderTime(now = performance.now()) {
+        return now + (this.clockOffset || 0) - this.interval * INTERPOLATION_INTERVALS;
+    }
+
+    // Where to draw a remote player this frame, in (fractional) tiles
+    position(uid, now) {
+        const buffer = this.remote.get(String(uid));
+        return buffer ? buffer.sample(this.renderTime(now)) : null;
+    }
+
+    // Every player's position for this frame, ours included
+    positions(now = performance.now()) {
+        const renderTime = this.renderTime(now);
+        const positions = new Map([[this.selfUid, { x: this.local.x, y: this.local.y }]]);
+        this.remote.forEach((buffer, uid) => positions.set(uid, buffer.sample(renderTime)));
+        return positions;
+    }
+}
+
+window.RoomMotion = RoomMotion;
@@ -1,44 +1,241 @@
-// BFS pathfinding algorithm
-function bfs(start, end, blocked, maxAttempts = 10000) {
-    const endKey = `${end[0]}, ${end[1]}`;
-    if (blocked.has(endKey)) {
-        return null;
+// Grid pathfinding: A* over a typed-array grid with a binary heap.
+//
+// Tiles are walkable unless blocked, as far as the player cares to walk.
+// Searching a bounded grid is enough for that: the box around every
+// blocked tile (plus start and end), grown by one free ring, always holds
+// a shortest path, since a detour further out can follow the ring instead.
+
+const DIRECTIONS = [[0, 1], [1, 0], [0, -1], [-1, 0]];
+
+function parseTileKey(key) {
+    const [x, y] = key.split(',');
+    return [parseInt(x, 10), parseInt(y, 10)];
+}
+
+// Min-heap of node indexes ordered by an external score array; ties go to
+// the node pushed last, which keeps A* heading for the goal
+class NodeHeap {
+    constructor(capacity) {
+        this.nodes = new Int32Array(capacity);
+        this.order = new Uint32Array(capacity);
+        this.size = 0;
+        this.pushes = 0;
+    }
+
+    clear() {
+        this.size = 0;
+        this.pushes = 0;
+    }
+
+    less(a, b, score) {
+        const na = this.nodes[a];
+        const nb = this.nodes[b];
+        return score[na] < score[nb] || (score[na] === score[nb] && this.order[a] > this.order[b]);
+    }
+
+    swap(a, b) {
+        const node = this.nodes[a];
+        const order = this.order[a];
+        this.nodes[a] = this.nodes[b];
+        this.order[a] = this.order[b];
+        this.nodes[b] = node;
+        this.order[b] = order;
+    }
+
+    push(node, score) {
+        if (this.size === this.nodes.length) {
+            const nodes = new Int32Array(this.nodes.length * 2);
+            const order = new Uint32Array(this.nodes.length * 2);
+            nodes.set(this.nodes);
+            order.set(this.order);
+            this.nodes = nodes;
+            this.order = order;
+        }
+        let i = this.size++;
+        this.nodes[i] = node;
+        this.order[i] = this.pushes++;
+        while (i > 0) {
+            const parent = (i - 1) >> 1;
+            if (!this.less(i, parent, score)) {
+                break;
+            }
+            this.swap(i, parent);
+            i = parent;
+        }
+    }
+
+    pop(score) {
+        const top = this.nodes[0];
+        this.size--;
+        if (this.size > 0) {
+            this.nodes[0] = this.nodes[this.size];
+            this.order[0] = this.order[this.size];
+            let i = 0;
+            while (true) {
+                const left = 2 * i + 1;
+                const right = left + 1;
+                let smallest = i;
+                if (left < this.size && this.less(left, smallest, score)) {
+                    smallest = left;
+                }
+                if (right < this.size && this.less(right, smallest, score)) {
+                    smallest = right;
+                }
+                if (smallest === i) {
+                    break;
+                }
+                this.swap(i, smallest);
+                i = smallest;
+            }
+        }
+        return top;
+    }
+}
+
+// Finds paths around one set of blocked tiles. Build one per room and reuse
+// it: the grid and search arrays are only reallocated when a search reaches
+// outside the current bounds.
+class PathFinder {
+    // `blocked`: iterable of "x, y" keys or [x, y] pairs
+    constructor(blocked) {
+        this.blockedTiles = [];
+        for (const tile of blocked) {
+            this.blockedTiles.push(typeof tile === 'string' ? parseTileKey(tile) : tile);
+        }
+        this.bounds = null;
+        this.heap = new NodeHeap(1024);
     }
 
-    const directions = [
-        [0, 1], [1, 0], [0, -1], [-1, 0]
-    ];
+    // Grid covering the blocked tiles and these points, plus the free ring
+    layout(points) {
+        let minX = Infinity, minY = Infinity, maxX = -Infinity, maxY = -Infinity;
+        for (const [x, y] of this.blockedTiles.concat(points)) {
+            minX = Math.min(minX, x);
+            minY = Math.min(minY, y);
+            maxX = Math.max(maxX, x);
+            maxY = Math.max(maxY, y);
+        }
+        minX--; minY--; maxX++; maxY++;
 
-    const queue = [[start, [start]]];
-    const visited = new Set(blocked);
-    visited.add(`${start[0]}, ${start[1]}`);
+        const width = maxX - minX + 1;
+        const height = maxY - minY + 1;
+        const size = width * height;
+        this.bounds = { minX, minY, maxX, maxY, width };
+        this.blocked = new Uint8Array(size);
+        for (const [x, y] of this.blockedTiles) {
+            this.blocked[(y - minY) * width + (x - minX)] = 1;
+        }
+        this.parent = new Int32Array(size);
+        this.cost = new Int32Array(size);
+        this.score = new Int32Array(size);
+        // A node is visited in search `generation` when its mark equals it,
+        // so arrays never need clearing between searches
+        this.visited = new Uint32Array(size);
+        this.closed = new Uint32Array(size);
+        this.generation = 0;
+    }
 
-    let attempts = 0;
+    contains(x, y) {
+        const b = this.bounds;
+        return b !== null && x >= b.minX && x <= b.maxX && y >= b.minY && y <= b.maxY;
+    }
 
-    while (queue.length > 0) {
-        if (attempts >= maxAttempts) {
+    isBlocked(x, y) {
+        if (!this.contains(x, y)) {
+            return false;
+        }
+        const b = this.bounds;
+        return this.blocked[(y - b.minY) * b.width + (x - b.minX)] === 1;
+    }
+
+    // Tiles to walk from `start` to `end`, without `start`; [] when already
+    // there, null when unreachable or after expanding `maxNodes` tiles
+    find(start, end, maxNodes = Infinity) {
+        if (!this.contains(start[0], start[1]) || !this.contains(end[0], end[1])) {
+            this.layout([start, end]);
+        }
+        if (this.isBlocked(end[0], end[1])) {
             return null;
         }
-        attempts++;
 
-        const [currentPos, path] = queue.shift();
-        const [x, y] = currentPos;
+        const { minX, minY, maxX, maxY, width } = this.bounds;
+        const startNode = (start[1] - minY) * width + (start[0] - minX);
+        const endNode = (end[1] - minY) * width + (end[0] - minX);
+        const [endX, endY] = end;
 
-        if (x === end[0] && y === end[1]) {
-            return path.slice(1);
+        const generation = ++this.generation;
+        if (generation === 0xFFFFFFFF) {
+            this.visited.fill(0);
+            this.closed.fill(0);
+            this.generation = 1;
         }
+        const { blocked, parent, cost, score, visited, closed, heap } = this;
+        const mark = this.generation;
 
-        for (const [dx, dy] of directions) {
-            const nextPos = [x + dx, y + dy];
-            const nextPosStr = `${nextPos[0]}, ${nextPos[1]}`;
-            if (!visited.has(nextPosStr)) {
-                visited.add(nextPosStr);
-                queue.push([nextPos, path.concat([nextPos])]);
+        heap.clear();
+        visited[startNode] = mark;
+        parent[startNode] = -1;
+        cost[startNode] = 0;
+        score[startNode] = Math.abs(start[0] - endX) + Math.abs(start[1] - endY);
+        heap.push(startNode, score);
+
+        let expanded = 0;
+        while (heap.size > 0) {
+            const node = heap.pop(score);
+            if (closed[node] === mark) {
+                continue;
+            }
+            if (node === endNode) {
+                return this.reconstruct(node);
+            }
+            if (++expanded > maxNodes) {
+                return null;
+            }
+            closed[node] = mark;
+
+            const x = node % width + minX;
+            const y = (node / width | 0) + minY;
+            for (const [dx, dy] of DIRECTIONS) {
+                const nx = x + dx;
+                const ny = y + dy;
+                if (nx < minX || nx > maxX || ny < minY || ny > maxY) {
+                    continue;
+                }
+                const next = node + dy * width + dx;
+                if (blocked[next] || closed[next] === mark) {
+                    continue;
+                }
+                const nextCost = cost[node] + 1;
+                if (visited[next] === mark && nextCost >= cost[next]) {
+                    continue;
+                }
+                visited[next] = mark;
+                parent[next] = node;
+                cost[next] = nextCost;
+                score[next] = nextCost + Math.abs(nx - endX) + Math.abs(ny - endY);
+                heap.push(next, score);
             }
         }
+        return null;
     }
 
-    return null;
+    reconstruct(node) {
+        const { minX, minY, width } = this.bounds;
+        const path = new Array(this.cost[node]);
+        for (let i = path.length - 1; i >= 0; i--) {
+            path[i] = [node % width + minX, (node / width | 0) + minY];
+            node = this.parent[node];
+        }
+        return path;
+    }
+}
+
+// Drop-in for the original BFS: same arguments and result. Callers that
+// search the same room repeatedly should keep a PathFinder instead, which
+// skips rebuilding the grid every time.
+function bfs(start, end, blocked, maxAttempts = Infinity) {
+    return new PathFinder(blocked).find(start, end, maxAttempts);
 }
 
+window.PathFinder = PathFinder;
 window.bfs = bfs;
@@ -6,101 +6,104 @@ class JitsiChat {
         this.cameraEnabled = false;
         this.micEnabled = false;
         this.channelTimeout = null;
+        this.switchDelay = 300;
         this.domain = 'meet.jit.si'; // Use public Jitsi server or configure your own
     }
 
+    // The server only reports a group once it has held for a moment, so a
+    // short debounce is enough to absorb a leave and rejoin in quick
+    // succession without rebuilding the iframe
     async joinChannel(channel, uid, realmId) {
+        this.switchChannel(this.createUniqueChannelId(realmId, channel));
+    }
+
+    async leaveChannel() {
+        this.switchChannel('');
+    }
+
+    switchChannel(channelId) {
         if (this.channelTimeout) {
             clearTimeout(this.channelTimeout);
         }
 
-        this.channelTimeout = setTimeout(async () => {
-            const uniqueChannelId = this.createUniqueChannelId(realmId, channel);
-            
-            if (uniqueChannelId === this.currentChannel && this.api) {
-                return; // Already in this channel
+        this.channelTimeout = setTimeout(() => {
+            this.channelTimeout = null;
+            if (channelId === this.currentChannel) {
+                return; // Already there
             }
 
-            // Leave current channel if any
-            if (this.api) {
-                await this.leaveChannel();
+            this.disposeConference();
+            if (channelId) {
+                this.openConference(channelId);
             }
+        }, this.switchDelay);
+    }
 
-            this.currentChannel = uniqueChannelId;
-            
-            // Create Jitsi Meet room
-            const options = {
-                roomName: uniqueChannelId,
-                width: '100%',
-                height: '100%',
-                parentNode: document.querySelector('#local-video'),
-                configOverwrite: {
-                    startWithAudioMuted: !this.micEnabled,
-                    startWithVideoMuted: !this.cameraEnabled,
-                    prejoinPageEnabled: false,
-                    disableDeepLinking: true
-                },
-                interfaceConfigOverwrite: {
-                    TOOLBAR_BUTTONS: [],
-                    SHOW_JITSI_WATERMARK: false,
-                    SHOW_WATERMARK_FOR_GUESTS: false,
-                    MOBILE_APP_PROMO: false
-                },
-                userInfo: {
-                    displayName: window.REALM_DATA.username
-                }
-            };
-
-            this.api = new JitsiMeetExternalAPI(this.domain, options);
-
-            // Handle remote participants
-            this.api.addEventListener('participantJoined', (event) => {
-                console.log('Participant joined:', event);
-                this.onParticipantJoined(event);
-            });
-
-            this.api.addEventListener('participantLeft', (event) => {
-                console.log('Participant left:', event);
-                this.onParticipantLeft(event);
-            });
-
-            this.api.addEventListener('videoConferenceJoined', (event) => {
-                console.log('Joined video conference:', event);
-            });
-
-            // Apply current audio/video state
-            if (!this.cameraEnabled) {
-                this.api.executeCommand('toggleVideo');
-            }
-            if (!this.micEnabled) {
-                this.api.executeCommand('toggleAudio');
+    openConference(channelId) {
+        this.currentChannel = channelId;
+
+        // Create Jitsi Meet room
+        const options = {
+            roomName: channelId,
+            width: '100%',
+            height: '100%',
+            parentNode: document.querySelector('#local-video'),
+            configOverwrite: {
+                startWithAudioMuted: !this.micEnabled,
+                startWithVideoMuted: !this.cameraEnabled,
+                prejoinPageEnabled: false,
+                disableDeepLinking: true
+            },
+            interfaceConfigOverwrite: {
+                TOOLBAR_BUTTONS: [],
+                SHOW_JITSI_WATERMARK: false,
+                SHOW_WATERMARK_FOR_GUESTS: false,
+                MOBILE_APP_PROMO: false
+            },
+            userInfo: {
+                displayName: window.REALM_DATA.username
             }
-        }, 1000);
-    }
+        };
 
-    async leaveChannel() {
-        if (this.channelTimeout) {
-            clearTimeout(this.channelTimeout);
+        this.api = new JitsiMeetExternalAPI(this.domain, options);
+
+        // Handle remote participants
+        this.api.addEventListener('participantJoined', (event) => {
+            console.log('Participant joined:', event);
+            this.onParticipantJoined(event);
+        });
+
+        this.api.addEventListener('participantLeft', (event) => {
+            console.log('Participant left:', event);
+            this.onParticipantLeft(event);
+        });
+
+        this.api.addEventListener('videoConferenceJoined', (event) => {
+            console.log('Joined video conference:', event);
+        });
+
+        // Apply current audio/video state
+        if (!this.cameraEnabled) {
+            this.api.executeCommand('toggleVideo');
+        }
+        if (!this.micEnabled) {
+            this.api.executeCommand('toggleAudio');
         }
+    }
 
-        this.channelTimeout = setTimeout(() => {
-            if (this.currentChannel === '') {
-                return;
-            }
+    disposeConference() {
+        if (this.api) {
+            this.api.dispose();
+            this.api = null;
+        }
 
-            if (this.api) {
-                this.api.dispose();
-                this.api = null;
-            }
+        this.currentChannel = '';
 
-            this.currentChannel = '';
-            
-            // Clear remote video containers
-            const remoteVideos = document.querySelector('#remote-videos');
-            if (remoteVideos) {
-                remoteVideos.innerHTML = '';
-            }
-        }, 1000);
+        // Clear remote video containers
+        const remoteVideos = document.querySelector('#remote-videos');
+        if (remoteVideos) {
+            remoteVideos.innerHTML = '';
+        }
     }
 
     async toggleCamera() {
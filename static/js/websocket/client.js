@@ -1,30 +1,66 @@
 // WebSocket client for Django Channels
+
+// Messages that (re)set the room state as of their `seq`
+const ROOM_BASE_TYPES = new Set(['joinedRealm', 'resumedRealm', 'roomSnapshot']);
+
+// Whether this browser can inflate the deflated frames the server sends
+// for large messages
+const CAN_INFLATE = (() => {
+    try {
+        new DecompressionStream('deflate-raw');
+        return true;
+    } catch (e) {
+        return false;
+    }
+})();
+
+async function inflate(blob) {
+    const stream = blob.stream().pipeThrough(new DecompressionStream('deflate-raw'));
+    return new Response(stream).text();
+}
+
 class WSClient {
     constructor() {
         this.ws = null;
         this.connected = false;
         this.handlers = {};
+        this.resumeToken = null;
+        this.closing = false;
+        this.reconnectDelay = 500;
+        this.lastSeq = null;
+        this.pending = new Map();
+        this.gapTimer = null;
+        this.ackedSeq = null;
+        this.ackTimer = null;
+        this.inbox = Promise.resolve();
     }
 
     connect() {
+        this.closing = false;
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${window.location.host}/ws/game/`;
+        const query = CAN_INFLATE ? '?compress=deflate-raw' : '';
+        const wsUrl = `${protocol}//${window.location.host}/ws/game/${query}`;
         
         this.ws = new WebSocket(wsUrl);
 
         this.ws.onopen = () => {
             console.log('WebSocket connected');
             this.connected = true;
+            this.reconnectDelay = 500;
             window.signal.emit('ws-connected');
         };
 
         this.ws.onmessage = (event) => {
-            try {
-                const data = JSON.parse(event.data);
-                this.handleMessage(data);
-            } catch (e) {
-                console.error('Failed to parse WebSocket message:', e);
-            }
+            // Binary (deflated) frames take a moment to inflate; chain every
+            // message so they are still handled in the order they arrived
+            this.inbox = this.inbox.then(async () => {
+                try {
+                    const text = typeof event.data === 'string' ? event.data : await inflate(event.data);
+                    this.handleMessage(JSON.parse(text));
+                } catch (e) {
+                    console.error('Failed to parse WebSocket message:', e);
+                }
+            });
         };
 
         this.ws.onerror = (error) => {
@@ -36,6 +72,13 @@ class WSClient {
             console.log('WebSocket disconnected');
             this.connected = false;
             window.signal.emit('ws-disconnected');
+
+            // The server holds our player for a short grace period, so come
+            // back quickly and resume instead of rejoining from scratch
+            if (!this.closing) {
+                setTimeout(() => this.connect(), this.reconnectDelay);
+                this.reconnectDelay = Math.min(this.reconnectDelay * 2, 8000);
+            }
         };
     }
 
@@ -52,7 +95,112 @@ class WSClient {
 
     handleMessage(data) {
         const type = data.type;
-        
+
+        if (data.resumeToken) {
+            this.resumeToken = data.resumeToken;
+        } else if (type === 'failedToResume' || type === 'realmMoved') {
+            this.resumeToken = null;
+        } else if (type === 'kicked') {
+            // Removed by an administrator; the server closes next, for good
+            this.resumeToken = null;
+            this.closing = true;
+        }
+
+        if (type === 'roomDelta') {
+            this.applyDelta(data);
+            return;
+        }
+        if (data.seq !== undefined) {
+            this.receiveSequenced(data);
+            return;
+        }
+
+        this.dispatch(data);
+    }
+
+    // Room events carry a per-room sequence number. Apply them strictly in
+    // order; hold early arrivals briefly and ask the server to fill real gaps.
+    receiveSequenced(data) {
+        if (ROOM_BASE_TYPES.has(data.type)) {
+            this.lastSeq = data.seq;
+            this.ackedSeq = data.seq;
+            this.pending.clear();
+            this.dispatch(data);
+            return;
+        }
+        if (this.lastSeq === null || data.seq <= this.lastSeq) {
+            return; // Not joined yet, or already covered by a snapshot/delta
+        }
+        this.pending.set(data.seq, data);
+        this.drainPending();
+    }
+
+    drainPending() {
+        while (this.pending.has(this.lastSeq + 1)) {
+            const event = this.pending.get(this.lastSeq + 1);
+            this.pending.delete(this.lastSeq + 1);
+            this.lastSeq = event.seq;
+            if (event.type !== 'ack') {
+                this.dispatch(event);
+            }
+        }
+
+        this.scheduleAck();
+
+        if (this.pending.size === 0) {
+            clearTimeout(this.gapTimer);
+            this.gapTimer = null;
+        } else if (!this.gapTimer) {
+            this.gapTimer = setTimeout(() => {
+                this.gapTimer = null;
+                if (this.pending.size > 0) {
+                    this.send('syncRoom', { seq: this.lastSeq });
+                }
+            }, 250);
+        }
+    }
+
+    applyDelta(data) {
+        data.events.forEach(event => {
+            if (event.seq > this.lastSeq) {
+                this.lastSeq = event.seq;
+                this.dispatch(event);
+            }
+        });
+        this.lastSeq = Math.max(this.lastSeq, data.seq);
+        for (const seq of this.pending.keys()) {
+            if (seq <= this.lastSeq) {
+                this.pending.delete(seq);
+            }
+        }
+        this.drainPending();
+    }
+
+    // Tell the server how far we got so it knows whether we keep up;
+    // batched, since the server only needs a rough position
+    scheduleAck() {
+        if (this.lastSeq === null || this.lastSeq === this.ackedSeq) {
+            return;
+        }
+        if (this.lastSeq - this.ackedSeq >= 32) {
+            this.sendAck();
+        } else if (!this.ackTimer) {
+            this.ackTimer = setTimeout(() => this.sendAck(), 200);
+        }
+    }
+
+    sendAck() {
+        clearTimeout(this.ackTimer);
+        this.ackTimer = null;
+        if (this.lastSeq !== null && this.lastSeq !== this.ackedSeq) {
+            this.ackedSeq = this.lastSeq;
+            this.send('ackSeq', { seq: this.lastSeq });
+        }
+    }
+
+    dispatch(data) {
+        const type = data.type;
+
         // Emit to signal for component handling
         window.signal.emit(`ws:${type}`, data);
 
@@ -80,8 +228,20 @@ class WSClient {
         this.send('joinRealm', { realmId, shareId });
     }
 
-    movePlayer(x, y) {
-        this.send('movePlayer', { x, y });
+    // Watch a room without joining it; null for the spawn room
+    spectateRealm(realmId, roomIndex) {
+        this.send('spectateRealm', { realmId, roomIndex });
+    }
+
+    resumeRealm(realmId) {
+        // realmId lets the server route us to the worker that owns the realm
+        this.send('resumeRealm', { realmId, resumeToken: this.resumeToken });
+    }
+
+    // `input` numbers our moves so the server's batches can say which it
+    // applied (see RoomMotion)
+    movePlayer(x, y, input) {
+        this.send('movePlayer', { x, y, input });
     }
 
     teleport(roomIndex, x, y) {
@@ -92,13 +252,16 @@ class WSClient {
         this.send('changedSkin', { skin });
     }
 
-    sendMessage(message) {
-        this.send('sendMessage', { message });
+    // scope: 'room', 'realm', 'proximity', or 'direct' to the player ``to``
+    sendMessage(message, scope = 'room', to = undefined) {
+        this.send('sendMessage', { message, scope, to });
     }
 
     disconnect() {
+        this.closing = true;
         if (this.ws) {
-            this.ws.close();
+            // 1000 tells the server we left on purpose (no resume grace)
+            this.ws.close(1000);
         }
     }
 }